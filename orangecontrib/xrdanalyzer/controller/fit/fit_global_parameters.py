@@ -49,8 +49,8 @@ class FitGlobalParameters(FitParametersList):
     def is_convergence_reached(self):
         return self.convergence_reached == True
 
-    def space_parameters(self):
-        return FitSpaceParameters(self)
+    def space_parameters(self, fft_parameters=None):
+        return FitSpaceParameters(self, fft_parameters)
 
     def get_background_parameters(self, key):
         try:
@@ -272,8 +272,8 @@ class FitGlobalParameters(FitParametersList):
             self.set_functions_values(parameters_dictionary)
             self.free_output_parameters.set_functions_values(parameters_dictionary)
 
-    def duplicate(self):
-        self.evaluate_functions()
+    def duplicate(self, evaluate_functions=True):
+        if evaluate_functions: self.evaluate_functions()
 
         fit_initialization = None if self.fit_initialization is None else self.fit_initialization.duplicate()
 
@@ -337,6 +337,24 @@ class FitGlobalParameters(FitParametersList):
         fit_global_parameters.free_input_parameters = self.free_input_parameters.duplicate()
         fit_global_parameters.free_output_parameters = self.free_output_parameters.duplicate()
 
+        # the fitters plan their work on it (e.g. the last stages of the multiresolution schedule)
+        fit_global_parameters.n_max_iterations = self.n_max_iterations
+
+        return fit_global_parameters
+
+    def snapshot(self):
+        """
+        read-only copy of the current state, to be published while the original keeps changing (e.g. the working
+        parameters of a fitter): the formulas are not re-evaluated, errors and fit status are kept
+        """
+        fit_global_parameters = self.duplicate(evaluate_functions=False)
+
+        for parameter, snapshot_parameter in zip(self.get_parameters(), fit_global_parameters.get_parameters()):
+            snapshot_parameter.error = parameter.error
+
+        fit_global_parameters.n_max_iterations = self.n_max_iterations
+        fit_global_parameters.convergence_reached = self.convergence_reached
+
         return fit_global_parameters
 
     def is_compatibile(self, other_fit_global_parameters):
@@ -353,9 +371,11 @@ class FitGlobalParameters(FitParametersList):
         return True
 
 class FitSpaceParameters:
-    def __init__(self, fit_global_parameters):
-        s_max   = fit_global_parameters.fit_initialization.fft_parameters.s_max
-        n_steps = fit_global_parameters.fit_initialization.fft_parameters.n_step
+    def __init__(self, fit_global_parameters, fft_parameters=None): # other FFT parameters than the fit ones: e.g. a probe grid
+        if fft_parameters is None: fft_parameters = fit_global_parameters.fit_initialization.fft_parameters
+
+        s_max   = fft_parameters.s_max
+        n_steps = fft_parameters.n_step
 
         self.ds = s_max/(n_steps - 1)
         self.dL = 1 / (2 * s_max)
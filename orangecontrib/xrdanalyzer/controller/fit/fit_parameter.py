@@ -142,7 +142,6 @@ class ParametersList:
 
 
 class FitParametersList(ParametersList):
-    __parameters = numpy.empty(10000)
 
     @classmethod
     def get_parameters_prefix(cls):
@@ -152,7 +151,8 @@ class FitParametersList(ParametersList):
         return len(self.get_parameters())
 
     def get_parameters(self):
-        return self.__parameters
+        # the fit parameters of the instance, in the order they are set by __init__
+        return [value for value in self.__dict__.values() if isinstance(value, FitParameter)]
 
     def to_text(self):
         raise NotImplementedError()
@@ -166,7 +166,7 @@ class FitParametersList(ParametersList):
     def get_available_parameters(self):
         text = ""
 
-        for parameter in self.__parameters:
+        for parameter in self.get_parameters():
             if not parameter.function: text += parameter.to_parameter_text() + "\n"
 
         return text
@@ -175,7 +175,7 @@ class FitParametersList(ParametersList):
         parameters_dictionary = {}
         python_code = ""
 
-        for parameter in self.__parameters:
+        for parameter in self.get_parameters():
             if parameter.function:
                 parameters_dictionary[parameter.parameter_name] = numpy.nan
                 python_code += parameter.to_python_code() + "\n"
@@ -183,7 +183,7 @@ class FitParametersList(ParametersList):
         return parameters_dictionary, python_code
 
     def set_functions_values(self, parameters_dictionary):
-        for parameter in self.__parameters:
+        for parameter in self.get_parameters():
             if parameter.function:
                 parameter.value = float(parameters_dictionary[parameter.parameter_name])
 
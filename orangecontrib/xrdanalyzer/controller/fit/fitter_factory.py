@@ -1,14 +1,16 @@
 import orangecontrib.xrdanalyzer.util.congruence as congruence
 from orangecontrib.xrdanalyzer.controller.fit.fitters.fitter_minpack import FitterMinpack
 from orangecontrib.xrdanalyzer.controller.fit.fitters.fitter_minpack_2 import FitterMinpack2
+from orangecontrib.xrdanalyzer.controller.fit.fitters.fitter_least_squares import FitterLeastSquares
 
 class FitterName:
     MINPACK  = "minpack"
     MINPACK2  = "minpack2"
+    LEAST_SQUARES  = "least_squares"
 
     @classmethod
     def tuple(cls):
-        return [cls.MINPACK, cls.MINPACK2]
+        return [cls.MINPACK, cls.MINPACK2, cls.LEAST_SQUARES]
 
 class FitterFactory():
 
@@ -16,9 +18,14 @@ class FitterFactory():
     def create_fitter(cls, fitter_name=FitterName.MINPACK, additional_data=None):
         congruence.checkEmptyString(fitter_name, "Fitter Name")
 
+        # additional_data: dictionary of options passed to the fitter constructor (e.g. n_workers)
+        if additional_data is None: additional_data = {}
+
         if fitter_name == FitterName.MINPACK:
-            return FitterMinpack()
+            return FitterMinpack(**additional_data)
         elif fitter_name == FitterName.MINPACK2:
-            return FitterMinpack2()
+            return FitterMinpack2(**additional_data)
+        elif fitter_name == FitterName.LEAST_SQUARES:
+            return FitterLeastSquares(**additional_data)
         else:
             raise ValueError("Fitter name <" + fitter_name +"> not recognized")
@@ -0,0 +1,871 @@
+import copy, threading, re, time
+from concurrent.futures import ThreadPoolExecutor
+
+from orangecontrib.xrdanalyzer.controller.fit.fitter import FitterInterface
+
+from orangecontrib.xrdanalyzer.model.diffraction_pattern import DiffractionPattern, DiffractionPoint
+from orangecontrib.xrdanalyzer.controller.fit.fit_parameter import PARAM_ERR
+from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import PeakSynthesis, AutomaticGrid
+from orangecontrib.xrdanalyzer.controller.fit.instrument.instrumental_parameters import Lab6TanCorrection, ZeroError, SpecimenDisplacement
+from orangecontrib.xrdanalyzer.controller.fit.instrument.background_parameters import ChebyshevBackground, ExpDecayBackground
+from orangecontrib.xrdanalyzer.controller.fit.microstructure.size import Distribution
+from orangecontrib.xrdanalyzer.controller.fit.microstructure.strain import InvariantPAH, WarrenModel, KrivoglazWilkensModel
+from orangecontrib.xrdanalyzer.controller.fit.fitters.fitter_minpack_util import *
+from orangecontrib.xrdanalyzer.controller.fit.wppm_functions import fit_function_direct, component_cache, get_auto_fft_grid, \
+    init_experimental_factors
+from orangecontrib.xrdanalyzer.controller.fit.wppm_derivatives import fit_function_direct_derivatives
+
+PRCSN = 2.5E-7
+
+class MinpackData:
+    def __init__(self,
+                 dof = 0.0,
+                 wss = 0.0,
+                 ss = 0.0,
+                 wsq = 0.0,
+                 nobs = 0.0,
+                 nprm = 0.0,
+                 nfit = 0.0,
+                 calc_lambda = 0.0,
+                 cache_hits = 0,
+                 cache_misses = 0,
+                 component_cache_text = "",
+                 multiresolution_text = "",
+                 calculate = True):
+        self.dof = dof
+        self.wss = wss
+        self.ss = ss
+        self.wsq = wsq
+        self.nprm = nprm
+        self.nfit = nfit
+        self.nobs = nobs
+        self.calc_lambda = calc_lambda
+        self.cache_hits = cache_hits
+        self.cache_misses = cache_misses
+        self.component_cache_text = component_cache_text
+        self.multiresolution_text = multiresolution_text
+
+        if calculate: self.calculate()
+
+    def calculate(self):
+        try:
+            self.rwp  = numpy.sqrt(self.wss / self.wsq)
+        except:
+            self.rwp = 0.0
+
+        try:
+            self.rexp = numpy.sqrt(self.dof / self.wsq)
+        except:
+            self.rexp = 0.0
+
+    def gof(self):
+        return self.rwp / self.rexp
+
+    def to_text(self):
+        text = "\nCurrent fit results:\n\n"
+        text += "  total parameters   (nprm): " + str(self.nprm) + "\n"
+        text += "  parameters to fit  (nfit): " + str(self.nfit) + "\n"
+        text += "  nr. of observables (nobs): " + str(self.nobs) + "\n"
+        text += "  dof (nobs - nfit)        : " + str(self.dof)  + "\n"
+        text += "  LAMBDA: " + str(self.calc_lambda)+ "\n"
+        text += "  wss: " + str(self.wss) + "\n"
+        text += "  ss : " + str(self.ss) + "\n"
+        text += "  wsq: " + str(self.wsq) + "\n"
+        text += "  gof: " + str(self.gof())+ "\n"
+        text += "  model cache hits/misses: " + str(self.cache_hits) + "/" + str(self.cache_misses) + "\n"
+        text += self.component_cache_text
+        text += self.multiresolution_text
+
+        return text
+
+class FitterBase(FitterInterface):
+    """
+    the WPPM model seen by a minimizer: weighted residuals and jacobian of the patterns, parameters layout, model
+    cache, workers of the jacobian, multiresolution schedule, automatic FFT grid and published snapshots. The
+    subclasses implement the minimization (init_minimizer and do_fit)
+    """
+
+    def __init__(self, n_workers=1, analytic_jacobian=False, synthesis=PeakSynthesis.FFT, multiresolution_stages=1, multiresolution_stall=0.01):
+        super().__init__()
+
+        # how the peaks are calculated on the points of the patterns (PeakSynthesis)
+        self.synthesis = synthesis
+
+        # opt-in: analytic derivatives where available, finite differences for the other parameters
+        # the analytic derivatives are the ones of the FFT synthesis
+        self.analytic_jacobian = analytic_jacobian and synthesis == PeakSynthesis.FFT
+
+        # number of threads evaluating the columns of the jacobian (1 = serial)
+        self.n_workers = max(1, int(n_workers))
+        self._worker_state = threading.local()
+        self._executor = None
+
+        # coarse-to-fine schedule (1 stage: always at full resolution)
+        self.multiresolution_stages = max(1, int(multiresolution_stages))
+        self.multiresolution_stall = multiresolution_stall
+
+    def init_fitter(self, fit_global_parameters):
+        print("Initializing Fitter...")
+
+        self.shutdown_workers()
+
+        self.fit_global_parameters = fit_global_parameters
+        self._parameters_layouts = {}
+        self._published = None
+        self._model_version = 0
+
+        self.totalWeight = 0.0
+
+        self._lambda = 0.0 # damping factor of the minimizer, if any
+        self._totIter = 0
+
+        # INITIALIZATION OF FUNCTION VALUES
+
+        self.fit_global_parameters.evaluate_functions()
+
+        self.parameters = self.fit_global_parameters.get_parameters()
+
+        self.diffraction_patterns_number = self.fit_global_parameters.fit_initialization.get_diffraction_patterns_number()
+
+        self.twotheta_experimental_list = numpy.array([None]*self.diffraction_patterns_number)
+        self.intensity_experimental_list = numpy.array([None]*self.diffraction_patterns_number)
+        self.error_experimental_list = numpy.array([None]*self.diffraction_patterns_number)
+
+        # weights of the residuals: 1/error (0 where error is 0), and 1/(error^2 + 1) with the shifted intensity of the Mighell statistic
+        self.inverse_error_experimental_list = numpy.array([None]*self.diffraction_patterns_number)
+        self.mighell_weight_list = numpy.array([None]*self.diffraction_patterns_number)
+        self.mighell_intensity_list = numpy.array([None]*self.diffraction_patterns_number)
+
+        # components and counters of this fit only
+        component_cache.clear()
+
+        # the patterns at full resolution: the coarse stages of the multiresolution schedule fit rebinned copies
+        self.full_resolution_patterns = []
+
+        for index in range(self.diffraction_patterns_number):
+            twotheta_experimental, intensity_experimental, error_experimental, s_experimental = self.fit_global_parameters.fit_initialization.diffraction_patterns[index].tuples()
+
+            self.full_resolution_patterns.append([numpy.array(twotheta_experimental), numpy.array(intensity_experimental), numpy.array(error_experimental)])
+            self.set_experimental_pattern(index, *self.full_resolution_patterns[index])
+
+        self.nr_points = self.getNrPoints()
+
+        self.nprm = len(self.parameters)
+        self.nfit = self.getNrParamToFit()
+
+        self.parameters_dependencies = self.build_parameters_dependencies(self.fit_global_parameters)
+        self.nobs = self.nr_points
+        self.dof = self.nobs - self.nfit
+
+        # normal matrix J^T*J of the weighted residuals: the errors of the parameters
+        self.a = CTriMatrix(_n=self.nfit)
+
+        self.mighell = False
+
+        # model evaluations, keyed by the parameter vector: emptied at every iteration, but the last one
+        self._model_cache = {}
+        self.model_cache_hits = 0
+        self.model_cache_misses = 0
+
+        self.multiresolution = MultiresolutionSchedule(self.multiresolution_stages, self.multiresolution_stall)
+        self.full_resolution_n_step = self.fit_global_parameters.fit_initialization.fft_parameters.n_step
+        self.set_resolution_stage(0)
+
+        self.update_fft_grid()
+
+        self.wss = self.getWSSQ()
+        self.oldwss  = self.wss
+
+        self.fit_data = MinpackData(wss=self.wss,
+                                    dof=self.dof,
+                                    nobs=self.nobs,
+                                    nprm=self.nprm,
+                                    nfit=self.nfit)
+
+        self.conver = False
+
+        self.init_minimizer()
+
+        print("Fitter Initialization done.")
+
+    def init_minimizer(self):
+        pass
+
+    def start_iteration(self, current_fit_global_parameters, current_iteration):
+        """
+        working parameters, multiresolution stage and FFT grid of an iteration. Returns True if the stage changed
+        """
+        print("Fitter - Begin iteration nr. " + str(current_iteration))
+
+        is_last_published = self.is_last_published(current_fit_global_parameters)
+
+        if is_last_published:
+            # the iterations continue on the working parameters, with their compiled layout and last model
+            key = self.get_model_key()
+            self._model_cache = {key: self._model_cache[key]} if key in self._model_cache else {}
+        else:
+            self.fit_global_parameters = current_fit_global_parameters.duplicate()
+            self.clear_model_cache()
+            self._parameters_layouts.clear()
+
+        self.iteration_start_time = time.time()
+
+        # a new stage or a new grid is a new model: the reference wss is recalculated on it (new working parameters are
+        # checked at once)
+        stage_changed = self.update_resolution_stage(current_iteration, current_fit_global_parameters.get_n_max_iterations())
+        grid_changed = self.update_fft_grid(current_iteration if is_last_published else None)
+
+        if stage_changed or grid_changed: self.oldwss = self.wss = self.getWSSQ()
+
+        self.wss_begin = self.oldwss
+
+        return stage_changed
+
+    def end_iteration(self):
+        # the convergence of a coarse stage moves the fit to the next one
+        self.conver = self.multiresolution.end_iteration(self.wss_begin, self.oldwss, self.conver, time.time() - self.iteration_start_time)
+        self.fit_data.multiresolution_text = self.multiresolution.to_text()
+
+    def get_fitted_patterns(self):
+        """
+        the fitted patterns of the iteration (always the full ones): the published parameters receive the convergence
+        """
+        fit_global_parameters_out = self.build_fit_global_parameters_out(self.parameters)
+        fit_global_parameters_out.set_convergence_reached(self.conver)
+
+        fitted_patterns = self.build_fitted_diffraction_pattern(fit_global_parameters=fit_global_parameters_out,
+                                                                y_list=self.get_model() if self.multiresolution.is_full_resolution() else None)
+
+        self.conver = False
+
+        return fitted_patterns
+
+    def publish_errors(self, calculate_errors=True):
+        """
+        errors of the variable parameters from the normal matrix self.a, and the snapshot of the parameters for the caller
+        """
+        errors = [0] * len(self.parameters)
+
+        if calculate_errors:
+            if self.a.chodec() == 0: # Cholesky decomposition
+                # diagonal of the inverse of A: one back substitution with all the unit vectors as right-hand sides
+                variances = numpy.diagonal(self.a.chosolve(numpy.identity(self.nfit)))
+
+                k = 0
+                for i in range (0, self.nprm):
+                    if self.parameters[i].is_variable():
+                        errors[i] = numpy.sqrt(numpy.abs(variances[k]))
+                        k += 1
+            else:
+                print("Errors not calculated: chodec != 0")
+
+        return self.publish(self.build_fit_global_parameters_out_errors(errors=errors))
+
+    def finalize_fit(self):
+        self.shutdown_workers()
+
+    def set_experimental_pattern(self, index, twotheta_experimental, intensity_experimental, error_experimental):
+        self.twotheta_experimental_list[index] = twotheta_experimental
+        self.intensity_experimental_list[index] = intensity_experimental
+        self.error_experimental_list[index] = error_experimental
+
+        self.inverse_error_experimental_list[index] = numpy.divide(1.0, error_experimental, out=numpy.zeros(len(error_experimental)), where=error_experimental != 0)
+        self.mighell_weight_list[index] = 1/(error_experimental**2 + 1.0)
+        self.mighell_intensity_list[index] = intensity_experimental + numpy.where(intensity_experimental < 1, intensity_experimental, 1.0)
+
+        init_experimental_factors(twotheta_experimental, self.fit_global_parameters, index)
+
+    def set_resolution_stage(self, stage):
+        """
+        patterns and FFT steps of a stage of the multiresolution schedule (the automatic grid keeps its own steps)
+        """
+        self.multiresolution.stage = stage
+        self.multiresolution.escalate = False
+
+        factor = self.multiresolution.get_factor()
+
+        for index in range(self.diffraction_patterns_number):
+            self.set_experimental_pattern(index, *rebin_pattern(*self.full_resolution_patterns[index], factor))
+
+        self.nr_points = self.getNrPoints()
+        self.nobs = self.nr_points
+        self.dof = self.nobs - self.nfit
+
+        if hasattr(self, "fit_data"):
+            self.fit_data.nobs = self.nobs
+            self.fit_data.dof = self.dof
+
+        self.apply_resolution_stage()
+        self.clear_model_cache()
+
+        if self.multiresolution.n_stages > 1:
+            print("Multiresolution stage " + str(stage + 1) + "/" + str(self.multiresolution.n_stages) + ": " + str(self.nobs) + " points")
+
+    def apply_resolution_stage(self, fit_global_parameters=None):
+        if fit_global_parameters is None: fit_global_parameters = self.fit_global_parameters
+
+        fft_parameters = fit_global_parameters.fit_initialization.fft_parameters
+
+        if self.multiresolution.n_stages > 1 and not fft_parameters.auto_grid:
+            n_step = max(self.full_resolution_n_step//self.multiresolution.get_factor(), min(AutomaticGrid.N_STEP_MIN, self.full_resolution_n_step))
+
+            if fft_parameters.n_step != n_step:
+                fft_parameters.n_step = n_step
+                self.clear_model_cache()
+
+    def update_resolution_stage(self, current_iteration, n_max_iterations):
+        """
+        stage of the multiresolution schedule for the current iteration. Returns True if the stage changed
+        """
+        stage = self.multiresolution.get_stage(current_iteration, n_max_iterations)
+
+        if stage == self.multiresolution.stage:
+            self.apply_resolution_stage() # new working parameters come at full resolution
+
+            return False
+        else:
+            self.set_resolution_stage(stage)
+
+            return True
+
+    def update_fft_grid(self, current_iteration=None):
+        """
+        automatic grid of the FFT parameters: chosen at the initialization (current_iteration None) and checked again
+        every auto_check_interval iterations, when it can only grow. Returns True if the grid changed
+        """
+        fft_parameters = self.fit_global_parameters.fit_initialization.fft_parameters
+
+        if not fft_parameters.auto_grid: return False
+        if not current_iteration is None and current_iteration % fft_parameters.auto_check_interval != 0: return False
+
+        s_max, n_step = get_auto_fft_grid(self.set_parameters(self.parameters), self.twotheta_experimental_list, self.synthesis,
+                                          grow_only=not current_iteration is None)
+
+        if s_max == fft_parameters.s_max and n_step == fft_parameters.n_step: return False
+
+        print("Automatic FFT grid: s_max " + str(fft_parameters.s_max) + " -> " + str(s_max) + ", n_step " + str(fft_parameters.n_step) + " -> " + str(n_step))
+
+        fft_parameters.s_max = s_max
+        fft_parameters.n_step = n_step
+
+        # the model evaluations are keyed by the parameters only
+        self.clear_model_cache()
+
+        return True
+
+
+    ###############################################
+    #
+    # PARAMETERS LAYOUT
+    #
+    ###############################################
+
+    def build_parameters_layout(self, fit_global_parameters):
+        """
+        compiled positions of the model parameters in the parameters vector (same order of get_parameters()):
+        list of [FitParameter of the model or None, set of indexes of the diffraction patterns it can affect]
+        """
+        diffraction_patterns_number = len(fit_global_parameters.fit_initialization.diffraction_patterns)
+        all_patterns = set(range(diffraction_patterns_number))
+
+        parameters_layout = []
+
+        def add_parameters(parameters, patterns, parameters_count=None): # empty positions up to parameters_count
+            if parameters_count is None: parameters_count = len(parameters)
+
+            parameters_layout.extend([[parameter, set(patterns)] for parameter in parameters])
+            parameters_layout.extend([[None, set(patterns)] for _ in range(parameters_count - len(parameters))])
+
+        def get_patterns(list, index): # lists of a single element are shared by all the patterns
+            return all_patterns if len(list) == 1 else {index}
+
+        for index in range(diffraction_patterns_number):
+            diffraction_pattern = fit_global_parameters.fit_initialization.diffraction_patterns[index]
+
+            add_parameters([diffraction_pattern.wavelength], {index})
+
+            if not diffraction_pattern.is_single_wavelength:
+                for secondary_wavelength, secondary_wavelength_weigth in zip(diffraction_pattern.secondary_wavelengths,
+                                                                             diffraction_pattern.secondary_wavelengths_weights):
+                    add_parameters([secondary_wavelength, secondary_wavelength_weigth], {index})
+
+        for index in range(len(fit_global_parameters.fit_initialization.crystal_structures)):
+            crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[index]
+
+            add_parameters([crystal_structure.a,
+                            crystal_structure.b,
+                            crystal_structure.c,
+                            crystal_structure.alpha,
+                            crystal_structure.beta,
+                            crystal_structure.gamma], {index})
+
+            if crystal_structure.use_structure: add_parameters([crystal_structure.intensity_scale_factor], {index})
+
+            add_parameters([crystal_structure.get_reflection(reflection_index).intensity for reflection_index in range(crystal_structure.get_reflections_count())], {index})
+
+        if not fit_global_parameters.fit_initialization.thermal_polarization_parameters is None:
+            thermal_polarization_parameters_list = fit_global_parameters.fit_initialization.thermal_polarization_parameters
+
+            for index, thermal_polarization_parameters in enumerate(thermal_polarization_parameters_list):
+                if not thermal_polarization_parameters.debye_waller_factor is None:
+                    add_parameters([thermal_polarization_parameters.debye_waller_factor],
+                                   get_patterns(thermal_polarization_parameters_list, index),
+                                   thermal_polarization_parameters.get_parameters_count())
+
+        if not fit_global_parameters.background_parameters is None:
+            for key in fit_global_parameters.background_parameters.keys():
+                background_parameters_list = fit_global_parameters.get_background_parameters(key)
+
+                if not background_parameters_list is None:
+                    for index, background_parameters in enumerate(background_parameters_list):
+                        if key == ChebyshevBackground.__name__:
+                            parameters = [background_parameters.c0,
+                                          background_parameters.c1,
+                                          background_parameters.c2,
+                                          background_parameters.c3,
+                                          background_parameters.c4,
+                                          background_parameters.c5,
+                                          background_parameters.c6,
+                                          background_parameters.c7,
+                                          background_parameters.c8,
+                                          background_parameters.c9]
+                        elif key == ExpDecayBackground.__name__:
+                            parameters = [background_parameters.a0,
+                                          background_parameters.b0,
+                                          background_parameters.a1,
+                                          background_parameters.b1,
+                                          background_parameters.a2,
+                                          background_parameters.b2]
+                        else:
+                            parameters = []
+
+                        add_parameters(parameters, get_patterns(background_parameters_list, index), background_parameters.get_parameters_count())
+
+        if not fit_global_parameters.instrumental_parameters is None:
+            for index, instrumental_parameters in enumerate(fit_global_parameters.instrumental_parameters):
+                add_parameters([instrumental_parameters.U,
+                                instrumental_parameters.V,
+                                instrumental_parameters.W,
+                                instrumental_parameters.a,
+                                instrumental_parameters.b,
+                                instrumental_parameters.c],
+                               get_patterns(fit_global_parameters.instrumental_parameters, index),
+                               instrumental_parameters.get_parameters_count())
+
+        if not fit_global_parameters.shift_parameters is None:
+            for key in fit_global_parameters.shift_parameters.keys():
+                shift_parameters_list = fit_global_parameters.get_shift_parameters(key)
+
+                if not shift_parameters_list is None:
+                    for index, shift_parameters in enumerate(shift_parameters_list):
+                        if key == Lab6TanCorrection.__name__:
+                            parameters = [shift_parameters.ax,
+                                          shift_parameters.bx,
+                                          shift_parameters.cx,
+                                          shift_parameters.dx,
+                                          shift_parameters.ex]
+                        elif key == ZeroError.__name__:
+                            parameters = [shift_parameters.shift]
+                        elif key == SpecimenDisplacement.__name__:
+                            parameters = [shift_parameters.displacement]
+                        else:
+                            parameters = []
+
+                        add_parameters(parameters, get_patterns(shift_parameters_list, index), shift_parameters.get_parameters_count())
+
+        if not fit_global_parameters.size_parameters is None:
+            for index, size_parameters in enumerate(fit_global_parameters.size_parameters):
+                if size_parameters.distribution == Distribution.LOGNORMAL:
+                    parameters = [size_parameters.mu, size_parameters.sigma]
+                else:
+                    parameters = [size_parameters.mu]
+
+                add_parameters(parameters, get_patterns(fit_global_parameters.size_parameters, index), size_parameters.get_parameters_count())
+
+        if not fit_global_parameters.strain_parameters is None:
+            for index, strain_parameters in enumerate(fit_global_parameters.strain_parameters):
+                if isinstance(strain_parameters, InvariantPAH):
+                    parameters = [strain_parameters.aa,
+                                  strain_parameters.bb,
+                                  strain_parameters.e1, # in realtà è E1 dell'invariante PAH
+                                  strain_parameters.e2, # in realtà è E1 dell'invariante PAH
+                                  strain_parameters.e3, # in realtà è E1 dell'invariante PAH
+                                  strain_parameters.e4, # in realtà è E4 dell'invariante PAH
+                                  strain_parameters.e5, # in realtà è E4 dell'invariante PAH
+                                  strain_parameters.e6] # in realtà è E4 dell'invariante PAH
+                elif isinstance(strain_parameters, KrivoglazWilkensModel):
+                    parameters = [strain_parameters.rho,
+                                  strain_parameters.Re,
+                                  strain_parameters.Ae,
+                                  strain_parameters.Be,
+                                  strain_parameters.As,
+                                  strain_parameters.Bs,
+                                  strain_parameters.mix,
+                                  strain_parameters.b]
+                elif isinstance(strain_parameters, WarrenModel):
+                    parameters = [strain_parameters.average_cell_parameter]
+                else:
+                    parameters = []
+
+                add_parameters(parameters, get_patterns(fit_global_parameters.strain_parameters, index), strain_parameters.get_parameters_count())
+
+        return parameters_layout
+
+    def get_parameters_layout(self, fit_global_parameters):
+        # the copy of a worker has its layout in the worker state, the fitter keeps the ones of its own instances
+        worker_state = self._worker_state
+        if getattr(worker_state, "fit_global_parameters", None) is fit_global_parameters: return worker_state.parameters_layout
+
+        try:
+            return self._parameters_layouts[id(fit_global_parameters)][1]
+        except KeyError:
+            parameters_layout = ParametersLayout(self.build_parameters_layout(fit_global_parameters), fit_global_parameters)
+
+            self._parameters_layouts[id(fit_global_parameters)] = [fit_global_parameters, parameters_layout]
+
+            return parameters_layout
+
+    def build_parameters_dependencies(self, fit_global_parameters):
+        """
+        for each parameter, the set of indexes of the diffraction patterns it can affect
+        """
+        parameters_dependencies = [patterns for _, patterns in self.build_parameters_layout(fit_global_parameters)]
+
+        parameters = fit_global_parameters.get_parameters()
+
+        # parameters not in the layout: no assumption
+        parameters_dependencies.extend([set(range(self.diffraction_patterns_number)) for _ in range(len(parameters) - len(parameters_dependencies))])
+
+        # a parameter used in the formula of another parameter affects the same patterns
+        for parameter, dependencies in zip(parameters, parameters_dependencies):
+            if parameter.function:
+                for other_parameter, other_dependencies in zip(parameters, parameters_dependencies):
+                    if not other_parameter.function and \
+                            re.search(r"\b" + re.escape(other_parameter.parameter_name) + r"\b", parameter.function_value):
+                        other_dependencies.update(dependencies)
+
+        return parameters_dependencies
+
+    def set_parameters(self, parameters, fit_global_parameters=None):
+        """
+        fast update of the model for a function evaluation: only the changed values of the parameters vector are
+        written into the model, and the formulas are evaluated only if one of their input changed
+        """
+        if fit_global_parameters is None: fit_global_parameters = self.fit_global_parameters
+
+        self.get_parameters_layout(fit_global_parameters).set_values(numpy.fromiter((parameter.value for parameter in parameters),
+                                                                                    dtype=float,
+                                                                                    count=len(parameters)))
+
+        return fit_global_parameters
+
+    def build_fit_global_parameters_out(self, fitted_parameters, fit_global_parameters=None):
+        if fit_global_parameters is None: fit_global_parameters = self.fit_global_parameters
+
+        self.get_parameters_layout(fit_global_parameters).set_values(numpy.fromiter((parameter.value for parameter in fitted_parameters),
+                                                                                    dtype=float,
+                                                                                    count=len(fitted_parameters)),
+                                                                     publish=True)
+
+        return fit_global_parameters
+
+    def build_fit_global_parameters_out_errors(self, errors):
+        fit_global_parameters = self.fit_global_parameters
+
+        self.get_parameters_layout(fit_global_parameters).set_errors(errors)
+
+        return fit_global_parameters
+
+    def publish(self, fit_global_parameters):
+        """
+        the working parameters stay with the fitter: the caller receives a snapshot of them
+        """
+        fit_global_parameters_out = fit_global_parameters.snapshot()
+
+        # the caller receives the full resolution
+        if self.multiresolution.n_stages > 1 and not fit_global_parameters_out.fit_initialization.fft_parameters.auto_grid:
+            fit_global_parameters_out.fit_initialization.fft_parameters.n_step = self.full_resolution_n_step
+
+        self._published = [fit_global_parameters_out,
+                           numpy.array([parameter.value for parameter in fit_global_parameters_out.get_parameters()], dtype=float)]
+
+        return fit_global_parameters_out
+
+    def is_last_published(self, fit_global_parameters):
+        # the snapshot of the last iteration, received back unchanged
+        return not self._published is None and \
+               fit_global_parameters is self._published[0] and \
+               numpy.array_equal(self._published[1], [parameter.value for parameter in fit_global_parameters.get_parameters()])
+
+    def build_fitted_diffraction_pattern(self, fit_global_parameters, y_list=None):
+
+        fitted_patterns = []
+
+        for index in range(len(fit_global_parameters.fit_initialization.diffraction_patterns)):
+            wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[index].wavelength
+
+            fitted_pattern = DiffractionPattern(wavelength=wavelength)
+
+            twotheta_experimental, intensity_experimental, _ = self.full_resolution_patterns[index]
+
+            if y_list is None:
+                fitted_intensity = fit_function_direct(twotheta_experimental,
+                                                       fit_global_parameters,
+                                                       diffraction_pattern_index=index,
+                                                       synthesis=self.synthesis)
+            else:
+                fitted_intensity = y_list[index]
+            fitted_residual = intensity_experimental - fitted_intensity
+
+            for i in range(0, len(fitted_intensity)):
+                fitted_pattern.add_diffraction_point(diffraction_point=DiffractionPoint(twotheta=twotheta_experimental[i],
+                                                                                        intensity=fitted_intensity[i],
+                                                                                        error=fitted_residual[i]))
+            fitted_patterns.append(fitted_pattern)
+
+        return fitted_patterns
+
+
+    def build_minpack_data(self, y_list=None):
+        self.wss = self.getWSSQ(y_list=y_list)
+
+        self.fit_data.wss = self.wss
+        self.fit_data.ss = self.getSSQFromData(y_list=y_list)
+        self.fit_data.wsq = self.getWSQFromData(y_list=y_list)
+        self.fit_data.calc_lambda = self._lambda
+        self.fit_data.cache_hits = self.model_cache_hits
+        self.fit_data.cache_misses = self.model_cache_misses
+        self.fit_data.component_cache_text = component_cache.to_text()
+        self.fit_data.calculate()
+
+
+    ###############################################
+    #
+    # METODI minObj
+    #
+    ###############################################
+
+    def get_model_key(self):
+        return numpy.array([parameter.value for parameter in self.parameters], dtype=float).tobytes()
+
+    def get_model(self):
+        key = self.get_model_key()
+
+        try:
+            y_list = self._model_cache[key]
+            self.model_cache_hits += 1
+        except KeyError:
+            self.model_cache_misses += 1
+
+            fit_global_parameters = self.set_parameters(self.parameters)
+
+            y_list = [fit_function_direct(self.twotheta_experimental_list[index],
+                                          fit_global_parameters,
+                                          index,
+                                          self.synthesis) for index in range(self.diffraction_patterns_number)]
+
+            self._model_cache[key] = y_list
+
+        return y_list
+
+    def getNrPoints(self, diffraction_patterns_index=None):
+        if diffraction_patterns_index is None:
+            nr_points = 0
+            for list in self.twotheta_experimental_list: nr_points += len(list)
+    
+            return nr_points
+        else:
+            return len(self.twotheta_experimental_list[diffraction_patterns_index])
+
+    def getNrParamToFit(self):
+        nfit = 0
+        for parameter in self.parameters:
+            if parameter.is_variable():
+                nfit += 1
+        return nfit
+
+    def getWeightedDelta(self):
+        y_list = self.get_model()
+
+        return [self._get_weighted_derivative(index, y_list[index] - self.intensity_experimental_list[index])
+                for index in range(self.diffraction_patterns_number)]
+
+    def getDerivative(self):
+        deriv = []
+        y_list = self.get_model()
+        columns = []
+
+        if self.analytic_jacobian: fit_global_parameters = self.set_parameters(self.parameters)
+
+        for index in range(self.diffraction_patterns_number):
+            deriv.append(CMatrix(self.getNrParamToFit(), self.getNrPoints(index)))
+
+            if self.analytic_jacobian:
+                analytic_derivatives = fit_function_direct_derivatives(self.twotheta_experimental_list[index],
+                                                                       fit_global_parameters,
+                                                                       diffraction_pattern_index=index)
+                # same order of self.parameters
+                fit_global_parameters_parameters = fit_global_parameters.get_parameters()
+            else:
+                analytic_derivatives = {}
+
+            jj = 0
+            for k in range (0, self.nprm):
+                if self.parameters[k].is_variable():
+                    key = None if len(analytic_derivatives) == 0 else id(fit_global_parameters_parameters[k])
+
+                    if not index in self.parameters_dependencies[k]:
+                        pass # the parameter does not affect this pattern: the derivative is 0
+                    elif key in analytic_derivatives:
+                        deriv[index][jj] = self._get_weighted_derivative(index, analytic_derivatives[key])
+                    else:
+                        columns.append((index, jj, k))
+                    jj += 1
+
+        # every column is computed from the same starting point, so the result
+        # does not depend on the order the workers pick the columns up
+        if self.n_workers > 1 and len(columns) > 1:
+            results = list(self.get_executor().map(self._get_derivative_column_in_worker, columns))
+        else:
+            results = [self._get_derivative_column(column) for column in columns]
+
+            # the formulas of the working parameters are left evaluated at the last perturbed point
+            if len(columns) > 0: self.set_parameters(self.parameters)
+
+        for (index, jj, k), (d, y_k) in zip(columns, results):
+            deriv[index][jj] = self._get_weighted_derivative(index, (y_k - y_list[index]) / d)
+
+        return deriv
+
+    def _get_weighted_derivative(self, index, derivative):
+        # points with error 0 are excluded from the fit
+        inverse_error_experimental = self.inverse_error_experimental_list[index]
+
+        return numpy.where(inverse_error_experimental == 0, 0.0, derivative*inverse_error_experimental)
+
+    ###############################################
+    #
+    # WORKERS OF THE JACOBIAN
+    #
+    ###############################################
+
+    def get_executor(self):
+        # one pool for the whole fit: the workers keep their copies between the evaluations of the jacobian
+        if self._executor is None: self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+
+        return self._executor
+
+    def shutdown_workers(self):
+        # the threads end with their copies of the parameters
+        if not getattr(self, "_executor", None) is None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def clear_model_cache(self):
+        # new working parameters, stage or grid: the copies of the workers are made again at their next column
+        self._model_cache.clear()
+        self._model_version += 1
+
+    def _init_derivative_worker(self):
+        # every worker perturbs its own copy of the parameters and of the fit global parameters, with its own layout
+        worker_state = self._worker_state
+
+        worker_state.model_version = self._model_version
+        worker_state.parameters = [copy.copy(parameter) for parameter in self.parameters]
+        worker_state.fit_global_parameters = self.fit_global_parameters.duplicate()
+        worker_state.parameters_layout = ParametersLayout(self.build_parameters_layout(worker_state.fit_global_parameters),
+                                                          worker_state.fit_global_parameters)
+
+    def _get_derivative_column_in_worker(self, column):
+        worker_state = self._worker_state
+
+        if getattr(worker_state, "model_version", None) != self._model_version:
+            self._init_derivative_worker()
+        else:
+            # same model: only the values of the current point, written through the layout by set_parameters
+            for worker_parameter, parameter in zip(worker_state.parameters, self.parameters):
+                worker_parameter.value = parameter.value
+
+        return self._get_derivative_column(column,
+                                           parameters=worker_state.parameters,
+                                           fit_global_parameters=worker_state.fit_global_parameters)
+
+    def _get_derivative_column(self, column, parameters=None, fit_global_parameters=None):
+        if parameters is None: parameters = self.parameters
+
+        index, jj, k = column
+        parameter = parameters[k]
+
+        pk = parameter.value
+        if parameter.step == PARAM_ERR: step = 0.001
+        else: step = parameter.step
+
+        if abs(pk) > PRCSN:
+            d = pk*step
+            parameter.value = pk * (1.0 + step)
+        else:
+            d = step
+            parameter.value = pk + d
+        parameter.check_value()
+
+        y_k = fit_function_direct(self.twotheta_experimental_list[index],
+                                  self.set_parameters(parameters, fit_global_parameters),
+                                  diffraction_pattern_index=index,
+                                  synthesis=self.synthesis)
+
+        parameter.value = pk
+        parameter.check_value()
+
+        return d, y_k
+
+    def getWSSQ(self, y_list=None):
+        if y_list is None: y_list = self.get_model()
+
+        wssqlow = 0.0
+        wssq = 0.0
+
+        for index in range(self.diffraction_patterns_number):
+            wssqtmp = self._get_weighted_squared_residuals(index, y_list[index])
+
+            # small and large terms are accumulated separately
+            low = wssqtmp < 1E-2
+
+            wssqlow += numpy.sum(wssqtmp[low])
+            wssq    += numpy.sum(wssqtmp[~low])
+
+        return wssq + wssqlow
+
+
+    def getWSQFromData(self, y_list=None):
+        if y_list is None: y_list = self.get_model()
+
+        wssq = 0.0
+
+        for index in range(self.diffraction_patterns_number):
+            wssq += numpy.sum(self._get_weighted_squared_residuals(index, y_list[index]))
+
+        return wssq
+
+    def getSSQFromData(self, y_list=None):
+        if y_list is None: y_list = self.get_model()
+
+        ss = 0.0
+
+        for index in range(self.diffraction_patterns_number):
+            if self.mighell:
+                yv = y_list[index] - self.mighell_intensity_list[index]
+            else:
+                yv = y_list[index] - self.intensity_experimental_list[index]
+
+            ss += numpy.dot(yv, yv)
+
+        return ss
+
+    def _get_weighted_squared_residuals(self, index, y):
+        if self.mighell:
+            return ((y - self.mighell_intensity_list[index])**2)*self.mighell_weight_list[index]
+        else:
+            return self._get_weighted_derivative(index, y - self.intensity_experimental_list[index])**2
+
+
+
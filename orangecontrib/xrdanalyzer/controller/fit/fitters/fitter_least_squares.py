@@ -0,0 +1,188 @@
+import numpy
+
+from scipy.optimize import least_squares
+from scipy.optimize._numdiff import approx_derivative
+from scipy.sparse import lil_matrix
+
+from orangecontrib.xrdanalyzer.controller.fit.fit_parameter import PARAM_HWMIN, PARAM_HWMAX, PARAM_ERR
+from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import PeakSynthesis
+from orangecontrib.xrdanalyzer.controller.fit.fitters.fitter_base import FitterBase, PRCSN
+
+class LeastSquaresMethod:
+    TRF = "trf"
+    LM = "lm"
+    DOGBOX = "dogbox"
+
+    @classmethod
+    def tuple(cls):
+        return [cls.TRF, cls.LM, cls.DOGBOX]
+
+class LeastSquaresJacobian:
+    FITTER = "fitter" # the derivatives of the fitter: finite differences (analytic ones where available, with analytic_jacobian)
+    TWO_POINT = "2-point" # finite differences of scipy with the steps of the fitter, and the sparsity of the parameters dependencies
+    THREE_POINT = "3-point"
+
+    @classmethod
+    def tuple(cls):
+        return [cls.FITTER, cls.TWO_POINT, cls.THREE_POINT]
+
+class FitterLeastSquares(FitterBase):
+    """
+    scipy.optimize.least_squares on the same weighted residuals of FitterMinpack: the boundaries of the parameters
+    are native bounds of the minimizer (no reflection of the values), every iteration is a call of least_squares
+    limited to max_nfev evaluations of the model (None: until convergence)
+    """
+
+    # a tolerance on the step (ftol/xtol) reached within the first evaluations is a failed step, not a convergence
+    MIN_CONVERGENCE_NFEV = 3
+
+    def __init__(self,
+                 n_workers=1,
+                 analytic_jacobian=False,
+                 method=LeastSquaresMethod.TRF,
+                 jacobian=LeastSquaresJacobian.FITTER,
+                 x_scale=1.0,
+                 max_nfev=50,
+                 synthesis=PeakSynthesis.FFT,
+                 multiresolution_stages=1,
+                 multiresolution_stall=0.01):
+        super().__init__(n_workers=n_workers,
+                         analytic_jacobian=analytic_jacobian,
+                         synthesis=synthesis,
+                         multiresolution_stages=multiresolution_stages,
+                         multiresolution_stall=multiresolution_stall)
+
+        if not method in LeastSquaresMethod.tuple(): raise ValueError("Least squares method <" + method + "> not recognized")
+        if not jacobian in LeastSquaresJacobian.tuple(): raise ValueError("Least squares jacobian <" + jacobian + "> not recognized")
+
+        self.method = method
+        self.jacobian = jacobian
+        self.x_scale = x_scale
+        self.max_nfev = max_nfev
+
+    def init_minimizer(self):
+        # no damping factor (_lambda 0): the trust region is handled by the minimizer
+        self.variables_indexes = [k for k in range(self.nprm) if self.parameters[k].is_variable()]
+
+        variables = [self.parameters[k] for k in self.variables_indexes]
+
+        self.lower_bounds = numpy.array([-numpy.inf if parameter.boundary is None or parameter.boundary.min_value == PARAM_HWMIN
+                                         else parameter.boundary.min_value for parameter in variables], dtype=float)
+        self.upper_bounds = numpy.array([numpy.inf if parameter.boundary is None or parameter.boundary.max_value == PARAM_HWMAX
+                                         else parameter.boundary.max_value for parameter in variables], dtype=float)
+
+        if self.method == LeastSquaresMethod.LM and (numpy.any(numpy.isfinite(self.lower_bounds)) or numpy.any(numpy.isfinite(self.upper_bounds))):
+            raise ValueError("Least squares method <lm> does not support boundaries: remove them from the parameters or choose <trf>/<dogbox>")
+
+        # the steps of the finite differences of the fitter (FitParameter.step)
+        self.steps = numpy.array([0.001 if parameter.step == PARAM_ERR else parameter.step for parameter in variables], dtype=float)
+
+        self.jac_sparsity = self.build_jac_sparsity() if (self.jacobian != LeastSquaresJacobian.FITTER and
+                                                          self.method != LeastSquaresMethod.LM) else None
+
+    def build_jac_sparsity(self):
+        # a parameter changes only the points of the diffraction patterns it can affect
+        jac_sparsity = lil_matrix((self.nobs, self.nfit), dtype=int)
+
+        offsets = numpy.cumsum([0] + [self.getNrPoints(index) for index in range(self.diffraction_patterns_number)])
+
+        for j, k in enumerate(self.variables_indexes):
+            for index in self.parameters_dependencies[k]:
+                jac_sparsity[offsets[index]:offsets[index + 1], j] = 1
+
+        return jac_sparsity
+
+    def set_resolution_stage(self, stage):
+        super().set_resolution_stage(stage)
+
+        # same parameters, different points
+        if not getattr(self, "jac_sparsity", None) is None: self.jac_sparsity = self.build_jac_sparsity()
+
+    def do_fit(self, current_fit_global_parameters, current_iteration):
+        self.start_iteration(current_fit_global_parameters, current_iteration)
+
+        if current_iteration <= current_fit_global_parameters.get_n_max_iterations() and not self.conver and self.nfit > 0:
+            self._totIter += 1
+
+            print("Begin Minimization using scipy.optimize.least_squares, method: ", self.method)
+
+            x0 = numpy.clip(self.get_variables(), self.lower_bounds, self.upper_bounds)
+
+            result = least_squares(self.get_residuals,
+                                   x0,
+                                   jac=self.get_jacobian if self.jacobian == LeastSquaresJacobian.FITTER else self.get_finite_differences_jacobian,
+                                   bounds=self.get_bounds(),
+                                   method=self.method,
+                                   x_scale=self.x_scale,
+                                   max_nfev=self.max_nfev)
+
+            print(result.message)
+
+            self.set_variables(result.x)
+            self.parameters = self.set_parameters(self.parameters).get_parameters()
+
+            # status 0: the evaluations of this iteration are over, 1: gtol reached, 2-4: ftol/xtol reached
+            self.conver = result.status == 1 or (result.status > 1 and result.nfev >= self.MIN_CONVERGENCE_NFEV)
+
+            self.wss = self.getWSSQ()
+            self.oldwss = self.wss
+
+            jac = result.jac.toarray() if hasattr(result.jac, "toarray") else result.jac
+        else:
+            jac = None
+
+        self.end_iteration()
+
+        if not jac is None:
+            self.build_minpack_data(y_list=self.get_model())
+
+            print(self.fit_data.to_text())
+
+        fitted_patterns = self.get_fitted_patterns()
+
+        # same estimate of FitterMinpack: diagonal of the inverse of J^T*J
+        if not jac is None:
+            self.a.zero()
+            self.a.add_packed(numpy.dot(jac.T, jac))
+
+        return fitted_patterns, self.publish_errors(calculate_errors=not jac is None), self.fit_data
+
+    def get_variables(self):
+        return numpy.array([self.parameters[k].value for k in self.variables_indexes], dtype=float)
+
+    def set_variables(self, x):
+        # no check_value: the minimizer keeps the values inside the bounds
+        for j, k in enumerate(self.variables_indexes):
+            self.parameters[k].value = float(x[j])
+
+    def get_residuals(self, x):
+        self.set_variables(x)
+
+        return numpy.concatenate(self.getWeightedDelta())
+
+    def get_bounds(self):
+        if self.method == LeastSquaresMethod.LM: return (-numpy.inf, numpy.inf)
+        else: return (self.lower_bounds, self.upper_bounds)
+
+    def get_finite_differences_jacobian(self, x):
+        """
+        finite differences of scipy (2-point or 3-point, one-sided at the bounds) with the steps of the fitter: relative
+        to the values larger than PRCSN, absolute for the others. The relative steps of scipy vanish on the parameters
+        close to 0 (e.g. the coefficients of the background)
+        """
+        abs_step = numpy.where(numpy.abs(x) > PRCSN, x*self.steps, self.steps)
+
+        jacobian = approx_derivative(self.get_residuals,
+                                     x,
+                                     method=self.jacobian,
+                                     abs_step=abs_step,
+                                     bounds=self.get_bounds(),
+                                     sparsity=self.jac_sparsity)
+
+        # dense, as the one of the fitter: the exact trust-region solver of least_squares
+        return jacobian.toarray() if hasattr(jacobian, "toarray") else jacobian
+
+    def get_jacobian(self, x):
+        self.set_variables(x)
+
+        return numpy.concatenate([derivative.data for derivative in self.getDerivative()], axis=1).T
@@ -1,9 +1,13 @@
-import numpy
+import numpy, re
+from scipy.linalg import cho_factor, cho_solve, LinAlgError
 
 ########################################
 #
 # DATA STRUCTURES
 #
+# contiguous numpy arrays, with the 1-based
+# accessors of the original C++ containers
+#
 ########################################
 
 class CVector:
@@ -28,24 +32,16 @@ class CVector:
 
     #inline double &operator [] (int i) const { assert(i<n); return data[i]; }
     def __getitem__(self, index):
-        assert index < self.n
-
         return self.data[index]
 
     def __setitem__(self, index, value):
-        assert index < self.n
-
         self.data[index] = value
 
     #inline double &operator () (int i) const { assert(i<=n); return data[i-1]; }
     def getitem(self, i):
-        assert i <= self.n
-
         return self.data[i-1]
 
     def setitem(self, i, value):
-        assert i <= self.n
-
         self.data[i-1]=value
 
     #CVector &operator - ()
@@ -55,13 +51,13 @@ class CVector:
 	#	return *this;
 	#}
     def __neg__(self):
-        for i in range(0, self.n):
-            self.data[i] = -self.data[i]
+        if not self.data is None: numpy.negative(self.data, out=self.data)
 
         return self;
 
     def zero(self):
-        self.__init__(self.n)
+        if self.data is None: self.__init__(self.n)
+        else: self.data.fill(0.0)
 
     def __str__(self):
         str = ""
@@ -77,7 +73,7 @@ class CMatrix:
         self.m = _m
 
         if self.n > 0 and self.m > 0:
-            self.data = numpy.zeros(self.n*self.m).reshape((self.n, self.m))
+            self.data = numpy.zeros((self.n, self.m))
         else:
             self.data = None
 
@@ -86,42 +82,35 @@ class CMatrix:
             return
 
         if self.n*self.m != _n*_m:
-            self.data = numpy.zeros(_n*_m).reshape((_n, _m))
+            self.data = numpy.zeros((_n, _m))
+        else:
+            self.data = self.data.reshape((_n, _m))
 
         self.n = _n
         self.m = _m
 
     #inline double *operator [] (int i)		  const { assert(i<n);  return idx[i]; }
     def __getitem__(self, index):
-        assert index < self.n
-
         return self.data[index, :]
 
     def __setitem__(self, index, value):
-        assert index < self.n
-
         self.data[index, :] = value
 
 
     #inline double &operator () (int i, int j) const	{ assert(j<=m); return idx[--i][--j]; }
 	#inline double *operator () (int i)		  const	{ assert(i<=n); return idx[--i]; }
     def getitem(self, i, j=None):
-        assert i <= self.n
-
         if j is None:
             return self.data[i-1, :]
         else:
-            assert j <= self.m
-
             return self.data[i-1, j-1]
 
     def setitem(self, i, j, value):
-        assert j <= self.m
-
         self.data[i-1, j-1] = value
 
     def zero(self):
-        self.__init__(self.n, self.m)
+        if self.data is None: self.__init__(self.n, self.m)
+        else: self.data.fill(0.0)
 
     def getSize(self):
         return self.n*self.m
@@ -135,8 +124,6 @@ class CMatrix:
                 str += "\n"
         return str
 
-import copy
-
 class CTriMatrix:
 
     def __init__(self, _n=0, other=None):
@@ -144,7 +131,7 @@ class CTriMatrix:
             self._create_attributes(_n)
         else:
             self.n = other.getSize()
-            self.data = copy.deepcopy(other.data)
+            self.data = None if other.data is None else numpy.copy(other.data)
 
     def _create_attributes(self, _n):
         self.n = _n
@@ -169,18 +156,16 @@ class CTriMatrix:
 	#}
     def assign(self, other):
         assert other.n == self.n
-        self.__init__(other=other)
+
+        if self.data is None or other.data is None: self.__init__(other=other)
+        else: numpy.copyto(self.data, other.data)
 
 
     #inline double &operator [] (int i) const { assert(i<n); return data[i]; }
     def __getitem__(self, index):
-        assert index < self.n
-
         return self.data[index]
 
     def __setitem__(self, index, value):
-        assert index < self.n
-
         self.data[index] = value
 
     #inline double &operator () (int i, int j) const
@@ -194,12 +179,8 @@ class CTriMatrix:
 	#inline double &operator () (int i) const { assert(i<=n*(n+1)/2); return data[i-1]; }
     def getitem(self, i, j=None):
         if j is None:
-            assert i <= self.n*(self.n + 1)/2
             return self.data[int(i-1)]
         else:
-            assert i <= self.n
-            assert j <= self.n
-
             i -=1
             j -=1
 
@@ -209,64 +190,56 @@ class CTriMatrix:
             return self.data[l+j]
 
     def setitem(self, i, value):
-        assert i <= self.n*(self.n + 1)/2
-
         self.data[int(i-1)]=value
 
-    def chodec(self):
-        for j in range(1, self.n+1):
-            l = int(j*(j+1)/2)
-
-            if j>1:
-                for i in range(j, self.n+1):
-                    k1 = int(i * (i - 1)/2 + j)
-                    f  = self.getitem(k1)
-                    k2 = j - 1
-                    for k in range(1, k2+1):
-                        f -= self.getitem(k1-k)*self.getitem(l-k)
-                    self.setitem(k1, f)
-
-            if self.getitem(l) > 0:
-                f = numpy.sqrt(self.getitem(l))
-
-                for i in range(j, self.n+1):
-                    k2 = int(i*(i-1)/2+j)
-                    self.setitem(k2, self.getitem(k2)/f)
-            else:
-                return -1; # negative diagonal
+    # packed position k = i*(i-1)/2 + j (1-based, j <= i) is the row-major order of numpy.tril_indices
+    def get_packed_indices(self):
+        if not hasattr(self, "_packed_indices") or len(self._packed_indices[0]) != len(self.data):
+            self._packed_indices = numpy.tril_indices(self.n)
 
-        return 0
+        return self._packed_indices
 
-    def choback(self, g=CVector()):
-        g.setitem(1, value=g.getitem(1)/self.getitem(1))
+    # packed positions of the diagonal elements: k = i*(i+1)/2 (1-based)
+    def get_diagonal_indices(self):
+        if not hasattr(self, "_diagonal_indices") or len(self._diagonal_indices) != self.n:
+            i = numpy.arange(1, self.n + 1)
+            self._diagonal_indices = (i*(i+1))//2 - 1
+
+        return self._diagonal_indices
 
-        if self.n > 1:
-            l=1
-            for i in range(2, self.n+1):
-                k=i-1
-                for j in range(1, k+1):
-                    l += 1
-                    g.setitem(i, g.getitem(i) - self.getitem(l)*g.getitem(j))
-                l += 1
-                g.setitem(i, g.getitem(i) / self.getitem(l))
+    def add_packed(self, matrix):
+        self.data += matrix[self.get_packed_indices()]
 
-        mdi = self.n*(self.n+1)/2
+    def to_dense(self, symmetric=True):
+        matrix = numpy.zeros((self.n, self.n))
+        indices = self.get_packed_indices()
 
-        g.setitem(self.n, g.getitem(self.n) / self.getitem(mdi))
+        matrix[indices] = self.data
+        if symmetric: matrix[indices[1], indices[0]] = self.data
 
-        if self.n > 1:
-            for k1 in range(2, self.n + 1):
+        return matrix
 
-                i = self.n+2-k1
-                k = i-1
-                l = int(i*k/2)
+    def chodec(self):
+        # Cholesky decomposition (LAPACK): the lower factor replaces the matrix in the packed storage
+        try:
+            factor, _ = cho_factor(self.to_dense(symmetric=False), lower=True, check_finite=False)
+        except LinAlgError:
+            return -1 # negative diagonal
 
-                for j in range (1, k+1):
-                    g.setitem(j, g.getitem(j) - g.getitem(i)*self.getitem(l+j))
-                g.setitem(k, g.getitem(k) / self.getitem(l))
+        self.data[:] = factor[self.get_packed_indices()]
+
+        return 0
+
+    def chosolve(self, b):
+        # back substitution with the packed lower factor, b can hold several right-hand sides (one per column)
+        return cho_solve((self.to_dense(symmetric=False), True), b, check_finite=False)
+
+    def choback(self, g=CVector()):
+        g.data[:] = self.chosolve(g.data)
 
     def zero(self):
-        self.__init__(self.n)
+        if self.data is None: self.__init__(self.n)
+        else: self.data.fill(0.0)
 
     def __str__(self):
         str = ""
@@ -286,15 +259,140 @@ class CTriMatrix:
 
     def equals(self, other):
         if not self.data is None:
-            for i in range(1, self.n+1):
-                for j in range(1, self.n+1):
-                    if self.getitem(i,j) != other.getitem(i,j): return False
+            if other.data is None or self.n != other.n: return False
+
+            return numpy.array_equal(self.data, other.data)
         else:
             return False
 
-        return True
 
 
+########################################
+#
+# PARAMETERS LAYOUT
+#
+########################################
+
+class ParametersLayout:
+    """
+    compiled layout of the parameters vector: the FitParameter objects of one instance of the
+    fit global parameters, by position in the vector (None for empty positions)
+    """
+
+    def __init__(self, parameters_layout, fit_global_parameters):
+        self.parameters = [parameter for parameter, _ in parameters_layout]
+        self.fit_global_parameters = fit_global_parameters
+        self.values = None # last vector written into the model
+
+        self.has_functions = fit_global_parameters.has_functions()
+
+        # positions that require the evaluation of the formulas when changed: the formulas and their inputs
+        functions = [parameter.function_value for parameter in self.parameters if not parameter is None and parameter.function]
+
+        self.functions_positions = numpy.array([position for position, parameter in enumerate(self.parameters)
+                                                if not parameter is None and
+                                                (parameter.function or
+                                                 any(re.search(r"\b" + re.escape(parameter.parameter_name) + r"\b", function) for function in functions))],
+                                               dtype=int)
+
+    def set_values(self, values, publish=False):
+        n = min(len(values), len(self.parameters))
+
+        if publish or self.values is None or len(self.values) != len(values):
+            changed = numpy.arange(n)
+        else:
+            changed = numpy.flatnonzero(values[:n] != self.values[:n])
+
+        for position in changed:
+            parameter = self.parameters[position]
+
+            if not parameter is None: parameter.set_value(float(values[position]))
+
+        first_write = self.values is None
+        self.values = numpy.array(values, dtype=float)
+
+        if self.has_functions and (publish or first_write or numpy.intersect1d(changed, self.functions_positions).size > 0):
+            self.fit_global_parameters.evaluate_functions()
+
+    def set_errors(self, errors):
+        for parameter, error in zip(self.parameters, errors):
+            if not parameter is None: parameter.error = error
+
+
+
+
+########################################
+#
+# MULTIRESOLUTION
+#
+########################################
+
+class MultiresolutionSchedule:
+    """
+    coarse-to-fine schedule of the fit: stage 0 fits the patterns rebinned by 2^(n_stages - 1) points, with n_step
+    reduced by the same factor, every following stage halves the factor and the last one is the full resolution.
+    The fit moves to the next stage when an iteration improves the wss by less than stall (relative), when the
+    minimizer converges, or when the remaining iterations are just enough to reach the last stage
+    """
+
+    def __init__(self, n_stages=1, stall=0.01):
+        self.n_stages = max(1, int(n_stages))
+        self.stall = stall
+
+        self.stage = 0
+        self.escalate = False
+        self.times = [0.0]*self.n_stages # seconds spent in each stage
+        self.iterations = [0]*self.n_stages
+
+    def get_factor(self, stage=None):
+        if stage is None: stage = self.stage
+
+        return 2**(self.n_stages - 1 - stage)
+
+    def is_full_resolution(self):
+        return self.stage == self.n_stages - 1
+
+    def get_stage(self, current_iteration, n_max_iterations):
+        # stage of the current iteration: the next one after a stall, the last ones when the iterations run out
+        stage = self.stage + 1 if self.escalate else self.stage
+
+        return min(max(stage, self.n_stages - (n_max_iterations - current_iteration + 1)), self.n_stages - 1)
+
+    def end_iteration(self, wss_begin, wss_end, converged, elapsed_time):
+        """
+        records the iteration: returns False if the convergence is only the one of a coarse stage
+        """
+        self.times[self.stage] += elapsed_time
+        self.iterations[self.stage] += 1
+
+        if self.is_full_resolution(): return converged
+
+        self.escalate = converged or not (wss_begin > 0 and (wss_begin - wss_end)/wss_begin >= self.stall)
+
+        return False
+
+    def to_text(self):
+        if self.n_stages == 1: return ""
+
+        text = "  multiresolution stage " + str(self.stage + 1) + "/" + str(self.n_stages) + " (points and FFT steps / " + str(self.get_factor()) + ")\n"
+
+        for stage in range(self.n_stages):
+            text += "    stage " + str(stage + 1) + ": " + str(self.iterations[stage]) + " iterations, " + str(round(self.times[stage], 3)) + " s\n"
+
+        return text
+
+def rebin_pattern(twotheta, intensity, error, factor):
+    """
+    averages of groups of factor consecutive points (the last group can be shorter), with the errors of the averages
+    """
+    if factor <= 1: return twotheta, intensity, error
+
+    bins = numpy.arange(0, len(twotheta), factor)
+    counts = numpy.diff(numpy.append(bins, len(twotheta)))
+
+    return numpy.add.reduceat(twotheta, bins)/counts, \
+           numpy.add.reduceat(intensity, bins)/counts, \
+           numpy.sqrt(numpy.add.reduceat(error**2, bins))/counts
 
 
 if __name__=="__main__":
@@ -308,4 +406,4 @@ if __name__=="__main__":
     print(vector[3])
     print(vector.getitem(4))
     print(vector)
-    print(-vector)
\ No newline at end of file
+    print(-vector)
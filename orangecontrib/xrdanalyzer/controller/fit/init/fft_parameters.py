@@ -9,29 +9,73 @@ class FFTTypes:
     def tuple(cls):
         return ["Real Only", "Full"]
 
+class FFTImplementation:
+    NUMPY = 0 # complex transforms of numpy
+    SCIPY = 1 # scipy.fft: real-input transforms, one transform for the full type, multithreaded
+
+    @classmethod
+    def tuple(cls):
+        return ["numpy (complex)", "scipy.fft (real input)"]
+
+class PeakSynthesis:
+    FFT = 0 # FFT on the grid of s_max/n_step, interpolated on the points of the pattern
+    DIRECT_SUM = 1 # Fourier series evaluated at the points of the pattern: cached phase matrices, a few times slower than the FFT
+
+    @classmethod
+    def tuple(cls):
+        return ["FFT + Interpolation", "Direct Fourier Sum (slower)"]
+
+class AutomaticGrid:
+    N_STEP_MIN = 1024
+    N_STEP_MAX = 65536
+
 class FFTInitParameters(FitParametersList):
 
     s_max = 9.0
     n_step = 4096
     fft_type = FFTTypes.REAL_ONLY
+    peak_threshold = 1e-4
+    fft_implementation = FFTImplementation.SCIPY
+    fft_workers = 1
+    auto_grid = False
+    auto_tolerance = 1e-4
+    auto_check_interval = 5
 
-    def __init__(self, s_max = 9.0, n_step = 4096, fft_type=FFTTypes.REAL_ONLY):
+    def __init__(self, s_max = 9.0, n_step = 4096, fft_type=FFTTypes.REAL_ONLY, peak_threshold=1e-4, fft_implementation=FFTImplementation.SCIPY, fft_workers=1,
+                 auto_grid=False, auto_tolerance=1e-4, auto_check_interval=5):
         congruence.checkStrictlyPositiveNumber(s_max, "S_max")
         congruence.checkStrictlyPositiveNumber(n_step, "N_step")
+        congruence.checkPositiveNumber(peak_threshold, "Peak threshold")
+        congruence.checkLessThan(peak_threshold, 1.0, "Peak threshold", "1")
+        congruence.checkStrictlyPositiveNumber(auto_tolerance, "Grid tolerance")
+        congruence.checkLessThan(auto_tolerance, 1.0, "Grid tolerance", "1")
+        congruence.checkStrictlyPositiveNumber(auto_check_interval, "Grid check interval")
 
         n_step = int(n_step)
 
         if not ((n_step & (n_step - 1)) == 0): raise ValueError("N_step should be a power of 2")
         if not (fft_type == FFTTypes.REAL_ONLY or fft_type == FFTTypes.FULL): raise ValueError("FFT type not recognized")
+        if not (fft_implementation == FFTImplementation.NUMPY or fft_implementation == FFTImplementation.SCIPY): raise ValueError("FFT implementation not recognized")
+        if int(fft_workers) == 0: raise ValueError("FFT threads should be positive (or negative, counting back from the number of CPUs)")
 
         self.s_max = s_max
         self.n_step = n_step
         self.fft_type = fft_type
+        self.peak_threshold = peak_threshold # relative to the peak maximum: the peaks are added to the pattern where they are above it
+        self.fft_implementation = fft_implementation
+        self.fft_workers = int(fft_workers) # threads of scipy.fft (-1: all the CPUs)
+
+        # automatic grid: s_max and n_step are chosen by the fitter from the current profiles, with relative accuracy
+        # auto_tolerance, and checked again every auto_check_interval iterations (s_max and n_step are the first probe)
+        self.auto_grid = auto_grid
+        self.auto_tolerance = auto_tolerance
+        self.auto_check_interval = int(auto_check_interval)
 
         # THESE PARAMETERS ARE FIXED BY DEFAULT, THEY ARE NOT PASSED TO THE LIST
 
     def duplicate(self):
-        return FFTInitParameters(s_max=self.s_max, n_step=self.n_step, fft_type=self.fft_type)
+        return FFTInitParameters(s_max=self.s_max, n_step=self.n_step, fft_type=self.fft_type, peak_threshold=self.peak_threshold, fft_implementation=self.fft_implementation, fft_workers=self.fft_workers,
+                                 auto_grid=self.auto_grid, auto_tolerance=self.auto_tolerance, auto_check_interval=self.auto_check_interval)
 
     def to_text(self):
         text = "FFT PARAMETERS\n"
@@ -39,6 +83,10 @@ class FFTInitParameters(FitParametersList):
         text += "fft steps: " + str(self.n_step) + "\n"
         text += "s max    : "  + str(self.s_max) + "\n"
         text += "FFT Type : "  + FFTTypes.tuple()[self.fft_type] + "\n"
+        text += "peak thr.: "  + str(self.peak_threshold) + "\n"
+        text += "FFT impl.: "  + FFTImplementation.tuple()[self.fft_implementation] + ", threads: " + str(self.fft_workers) + "\n"
+        if self.auto_grid:
+            text += "auto grid: tolerance " + str(self.auto_tolerance) + ", checked every " + str(self.auto_check_interval) + " iterations\n"
         text += "-----------------------------------\n"
 
         return text
@@ -1,6 +1,5 @@
 import numpy
 import scipy.interpolate
-import matplotlib.pyplot as plt
 
 #========================================================#
 
@@ -512,11 +511,15 @@ def C_highZen_edge_FCC(c11,c12,c44,h,k,l):
 #---PLOTTING FUNCTIONS------------------------------------------------------------#
 
 def s_vs_C(h,k,l,C_avg):
+    import matplotlib.pyplot as plt # plots only: the module is used without matplotlib
+
     plt.scatter(s(h,k,l),C_avg)
     plt.show()
     return
 
 def H_vs_C(h,k,l,C_avg):
+    import matplotlib.pyplot as plt
+
     plt.scatter(H(h, k, l), C_avg)
     plt.show()
     return
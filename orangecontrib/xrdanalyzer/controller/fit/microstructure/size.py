@@ -33,8 +33,6 @@ class Normalization:
     def tuple(cls):
         return ["to N", "to N\u00b2"]
 
-from orangecontrib.xrdanalyzer.controller.fit.wppm_functions import lognormal_distribution
-
 class SizeParameters(FitParametersList):
 
     shape = Shape.SPHERE
@@ -97,6 +95,8 @@ class SizeParameters(FitParametersList):
 
         try:
             if self.distribution == Distribution.LOGNORMAL:
+                from orangecontrib.xrdanalyzer.controller.fit.wppm_functions import lognormal_distribution # wppm_functions imports this module
+
                 y = lognormal_distribution(self.mu.value, self.sigma.value, x)
             else:
                 y = numpy.zeros(len(x))
@@ -0,0 +1,124 @@
+import threading, weakref, itertools
+from collections import OrderedDict
+
+import numpy
+
+class ComponentCache:
+    """
+    LRU cache of the components of the model (Fourier amplitudes, peak profiles), keyed by the exact values of
+    all the quantities each component depends on: a component is recalculated only when one of them changes.
+
+    The memory is bounded by max_bytes (size of the numpy arrays in the cached values); the cached arrays are
+    read-only, so they can be shared by all the callers (the workers of the fitters too).
+    """
+
+    def __init__(self, max_bytes=256*1024**2, enabled=True):
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.counters = {} # component name -> [hits, misses]
+
+        self._grids = {} # id of the array -> [weak reference, number]
+        self._grids_numbers = itertools.count()
+
+    def get(self, name, key, function):
+        """
+        cached value of the component <name> for <key>, function() calculates it when missing
+        """
+        if not self.enabled: return function()
+
+        key = (name, key)
+
+        with self._lock:
+            counters = self.counters.setdefault(name, [0, 0])
+
+            try:
+                value = self._entries[key]
+                self._entries.move_to_end(key)
+                counters[0] += 1
+
+                return value
+            except KeyError:
+                counters[1] += 1
+
+        value = function()
+        value_bytes = self._freeze(value)
+
+        if value_bytes <= self.max_bytes:
+            with self._lock:
+                if not key in self._entries:
+                    self._entries[key] = value
+                    self._bytes += value_bytes
+
+                    while self._bytes > self.max_bytes:
+                        _, evicted_value = self._entries.popitem(last=False)
+                        self._bytes -= self._get_bytes(evicted_value)
+
+        return value
+
+    def get_grid_key(self, x):
+        """
+        key of a grid of points by identity, valid while the array lives: the grids of a fit (the experimental points)
+        are the same arrays, never modified, at every evaluation, so their values are not hashed. None for other
+        sequences
+        """
+        if not isinstance(x, numpy.ndarray): return None
+
+        with self._lock:
+            grid = self._grids.get(id(x))
+
+            if grid is None or not grid[0]() is x:
+                grid = [weakref.ref(x, self._remove_grid), next(self._grids_numbers)]
+                self._grids[id(x)] = grid
+
+            return ("grid", grid[1])
+
+    def _remove_grid(self, reference):
+        # called by the garbage collector: no lock, the entries of the component are evicted as usual
+        for id_x, grid in list(self._grids.items()):
+            if grid[0] is reference: self._grids.pop(id_x, None)
+
+    def clear(self, reset_counters=True):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if reset_counters: self.counters = {}
+
+    def get_hits(self):
+        return sum([counters[0] for counters in self.counters.values()])
+
+    def get_misses(self):
+        return sum([counters[1] for counters in self.counters.values()])
+
+    def hit_rate(self):
+        total = self.get_hits() + self.get_misses()
+
+        return 0.0 if total == 0 else self.get_hits()/total
+
+    def to_text(self):
+        text = "  component cache: " + str(len(self._entries)) + " entries, " + str(round(self._bytes/1024**2, 1)) + " MB, hit rate " + str(round(100*self.hit_rate(), 1)) + "%\n"
+
+        for name, counters in self.counters.items():
+            text += "    " + name + " hits/misses: " + str(counters[0]) + "/" + str(counters[1]) + "\n"
+
+        return text
+
+    @classmethod
+    def _get_bytes(cls, value):
+        if isinstance(value, numpy.ndarray): return value.nbytes
+        elif isinstance(value, (list, tuple)): return sum([cls._get_bytes(item) for item in value])
+        else: return 0
+
+    @classmethod
+    def _freeze(cls, value):
+        if isinstance(value, numpy.ndarray):
+            value.flags.writeable = False
+            return value.nbytes
+        elif isinstance(value, (list, tuple)):
+            return sum([cls._freeze(item) for item in value])
+        else:
+            return 0
@@ -41,13 +41,40 @@ class Utilities:
     @classmethod
     def merge_functions(cls, list_of_pairs, s):
         # x step must be the same for all functions
+        # s must be increasing: a function with a support window [x, y, (first, last)] is interpolated and added only
+        # on the points of s between x[first] and x[last]
         I = numpy.zeros(len(s))
 
         for pairs in list_of_pairs:
-            I += numpy.interp(s, pairs[0], pairs[1])
+            if len(pairs) == 2:
+                I += numpy.interp(s, pairs[0], pairs[1])
+            else:
+                x, y, (first, last) = pairs
+
+                # outside x numpy.interp extends the values at the edges: an edge of x leaves the window open on that side
+                start = 0 if first == 0 else numpy.searchsorted(s, x[first], side="left")
+                end = len(s) if last == len(x) - 1 else numpy.searchsorted(s, x[last], side="right")
+
+                if end > start: I[start:end] += numpy.interp(s[start:end], x[first:last + 1], y[first:last + 1])
 
         return I
 
+    @classmethod
+    def support_windows(cls, I, threshold):
+        # rows of I centered on the peak (the Bragg position of the FFT): first and last index above
+        # threshold*|I(center)|, extended by one sample on each side for the interpolation.
+        # The outermost samples are taken, so the dips of oscillating profiles do not cut the window.
+        # Threshold 0: the whole rows
+        n = I.shape[-1]
+        center = n//2
+
+        above = numpy.abs(I) >= threshold*numpy.abs(I[..., center:center + 1])
+
+        first = numpy.maximum(numpy.argmax(above, axis=-1) - 1, 0)
+        last = numpy.minimum(n - numpy.argmax(above[..., ::-1], axis=-1), n - 1)
+
+        return first, last
+
 
 
 
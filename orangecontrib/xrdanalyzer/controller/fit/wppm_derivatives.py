@@ -0,0 +1,527 @@
+import numpy, re
+from scipy.special import erfc
+
+from orangecontrib.xrdanalyzer.controller.fit.init.crystal_structure import CrystalStructure
+from orangecontrib.xrdanalyzer.controller.fit.init.thermal_polarization_parameters import LorentzFormula
+from orangecontrib.xrdanalyzer.controller.fit.instrument.instrumental_parameters import ZeroError
+from orangecontrib.xrdanalyzer.controller.fit.instrument.background_parameters import ChebyshevBackground, ExpDecayBackground
+from orangecontrib.xrdanalyzer.controller.fit.microstructure.size import Distribution
+from orangecontrib.xrdanalyzer.controller.fit.microstructure.strain import InvariantPAH
+from orangecontrib.xrdanalyzer.controller.fit.util.fit_utilities import Utilities
+from orangecontrib.xrdanalyzer.controller.fit.wppm_functions import FourierTranformFactory, component_cache, \
+    create_peaks, get_fourier_components, get_fourier_transforms, multiply_fourier_components, \
+    get_shift_parameters_list, get_lorentz_formula, \
+    caglioti_fwhm, strain_invariant_function_pah, strain_krivoglaz_wilkens, C_hkl_krivoglaz_wilkens, f_star, \
+    get_structure_intensity_factors, lorentz_factor_simplified_normalized, lorentz_factor_normalized, debye_waller, \
+    get_chebyshev_basis, get_expdecay_basis, get_s_experimental, get_polarization_factor_experimental, \
+    clausen_integral, F_STAR_EXPANSION_LIMIT
+
+#########################################################################
+#
+# ANALYTIC JACOBIAN OF THE WPPM MODEL
+#
+# derivatives of fit_function_direct with respect to the parameters that
+# have a closed form, the fitters fall back to finite differences for all
+# the other parameters.
+#
+# The derivatives are returned in a dictionary keyed by id() of the
+# FitParameter objects of the fit global parameters: a parameter is in the
+# dictionary only if ALL its contributions to the pattern are analytic.
+#
+#########################################################################
+
+def fit_function_direct_derivatives(twotheta, fit_global_parameters, diffraction_pattern_index = 0):
+    derivatives = {}
+
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+
+    I, reciprocal_derivatives = fit_function_reciprocal_derivatives(get_s_experimental(twotheta, wavelength),
+                                                                    fit_global_parameters,
+                                                                    diffraction_pattern_index)
+
+    derivatives.update(reciprocal_derivatives)
+
+    # POLARIZATION FACTOR --------------------------------------------------------------------------------------
+
+    if not fit_global_parameters.fit_initialization.thermal_polarization_parameters is None:
+        thermal_polarization_parameters = fit_global_parameters.fit_initialization.thermal_polarization_parameters[0 if len(fit_global_parameters.fit_initialization.thermal_polarization_parameters) == 1 else diffraction_pattern_index]
+
+        if thermal_polarization_parameters.use_polarization_factor:
+            polarization = get_polarization_factor_experimental(twotheta, thermal_polarization_parameters)
+
+            for key in derivatives.keys(): derivatives[key] *= polarization
+
+    # BACKGROUNDS: linear in the coefficients ----------------------------------------------------------------------
+
+    if not fit_global_parameters.background_parameters is None:
+        for key in fit_global_parameters.background_parameters.keys():
+            background_parameters_list = fit_global_parameters.get_background_parameters(key)
+
+            if not background_parameters_list is None:
+                background_parameters = background_parameters_list[0 if len(background_parameters_list) == 1 else diffraction_pattern_index]
+
+                if key == ChebyshevBackground.__name__:
+                    parameters=[background_parameters.c0,
+                                background_parameters.c1,
+                                background_parameters.c2,
+                                background_parameters.c3,
+                                background_parameters.c4,
+                                background_parameters.c5,
+                                background_parameters.c6,
+                                background_parameters.c7,
+                                background_parameters.c8,
+                                background_parameters.c9]
+
+                    for parameter, derivative in zip(parameters, chebyshev_background_derivatives(twotheta, len(parameters))):
+                        derivatives[id(parameter)] = derivative
+
+                elif key == ExpDecayBackground.__name__:
+                    parameters=[background_parameters.a0,
+                                background_parameters.b0,
+                                background_parameters.a1,
+                                background_parameters.b1,
+                                background_parameters.a2,
+                                background_parameters.b2]
+
+                    for parameter, derivative in zip(parameters, expdecay_background_derivatives(twotheta, [parameter.value for parameter in parameters])):
+                        derivatives[id(parameter)] = derivative
+
+    # parameters appearing in the formulas of other parameters: finite differences only
+    for parameter in _get_parameters_in_functions(fit_global_parameters):
+        derivatives.pop(id(parameter), None)
+
+    return derivatives
+
+def fit_function_reciprocal_derivatives(s, fit_global_parameters, diffraction_pattern_index = 0):
+    crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+
+    if not CrystalStructure.is_cube(crystal_structure.symmetry): raise NotImplementedError("Only Cubic structures are supported by fit")
+
+    # SUM OF THE DERIVATIVES OF THE PEAKS, INTERPOLATED ONTO ORIGINAL S VALUES INSIDE THEIR SUPPORT WINDOWS ------------
+
+    I, derivatives = peaks_derivatives(s, fit_global_parameters, diffraction_pattern_index)
+
+    # SAXS depends on size and lattice parameter: those keep finite differences
+
+    if not fit_global_parameters.size_parameters is None:
+        size_parameters = fit_global_parameters.size_parameters[0 if len(fit_global_parameters.size_parameters) == 1 else diffraction_pattern_index]
+
+        if size_parameters.distribution == Distribution.DELTA and size_parameters.add_saxs:
+            derivatives.pop(id(size_parameters.mu), None)
+
+    # DEBYE-WALLER FACTOR ------------------------------------------------------------------------------------------
+
+    if not fit_global_parameters.fit_initialization.thermal_polarization_parameters is None:
+        thermal_polarization_parameters = fit_global_parameters.fit_initialization.thermal_polarization_parameters[0 if len(fit_global_parameters.fit_initialization.thermal_polarization_parameters) == 1 else diffraction_pattern_index]
+
+        if not thermal_polarization_parameters.debye_waller_factor is None:
+            dw = debye_waller(s, thermal_polarization_parameters.debye_waller_factor.value)
+
+            I *= dw
+            for key in derivatives.keys(): derivatives[key] *= dw
+
+            _add_derivative(derivatives, id(thermal_polarization_parameters.debye_waller_factor), -0.5*(s**2)*I)
+
+    # MULTIPLE WAVELENGTHS: linear operator on the intensity, the weights keep finite differences -----------------
+
+    diffraction_pattern = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index]
+
+    if not diffraction_pattern.is_single_wavelength:
+        principal_wavelength = diffraction_pattern.wavelength
+
+        def scale(I):
+            I_scaled = I*diffraction_pattern.get_principal_wavelenght_weight()
+
+            for secondary_wavelength, secondary_wavelength_weigth in zip(diffraction_pattern.secondary_wavelengths,
+                                                                         diffraction_pattern.secondary_wavelengths_weights):
+                s_secondary = s * secondary_wavelength.value/principal_wavelength.value
+                I_scaled += Utilities.merge_functions([[s_secondary, I*secondary_wavelength_weigth.value]], s)
+
+            return I_scaled
+
+        for key in derivatives.keys(): derivatives[key] = scale(derivatives[key])
+
+        I = scale(I)
+
+    return I, derivatives
+
+#################################################
+# DERIVATIVES OF THE PEAKS
+#################################################
+
+def peaks_derivatives(s, fit_global_parameters, diffraction_pattern_index=0):
+    '''
+    sum of the peaks of create_peaks at the points s and its derivatives, with the same rows: the cached Fourier
+    amplitudes of get_fourier_components and their FFT (implementation and workers of the FFT parameters), the
+    derivatives of the rows interpolated by Utilities.merge_functions inside the support windows of the peaks.
+      - shape (instrumental, size, strain): derivatives of the amplitudes, transformed all at once along the rows
+      - intensities: the rows with unit intensity
+      - zero error: rigid shift of the rows, minus the slope of the interpolated peaks
+    '''
+    fft_parameters = fit_global_parameters.fit_initialization.fft_parameters
+    crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+    reflections = [crystal_structure.get_reflection(reflection_index) for reflection_index in range(crystal_structure.get_reflections_count())]
+
+    derivatives = {}
+
+    if len(reflections) == 0: return numpy.zeros(len(s)), derivatives
+
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+    lattice_parameter = crystal_structure.a.value
+
+    s_peaks, I_peaks, (first, last) = create_peaks(fit_global_parameters, diffraction_pattern_index)
+
+    def merge(rows):
+        return Utilities.merge_functions(list(zip(s_peaks, rows, zip(first, last))), s)
+
+    I = merge(I_peaks)
+
+    # FACTORS OF THE ROWS: same as create_peaks, with unit intensities -------------------------------------------------
+
+    s_hkl = Utilities.s_hkl(lattice_parameter,
+                            numpy.array([reflection.h for reflection in reflections]),
+                            numpy.array([reflection.k for reflection in reflections]),
+                            numpy.array([reflection.l for reflection in reflections]))[:, numpy.newaxis]
+
+    if crystal_structure.use_structure:
+        intensity_parameters = [crystal_structure.intensity_scale_factor]*len(reflections)
+        unit_factors = get_structure_intensity_factors(crystal_structure, reflections, s_hkl[:, 0])[:, numpy.newaxis]
+    else:
+        intensity_parameters = [reflection.intensity for reflection in reflections]
+        unit_factors = numpy.ones((len(reflections), 1))
+
+    lorentz_formula = get_lorentz_formula(fit_global_parameters, diffraction_pattern_index)
+
+    if lorentz_formula == LorentzFormula.Shkl_Shkl:
+        unit_factors = unit_factors*lorentz_factor_simplified_normalized(s_hkl, wavelength)
+    elif lorentz_formula == LorentzFormula.S_Shkl:
+        unit_factors = unit_factors*lorentz_factor_normalized(s_peaks, s_hkl, wavelength)
+
+    factors = unit_factors*numpy.array([parameter.value for parameter in intensity_parameters])[:, numpy.newaxis]
+
+    # SHAPE: FOURIER AMPLITUDES ----------------------------------------------------------------------------------------
+
+    components, amplitudes_key = get_fourier_components(fit_global_parameters, diffraction_pattern_index, reflections)
+
+    _, I_fft = get_fourier_transforms(fit_global_parameters, components, amplitudes_key, len(reflections))
+
+    components_derivatives = get_fourier_components_derivatives(fit_global_parameters, diffraction_pattern_index, reflections, components)
+
+    if len(components_derivatives) > 0:
+        shape = (len(reflections), fft_parameters.n_step)
+
+        amplitudes = multiply_fourier_components(components, shape, fft_parameters.fft_type)
+        amplitudes_derivatives = []
+
+        for component_index, _, derivative in components_derivatives:
+            others = multiply_fourier_components(components[:component_index] + components[component_index + 1:], shape, fft_parameters.fft_type)
+
+            amplitudes_derivatives.append(derivative*others)
+
+        rows_derivatives = FourierTranformFactory.get_fourier_transform(fft_parameters.fft_type,
+                                                                        fft_parameters.fft_implementation).fft_derivatives(amplitudes,
+                                                                                                                           numpy.array(amplitudes_derivatives),
+                                                                                                                           n_steps=fft_parameters.n_step,
+                                                                                                                           dL=fit_global_parameters.space_parameters().dL,
+                                                                                                                           workers=fft_parameters.fft_workers)
+
+        for (_, parameter, _), rows_derivative in zip(components_derivatives, rows_derivatives):
+            _add_derivative(derivatives, id(parameter), merge(rows_derivative*factors))
+
+    # INTENSITIES: linear -----------------------------------------------------------------------------------------------
+
+    unit_rows = I_fft*unit_factors
+
+    if crystal_structure.use_structure:
+        _add_derivative(derivatives, id(crystal_structure.intensity_scale_factor), merge(unit_rows))
+    else:
+        for reflection_index, parameter in enumerate(intensity_parameters):
+            _add_derivative(derivatives, id(parameter), Utilities.merge_functions([[s_peaks[reflection_index],
+                                                                                    unit_rows[reflection_index],
+                                                                                    (first[reflection_index], last[reflection_index])]], s))
+
+    # ZERO ERROR: rigid shift of all the peaks --------------------------------------------------------------------------
+
+    for key, shift_parameters in get_shift_parameters_list(fit_global_parameters, diffraction_pattern_index):
+        if key == ZeroError.__name__:
+            # minus the slope of the interpolated peaks, plus the change of the Lorentz factor on the shifted abscissa
+            shift_derivative = -_merge_slopes(s_peaks, I_peaks, (first, last), s)
+
+            if lorentz_formula == LorentzFormula.S_Shkl:
+                shift_derivative += merge(I_peaks*(-1/s_peaks + (s_peaks*(wavelength**2)/4)/(1 - (s_peaks*wavelength/2)**2)))
+
+            _add_derivative(derivatives, id(shift_parameters.shift), shift_derivative*numpy.cos(shift_parameters.shift.value/2)/wavelength)
+
+    return I, derivatives
+
+def get_fourier_components_derivatives(fit_global_parameters, diffraction_pattern_index, reflections, components):
+    '''
+    derivatives of the Fourier amplitudes of the components of get_fourier_components with respect to the parameters
+    with a closed form, from the component cache (same keys of the components).
+    returns [index of the component, parameter, derivative of the amplitudes]
+    '''
+    fit_space_parameters = fit_global_parameters.space_parameters()
+    crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+    lattice_parameter = crystal_structure.a.value
+
+    # columns: one value for each reflection, broadcast along L
+    h = numpy.array([reflection.h for reflection in reflections])[:, numpy.newaxis]
+    k = numpy.array([reflection.k for reflection in reflections])[:, numpy.newaxis]
+    l = numpy.array([reflection.l for reflection in reflections])[:, numpy.newaxis]
+
+    L = fit_space_parameters.L
+
+    components_derivatives = []
+
+    for component_index, (name, key, _) in enumerate(components):
+        if name == "instrumental":
+            instrumental_parameters = fit_global_parameters.instrumental_parameters[0 if len(fit_global_parameters.instrumental_parameters) == 1 else diffraction_pattern_index]
+
+            parameters = [instrumental_parameters.U,
+                          instrumental_parameters.V,
+                          instrumental_parameters.W,
+                          instrumental_parameters.a,
+                          instrumental_parameters.b,
+                          instrumental_parameters.c]
+
+            derivatives = component_cache.get("instrumental derivatives", key,
+                                              lambda: instrumental_function_derivatives(L, h, k, l, lattice_parameter, wavelength,
+                                                                                        *[parameter.value for parameter in parameters]))
+        elif name == "size":
+            size_parameters = fit_global_parameters.size_parameters[0 if len(fit_global_parameters.size_parameters) == 1 else diffraction_pattern_index]
+
+            if size_parameters.distribution == Distribution.LOGNORMAL:
+                parameters = [size_parameters.sigma, size_parameters.mu]
+
+                derivatives = component_cache.get("size derivatives", key,
+                                                  lambda: size_function_lognormal_derivatives(L, size_parameters.sigma.value, size_parameters.mu.value))
+            else:
+                parameters = [size_parameters.mu]
+
+                derivatives = component_cache.get("size derivatives", key,
+                                                  lambda: size_function_delta_derivatives(L, size_parameters.mu.value))
+        elif name == "strain":
+            strain_parameters = fit_global_parameters.strain_parameters[0 if len(fit_global_parameters.strain_parameters) == 1 else diffraction_pattern_index]
+
+            if isinstance(strain_parameters, InvariantPAH):
+                parameters = [strain_parameters.aa, strain_parameters.bb]
+
+                C_hkl = numpy.array([strain_parameters.get_invariant(reflection.h,
+                                                                     reflection.k,
+                                                                     reflection.l) for reflection in reflections])[:, numpy.newaxis]
+
+                derivatives = component_cache.get("strain derivatives", key,
+                                                  lambda: strain_invariant_function_pah_derivatives(L, h, k, l, lattice_parameter,
+                                                                                                    strain_parameters.aa.value,
+                                                                                                    strain_parameters.bb.value,
+                                                                                                    C_hkl))
+            else:
+                parameters = [strain_parameters.rho, strain_parameters.Re]
+
+                derivatives = component_cache.get("strain derivatives", key,
+                                                  lambda: strain_krivoglaz_wilkens_derivatives(L, h, k, l, lattice_parameter,
+                                                                                               strain_parameters.rho.value,
+                                                                                               strain_parameters.Re.value,
+                                                                                               strain_parameters.Ae.value,
+                                                                                               strain_parameters.Be.value,
+                                                                                               strain_parameters.As.value,
+                                                                                               strain_parameters.Bs.value,
+                                                                                               strain_parameters.mix.value,
+                                                                                               strain_parameters.b.value))
+        else: # warren: tabulated, finite differences
+            continue
+
+        for parameter, derivative in zip(parameters, derivatives):
+            components_derivatives.append([component_index, parameter, derivative])
+
+    return components_derivatives
+
+######################################################################
+# DERIVATIVES OF THE FOURIER AMPLITUDES
+#
+# input: the values of the quantities, h, k, l columns (one row for each
+# reflection) or scalars, output: [d(amplitudes)/d(parameter), ...] in
+# the order of the parameters of get_fourier_components_derivatives
+######################################################################
+
+def instrumental_function_derivatives(L, h, k, l, lattice_parameter, wavelength, U, V, W, a, b, c):
+    theta = Utilities.theta_hkl(lattice_parameter, h, k, l, wavelength)
+    theta_deg = numpy.degrees(theta)
+
+    eta = a + b*theta_deg + c*theta_deg**2
+    deta = numpy.where((eta < 0) | (eta > 1), 0.0, 1.0) # caglioti_eta is clipped into [0, 1]
+    eta = numpy.clip(eta, 0, 1)
+
+    q = numpy.sqrt(numpy.pi*numpy.log(2))
+    k = eta*q/(eta*q + (1-eta))
+    dk = deta*q/((eta*q + (1-eta))**2)
+
+    fwhm = caglioti_fwhm(U, V, W, theta)
+    sigma = numpy.radians(fwhm)*0.5*(numpy.cos(theta)/wavelength)
+    exp1 = numpy.pi * sigma * L
+
+    lorentzian = numpy.exp(-2.0*exp1)
+    gaussian = numpy.exp(-(exp1**2)/numpy.log(2))
+
+    dA_deta = dk*(lorentzian - gaussian)
+    dA_dfwhm = (-2.0*k*lorentzian - (1-k)*(2*exp1/numpy.log(2))*gaussian)*(numpy.pi*L)*numpy.radians(1.0)*0.5*(numpy.cos(theta)/wavelength)
+
+    tan_theta = numpy.tan(theta)
+
+    return [dA_dfwhm*(tan_theta**2)/(2*fwhm),
+            dA_dfwhm*tan_theta/(2*fwhm),
+            dA_dfwhm/(2*fwhm),
+            dA_deta,
+            dA_deta*theta_deg,
+            dA_deta*theta_deg**2]
+
+def size_function_lognormal_derivatives(L, sigma, mu):
+    modL = numpy.abs(L)
+    lnModL = numpy.log(modL)
+    sqrt2 = numpy.sqrt(2)
+
+    def z(n): # argument of the erfc functions and its derivatives with respect to mu and sigma
+        return (lnModL - mu - n*sigma**2)/(sigma*sqrt2), \
+               -1/(sigma*sqrt2), \
+               -(lnModL - mu)/((sigma**2)*sqrt2) - n/sqrt2
+
+    def derfc(z): # d erfc(z)/dz
+        return -2*numpy.exp(-z**2)/numpy.sqrt(numpy.pi)
+
+    za, dza_dmu, dza_dsigma = z(3)
+    zb, dzb_dmu, dzb_dsigma = z(2)
+    zc, dzc_dmu, dzc_dsigma = z(0)
+
+    eb = numpy.exp(-mu - 2.5*sigma**2)
+    ec = numpy.exp(-3*mu - 4.5*sigma**2)
+
+    da_dmu    = 0.5*derfc(za)*dza_dmu
+    da_dsigma = 0.5*derfc(za)*dza_dsigma
+    db_dmu    = -0.75*modL*eb*(derfc(zb)*dzb_dmu - erfc(zb))
+    db_dsigma = -0.75*modL*eb*(derfc(zb)*dzb_dsigma - 5*sigma*erfc(zb))
+    dc_dmu    = 0.25*(L**3)*ec*(derfc(zc)*dzc_dmu - 3*erfc(zc))
+    dc_dsigma = 0.25*(L**3)*ec*(derfc(zc)*dzc_dsigma - 9*sigma*erfc(zc))
+
+    return [da_dsigma + db_dsigma + dc_dsigma, da_dmu + db_dmu + dc_dmu]
+
+def size_function_delta_derivatives(L, D):
+    return [1.5*L/(D**2) - 1.5*(L**3)/(D**4)]
+
+def strain_invariant_function_pah_derivatives(L, h, k, l, lattice_parameter, a, b, C_hkl):
+    s_hkl = Utilities.s_hkl(lattice_parameter, h, k, l)
+
+    factor = -((2*numpy.pi**2)/((s_hkl**2)*(lattice_parameter**4))) * C_hkl * strain_invariant_function_pah(L, h, k, l, lattice_parameter, a, b, C_hkl)
+
+    return [factor*L, factor*(L**2)]
+
+def strain_krivoglaz_wilkens_derivatives(L, h, k, l, lattice_parameter, rho, Re, Ae, Be, As, Bs, mix, b):
+    s_hkl = Utilities.s_hkl(lattice_parameter, h, k, l)
+    C_hkl = C_hkl_krivoglaz_wilkens(h, k, l, Ae, Be, As, Bs, mix)
+
+    # f_star(L/Re) and its derivative: the same for all the reflections
+    eta = L/Re
+    f_star_values = f_star(eta)
+
+    amplitudes = strain_krivoglaz_wilkens(L, h, k, l, lattice_parameter, rho, Re, Ae, Be, As, Bs, mix, b, f_star_values)
+    factor = -(0.5*numpy.pi*(s_hkl**2)*(b**2)*C_hkl*(L**2)) * amplitudes
+
+    return [factor*f_star_values, factor*rho*f_star_derivative(eta)*(-L/(Re**2))]
+
+def f_star_derivative(eta, use_simplified_calculation=False):
+    # derivative of f_star, same expressions
+    result = numpy.zeros(len(eta))
+    eta = numpy.array(eta)
+
+    cursor_1 = numpy.where(eta >= 1)
+    cursor_2 = numpy.where(eta < 1) if use_simplified_calculation else numpy.where(eta < F_STAR_EXPANSION_LIMIT)
+
+    eta1 = eta[cursor_1]
+    eta2 = eta[cursor_2]
+
+    result[cursor_1] = -256/(45*numpy.pi*(eta1**2)) + (-0.25 + 2*((11/24) + (numpy.log(2) + numpy.log(eta1))/4))/(eta1**3)
+    result[cursor_2] = -1/eta2 + eta2/3 - (32*(eta2**2))/(75*numpy.pi)
+
+    if not use_simplified_calculation:
+        cursor_3 = numpy.where(numpy.logical_and(eta >= F_STAR_EXPANSION_LIMIT, eta < 1))
+        eta3 = eta[cursor_3]
+
+        log_2eta = numpy.log(2) + numpy.log(eta3)
+        root = numpy.sqrt(1 - eta3**2)
+        arcsin = numpy.arcsin(eta3)
+
+        # -root*P/(180*pi*eta)
+        P = 769 + 82*(eta3**2) + 4*(eta3**4)
+        dP = 164*eta3 + 16*(eta3**3)
+        d_first = -(-P/root + root*dP/eta3 - root*P/(eta3**2))/(180*numpy.pi)
+
+        # -N/(180*pi*eta^2), with N = (45 - 180*eta^2)*Cl2(2*arcsin(eta)) + 15*arcsin(eta)*Q
+        clausen = clausen_integral(2*arcsin)
+        Q = 11 + 42*(eta3**2) + 4*(eta3**4) + (6 - 24*(eta3**2))*log_2eta
+        dQ = 84*eta3 + 16*(eta3**3) - 48*eta3*log_2eta + (6 - 24*(eta3**2))/eta3
+        N = (45 - 180*(eta3**2))*clausen + 15*arcsin*Q
+        dN = -360*eta3*clausen - (45 - 180*(eta3**2))*2*log_2eta/root + 15*Q/root + 15*arcsin*dQ
+        d_second = -(dN/(eta3**2) - 2*N/(eta3**3))/(180*numpy.pi)
+
+        result[cursor_3] = -256/(45*numpy.pi*(eta3**2)) + eta3/3 - 1/eta3 + d_first + d_second
+
+    return result
+
+######################################################################
+# DERIVATIVES OF THE BACKGROUNDS
+######################################################################
+
+def chebyshev_background_derivatives(x, degree=10):
+    # linear in the coefficients: the (cached, read-only) basis of the background
+    return get_chebyshev_basis(x, degree)
+
+def expdecay_background_derivatives(x, parameters=[0, 0, 0, 0, 0, 0]):
+    degree = len(parameters)
+    n_terms = int(degree/2 - 1) # same terms of add_expdecay_background
+    derivatives = numpy.zeros((degree, len(x)))
+
+    if n_terms > 0:
+        exponentials = get_expdecay_basis(x, parameters[1:2*n_terms:2])
+
+        derivatives[0:2*n_terms:2, :] = exponentials
+        derivatives[1:2*n_terms:2, :] = -numpy.outer(parameters[0:2*n_terms:2], numpy.abs(x))*exponentials
+
+    return derivatives
+
+######################################################################
+# UTILITIES
+######################################################################
+
+def _get_parameters_in_functions(fit_global_parameters):
+    parameters = fit_global_parameters.get_parameters()
+    functions = [parameter.function_value for parameter in parameters if parameter.function]
+
+    if len(functions) == 0: return []
+
+    return [parameter for parameter in parameters if not parameter.function and
+            any(re.search(r"\b" + re.escape(parameter.parameter_name) + r"\b", function) for function in functions)]
+
+def _add_derivative(derivatives, key, derivative):
+    if key in derivatives: derivatives[key] = derivatives[key] + derivative
+    else: derivatives[key] = derivative
+
+def _merge_slopes(s_peaks, I_peaks, windows, s):
+    # derivative with respect to s of Utilities.merge_functions of the rows with their support windows: the slopes of
+    # the linear interpolation inside the windows, 0 outside the rows (where the interpolation is constant)
+    slopes = numpy.zeros(len(s))
+
+    for x, y, first, last in zip(s_peaks, I_peaks, *windows):
+        start = 0 if first == 0 else numpy.searchsorted(s, x[first], side="left")
+        end = len(s) if last == len(x) - 1 else numpy.searchsorted(s, x[last], side="right")
+
+        if end > start:
+            xp = x[first:last + 1]
+            points = s[start:end]
+
+            row_slopes = numpy.diff(y[first:last + 1])/numpy.diff(xp)
+            indexes = numpy.clip(numpy.searchsorted(xp, points) - 1, 0, len(row_slopes) - 1)
+
+            slopes[start:end] += numpy.where((points > xp[0]) & (points < xp[-1]), row_slopes[indexes], 0.0)
+
+    return slopes
@@ -1,19 +1,25 @@
 
+import scipy.fft
+from functools import lru_cache
 from orangecontrib.xrdanalyzer.controller.fit.init.crystal_structure import CrystalStructure
 from orangecontrib.xrdanalyzer.controller.fit.init.crystal_structure_symmetry import Symmetry
-from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import FFTTypes
+from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import FFTTypes, FFTImplementation, PeakSynthesis, AutomaticGrid
 from orangecontrib.xrdanalyzer.controller.fit.init.thermal_polarization_parameters import Beampath, LorentzFormula
 from orangecontrib.xrdanalyzer.controller.fit.instrument.instrumental_parameters import Lab6TanCorrection, ZeroError, SpecimenDisplacement
 from orangecontrib.xrdanalyzer.controller.fit.instrument.background_parameters import ChebyshevBackground, ExpDecayBackground
 from orangecontrib.xrdanalyzer.controller.fit.microstructure.size import Distribution, Normalization
 from orangecontrib.xrdanalyzer.controller.fit.microstructure.strain import InvariantPAH, WarrenModel, KrivoglazWilkensModel
 from orangecontrib.xrdanalyzer.controller.fit.util.fit_utilities import Utilities
+from orangecontrib.xrdanalyzer.controller.fit.util.component_cache import ComponentCache
 from orangecontrib.xrdanalyzer.util.general_functions import ChemicalFormulaParser
 
 
 #########################################################################
 # MAIN FUNCTION
 
+# components of the model (Fourier amplitudes, peak profiles) shared by all the evaluations
+component_cache = ComponentCache()
+
 #################################################
 #
 # FIT FUNCTION
@@ -22,12 +28,13 @@ from orangecontrib.xrdanalyzer.util.general_functions import ChemicalFormulaPars
 
 
 
-def fit_function_direct(twotheta, fit_global_parameters, diffraction_pattern_index = 0):
+def fit_function_direct(twotheta, fit_global_parameters, diffraction_pattern_index = 0, synthesis=PeakSynthesis.FFT):
     wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
 
-    I = fit_function_reciprocal(Utilities.s(0.5*numpy.radians(twotheta), wavelength),
+    I = fit_function_reciprocal(get_s_experimental(twotheta, wavelength),
                                 fit_global_parameters,
-                                diffraction_pattern_index)
+                                diffraction_pattern_index,
+                                synthesis)
 
 
     # POLARIZATION FACTOR --------------------------------------------------------------------------------------
@@ -36,12 +43,7 @@ def fit_function_direct(twotheta, fit_global_parameters, diffraction_pattern_ind
         thermal_polarization_parameters = fit_global_parameters.fit_initialization.thermal_polarization_parameters[0 if len(fit_global_parameters.fit_initialization.thermal_polarization_parameters) == 1 else diffraction_pattern_index]
 
         if thermal_polarization_parameters.use_polarization_factor:
-            twotheta_mono = thermal_polarization_parameters.twotheta_mono
-
-            I *= polarization_factor(numpy.radians(twotheta),
-                                     None if twotheta_mono is None else numpy.radians(twotheta_mono),
-                                     thermal_polarization_parameters.degree_of_polarization,
-                                     thermal_polarization_parameters.beampath)
+            I *= get_polarization_factor_experimental(twotheta, thermal_polarization_parameters)
 
     # ADD BACKGROUNDS  ---------------------------------------------------------------------------------------------
 
@@ -78,23 +80,31 @@ def fit_function_direct(twotheta, fit_global_parameters, diffraction_pattern_ind
 
     return I
 
-def fit_function_reciprocal(s, fit_global_parameters, diffraction_pattern_index = 0):
+def fit_function_reciprocal(s, fit_global_parameters, diffraction_pattern_index = 0, synthesis=PeakSynthesis.FFT):
     crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
 
     if CrystalStructure.is_cube(crystal_structure.symmetry):
 
-        # CONSTRUCTION OF EACH SEPARATE PEAK ---------------------------------------------------------------------------
+        if synthesis == PeakSynthesis.DIRECT_SUM:
+
+            # FOURIER SERIES OF EACH PEAK AT THE ORIGINAL S VALUES -----------------------------------------------------
 
-        separated_peaks_functions = []
+            I = numpy.array(sum_peaks_direct(s, fit_global_parameters, diffraction_pattern_index))
+
+        else:
 
-        for reflection_index in range(crystal_structure.get_reflections_count()):
-            sanalitycal, Ianalitycal = create_one_peak(reflection_index, fit_global_parameters, diffraction_pattern_index)
+            # CONSTRUCTION OF EACH SEPARATE PEAK -----------------------------------------------------------------------
 
-            separated_peaks_functions.append([sanalitycal, Ianalitycal])
+            # all the peaks at once: one row for each reflection
 
-        # INTERPOLATION ONTO ORIGINAL S VALUES -------------------------------------------------------------------------
+            sanalitycal, Ianalitycal, (first, last) = create_peaks(fit_global_parameters, diffraction_pattern_index)
 
-        I = Utilities.merge_functions(separated_peaks_functions, s)
+            # each peak is interpolated only inside its support window
+            separated_peaks_functions = list(zip(sanalitycal, Ianalitycal, zip(first, last)))
+
+            # INTERPOLATION ONTO ORIGINAL S VALUES ---------------------------------------------------------------------
+
+            I = Utilities.merge_functions(separated_peaks_functions, s)
 
         # ADD SAXS
 
@@ -136,6 +146,57 @@ def fit_function_reciprocal(s, fit_global_parameters, diffraction_pattern_index
     else:
         raise NotImplementedError("Only Cubic structures are supported by fit")
 
+#################################################
+# FIXED FACTORS OF THE EXPERIMENTAL POINTS
+#################################################
+
+# the coordinates and the angular factors of the experimental points depend only on the grid and on a few fixed
+# quantities: they are calculated once (the fitters prepare them with the patterns) and recalculated only when one of
+# these quantities changes, e.g. a refined wavelength
+
+def init_experimental_factors(twotheta, fit_global_parameters, diffraction_pattern_index=0):
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+
+    get_s_experimental(twotheta, wavelength)
+
+    if not fit_global_parameters.fit_initialization.thermal_polarization_parameters is None:
+        thermal_polarization_parameters = fit_global_parameters.fit_initialization.thermal_polarization_parameters[0 if len(fit_global_parameters.fit_initialization.thermal_polarization_parameters) == 1 else diffraction_pattern_index]
+
+        if thermal_polarization_parameters.use_polarization_factor:
+            get_polarization_factor_experimental(twotheta, thermal_polarization_parameters)
+
+def get_s_experimental(twotheta, wavelength):
+    def s():
+        return Utilities.s(0.5*numpy.radians(twotheta), wavelength)
+
+    grid_key = component_cache.get_grid_key(twotheta)
+
+    if grid_key is None: return s()
+    else: return component_cache.get("experimental", (grid_key, "s", wavelength), s)
+
+def get_polarization_factor_experimental(twotheta, thermal_polarization_parameters):
+    twotheta_mono = thermal_polarization_parameters.twotheta_mono
+
+    def polarization():
+        return polarization_factor(numpy.radians(twotheta),
+                                   None if twotheta_mono is None else numpy.radians(twotheta_mono),
+                                   thermal_polarization_parameters.degree_of_polarization,
+                                   thermal_polarization_parameters.beampath)
+
+    grid_key = component_cache.get_grid_key(twotheta)
+
+    if grid_key is None: return polarization()
+    else: return component_cache.get("experimental", (grid_key,
+                                                      "polarization",
+                                                      twotheta_mono,
+                                                      thermal_polarization_parameters.degree_of_polarization,
+                                                      thermal_polarization_parameters.beampath), polarization)
+
+def get_points_key(s):
+    # the read-only points are the cached coordinates of a grid: by identity, the others by value
+    if isinstance(s, numpy.ndarray) and not s.flags.writeable: return component_cache.get_grid_key(s)
+    else: return numpy.asarray(s, dtype=float).tobytes()
+
 
 #################################################
 # FOURIER FUNCTIONS
@@ -144,23 +205,42 @@ def fit_function_reciprocal(s, fit_global_parameters, diffraction_pattern_index
 
 class FourierTranformFactory:
     @classmethod
-    def get_fourier_transform(cls, type=FFTTypes.REAL_ONLY):
+    def get_fourier_transform(cls, type=FFTTypes.REAL_ONLY, implementation=FFTImplementation.NUMPY):
         if type == FFTTypes.REAL_ONLY:
-            return FourierTransformRealOnly
+            return FourierTransformRealOnlyRealInput if implementation == FFTImplementation.SCIPY else FourierTransformRealOnly
         elif type == FFTTypes.FULL:
-            return FourierTransformFull
+            return FourierTransformFullRealInput if implementation == FFTImplementation.SCIPY else FourierTransformFull
         else:
             raise ValueError("Type not recognized")
 
+@lru_cache(maxsize=32)
+def _get_fft_frequencies(n_steps, dL):
+    s = numpy.fft.fftshift(numpy.fft.fftfreq(n_steps, dL))
+    s.flags.writeable = False
+
+    return s
+
 class FourierTransform:
+    # f can be a single vector of amplitudes or a matrix with one row for each peak: the transform is along the last axis
+    # workers: threads of the transform, where supported
+
+    @classmethod
+    def fft(cls, f, n_steps, dL, workers=1):
+        raise NotImplementedError()
+
     @classmethod
-    def fft(cls, f, n_steps, dL):
+    def fft_derivatives(cls, f, f_derivatives, n_steps, dL, workers=1):
+        # derivatives of fft(f) for the derivatives of f (f_derivatives: one more leading axis, one for each derivative)
         raise NotImplementedError()
 
+    @classmethod
+    def get_frequencies(cls, n_steps, dL):
+        # shared by all the transforms on the same grid: read-only
+        return _get_fft_frequencies(n_steps, dL)
+
     @classmethod
     def get_empty_fft(cls, n_steps, dL):
-        s = numpy.fft.fftfreq(n_steps, dL)
-        s = numpy.fft.fftshift(s)
+        s = cls.get_frequencies(n_steps, dL)
 
         I = numpy.zeros(len(s))
         I[int(len(s)/2)] = 1.0
@@ -171,35 +251,65 @@ class FourierTransform:
 class FourierTransformRealOnly(FourierTransform):
 
     @classmethod
-    def _real_absolute_fourier(cls, y):
-        return numpy.fft.fftshift(numpy.abs(numpy.real(numpy.fft.fft(y))))
+    def _real_fourier(cls, y, workers=1):
+        return numpy.fft.fftshift(numpy.real(numpy.fft.fft(y)), axes=-1)
+
+    @classmethod
+    def _real_absolute_fourier(cls, y, workers=1):
+        return numpy.abs(cls._real_fourier(y, workers))
 
     @classmethod
     def _fft_normalized(cls, y_fft, n_steps, dL):
-        s = numpy.fft.fftfreq(n_steps, dL)
-        s = numpy.fft.fftshift(s)
+        s = cls.get_frequencies(n_steps, dL)
 
-        integral = numpy.trapz(y_fft, s)
+        integral = numpy.trapz(y_fft, s, axis=-1)
 
-        return s, y_fft / integral
+        return s, y_fft / numpy.expand_dims(integral, -1)
 
     @classmethod
-    def fft(cls, f, n_steps, dL):
-        return cls._fft_normalized(cls._real_absolute_fourier(f), n_steps, dL)
+    def fft(cls, f, n_steps, dL, workers=1):
+        return cls._fft_normalized(cls._real_absolute_fourier(f, workers), n_steps, dL)
+
+    @classmethod
+    def fft_derivatives(cls, f, f_derivatives, n_steps, dL, workers=1):
+        # I = |F|/Z, with F = Re(FFT(f)) and Z = integral of |F|: dI = (G - I*integral of G)/Z, with G = sign(F)*Re(FFT(df))
+        s = cls.get_frequencies(n_steps, dL)
+
+        F = cls._real_fourier(f, workers)
+        G = numpy.sign(F)*cls._real_fourier(f_derivatives, workers)
+
+        absolute_F = numpy.abs(F)
+        integral = numpy.expand_dims(numpy.trapz(absolute_F, s, axis=-1), -1)
+
+        return (G - (absolute_F/integral)*numpy.expand_dims(numpy.trapz(G, s, axis=-1), -1))/integral
+
+def _shifted_real_part(y_rfft):
+    # real part of the full transform of real values from the half one (Re Y[n - j] = Re Y[j]), in fftshift order:
+    # Y[n/2], Y[n/2 - 1], ..., Y[1], Y[0], ..., Y[n/2 - 1]
+    y_real = numpy.real(y_rfft)
+    half = y_real.shape[-1] - 1
+
+    return numpy.concatenate((y_real[..., half:0:-1], y_real[..., :half]), axis=-1)
+
+class FourierTransformRealOnlyRealInput(FourierTransformRealOnly):
+    # real amplitudes: half transform, n_steps is even
+
+    @classmethod
+    def _real_fourier(cls, y, workers=1):
+        return _shifted_real_part(scipy.fft.rfft(y, axis=-1, workers=workers))
 
 from scipy.integrate import simps
 
 class FourierTransformFull(FourierTransform):
     @classmethod
     def _full_fourier(cls, y):
-        return numpy.fft.fftshift(numpy.fft.fft(y))
+        return numpy.fft.fftshift(numpy.fft.fft(y), axes=-1)
 
     @classmethod
     def _fft_shifted(cls, y_fft, n_steps, dL):
-        s = numpy.fft.fftfreq(n_steps, dL)
-        s = numpy.fft.fftshift(s)
+        s = cls.get_frequencies(n_steps, dL)
 
-        y_fft -= y_fft[0]
+        y_fft -= y_fft[..., :1].copy()
 
         return s, y_fft
 
@@ -213,14 +323,40 @@ class FourierTransformFull(FourierTransform):
 
     @classmethod
     def _normalize(cls, s, i):
-        return s, i/simps(i, s)
+        return s, i/numpy.expand_dims(simps(i, s, axis=-1), -1)
 
     @classmethod
-    def fft(cls, f, n_steps, dL):
+    def _fft_unnormalized(cls, f, n_steps, dL, workers=1):
         sr, fft_real = cls._fft_real(numpy.real(f), n_steps, dL)
         si, fft_imag = cls._fft_imag(numpy.imag(f), n_steps, dL)
 
-        return cls._normalize(sr, fft_real - fft_imag)
+        return sr, fft_real - fft_imag
+
+    @classmethod
+    def fft(cls, f, n_steps, dL, workers=1):
+        return cls._normalize(*cls._fft_unnormalized(f, n_steps, dL, workers))
+
+    @classmethod
+    def fft_derivatives(cls, f, f_derivatives, n_steps, dL, workers=1):
+        # linear in f before the normalization: dI = (dR - I*integral of dR)/Z, with Z = integral of R
+        s, R = cls._fft_unnormalized(f, n_steps, dL, workers)
+        _, dR = cls._fft_unnormalized(f_derivatives, n_steps, dL, workers)
+
+        integral = numpy.expand_dims(simps(R, s, axis=-1), -1)
+
+        return (dR - (R/integral)*numpy.expand_dims(simps(dR, s, axis=-1), -1))/integral
+
+class FourierTransformFullRealInput(FourierTransformFull):
+    # Re(FFT(Re f)) - Im(FFT(Im f)) = Re(FFT(f)): one transform, half transform for real amplitudes
+
+    @classmethod
+    def _fft_unnormalized(cls, f, n_steps, dL, workers=1):
+        if numpy.iscomplexobj(f):
+            y_fft = numpy.fft.fftshift(numpy.real(scipy.fft.fft(f, axis=-1, workers=workers)), axes=-1)
+        else:
+            y_fft = _shifted_real_part(scipy.fft.rfft(f, axis=-1, workers=workers))
+
+        return cls._fft_shifted(y_fft, n_steps, dL)
 
 #################################################
 # CALCOLO DI UN SINGOLO PICCO
@@ -380,19 +516,13 @@ def create_one_peak(reflection_index, fit_global_parameters, diffraction_pattern
 
     s_hkl = Utilities.s_hkl(lattice_parameter, reflection.h, reflection.k, reflection.l)
 
-    s += s_hkl
+    s = s + s_hkl
 
     # INTENSITY MODULATION: STRUCTURAL MODEL YES/NO --------------------------------------------------------------------
 
     if crystal_structure.use_structure:
         I *= crystal_structure.intensity_scale_factor.value
-        I *= multiplicity_cubic(reflection.h, reflection.k, reflection.l)
-        I *= squared_modulus_structure_factor(s_hkl,
-                                              crystal_structure.formula,
-                                              reflection.h,
-                                              reflection.k,
-                                              reflection.l,
-                                              crystal_structure.symmetry)
+        I *= get_structure_intensity_factors(crystal_structure, [reflection], [s_hkl])[0]
     else:
         I *= reflection.intensity.value
 
@@ -432,6 +562,689 @@ def create_one_peak(reflection_index, fit_global_parameters, diffraction_pattern
 
     return s, I
 
+#################################################
+# CALCOLO DI TUTTI I PICCHI
+#################################################
+
+def create_peaks(fit_global_parameters, diffraction_pattern_index=0):
+    """
+    same calculation of create_one_peak for all the reflections at once: matrix of Fourier amplitudes
+    (reflections x L), one FFT along the rows, intensity factors and shifts applied to the rows.
+    returns s, I with one row for each reflection (read-only: they can come from the component cache) and the support
+    windows of the rows, first and last index above the peak threshold of the FFT parameters
+
+    every component is cached with the values of the quantities it depends on: when a parameter changes only the
+    components using it are recalculated (e.g. background: nothing, size: size amplitudes, FFT and rows)
+    """
+    n_steps = fit_global_parameters.fit_initialization.fft_parameters.n_step
+    crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+    reflections = [crystal_structure.get_reflection(reflection_index) for reflection_index in range(crystal_structure.get_reflections_count())]
+
+    fft_implementation = fit_global_parameters.fit_initialization.fft_parameters.fft_implementation
+    peak_threshold = fit_global_parameters.fit_initialization.fft_parameters.peak_threshold
+
+    if len(reflections) == 0: return numpy.zeros((0, n_steps)), numpy.zeros((0, n_steps)), (numpy.zeros(0, dtype=int), numpy.zeros(0, dtype=int))
+
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+    lattice_parameter = crystal_structure.a.value
+
+    # columns: one value for each reflection, broadcast along L
+    h = numpy.array([reflection.h for reflection in reflections])[:, numpy.newaxis]
+    k = numpy.array([reflection.k for reflection in reflections])[:, numpy.newaxis]
+    l = numpy.array([reflection.l for reflection in reflections])[:, numpy.newaxis]
+
+    components, amplitudes_key = get_fourier_components(fit_global_parameters, diffraction_pattern_index, reflections)
+
+    # the implementations differ by rounding only, but a cached FFT is always the one requested
+    fft_key = (amplitudes_key, fft_implementation)
+
+    # ROWS: INTENSITY, SHIFTS, LORENTZ ---------------------------------------------------------------------------------
+
+    shift_parameters_list = get_shift_parameters_list(fit_global_parameters, diffraction_pattern_index)
+    lorentz_formula = get_lorentz_formula(fit_global_parameters, diffraction_pattern_index)
+
+    def peaks():
+        s, I = get_fourier_transforms(fit_global_parameters, components, amplitudes_key, len(reflections))
+
+        I = I.copy()
+
+        s_hkl = Utilities.s_hkl(lattice_parameter, h, k, l)
+
+        s = s + s_hkl
+
+        # INTENSITY MODULATION: STRUCTURAL MODEL YES/NO ----------------------------------------------------------------
+
+        modulate_intensity(I, crystal_structure, reflections, s_hkl)
+
+        # PEAK SHIFTS  -------------------------------------------------------------------------------------------------
+
+        if not fit_global_parameters.shift_parameters is None: add_peak_shifts(s, wavelength, shift_parameters_list)
+
+        # LORENTZ FACTOR -----------------------------------------------------------------------------------------------
+
+        if lorentz_formula == LorentzFormula.Shkl_Shkl:
+            I *= lorentz_factor_simplified_normalized(s_hkl, wavelength)
+        elif lorentz_formula == LorentzFormula.S_Shkl:
+            I *= lorentz_factor_normalized(s, s_hkl, wavelength)
+
+        return s, I, Utilities.support_windows(I, peak_threshold)
+
+    return component_cache.get("peaks", (fft_key,
+                                         lattice_parameter,
+                                         wavelength,
+                                         get_intensity_key(crystal_structure, reflections),
+                                         get_shift_key(shift_parameters_list),
+                                         lorentz_formula,
+                                         peak_threshold), peaks)
+
+def get_fourier_transforms(fit_global_parameters, components, amplitudes_key, n_reflections):
+    """
+    FFT of the product of the components of get_fourier_components, one row for each reflection (read-only, from the
+    component cache), with the implementation and the workers of the FFT parameters
+    """
+    fft_type = fit_global_parameters.fit_initialization.fft_parameters.fft_type
+    n_steps = fit_global_parameters.fit_initialization.fft_parameters.n_step
+    fft_implementation = fit_global_parameters.fit_initialization.fft_parameters.fft_implementation
+    fft_workers = fit_global_parameters.fit_initialization.fft_parameters.fft_workers
+    dL = fit_global_parameters.space_parameters().dL
+
+    def fourier_transform():
+        if len(components) > 0:
+            return FourierTranformFactory.get_fourier_transform(fft_type, fft_implementation).fft(multiply_fourier_components(components, (n_reflections, n_steps), fft_type),
+                                                                                                  n_steps=n_steps,
+                                                                                                  dL=dL,
+                                                                                                  workers=fft_workers)
+        else:
+            s, I = FourierTransform.get_empty_fft(n_steps=n_steps, dL=dL)
+
+            return s, numpy.tile(I, (n_reflections, 1))
+
+    # the implementations differ by rounding only, but a cached FFT is always the one requested
+    return component_cache.get("fft", (amplitudes_key, fft_implementation), fourier_transform)
+
+def sum_peaks_direct(s, fit_global_parameters, diffraction_pattern_index=0):
+    """
+    sum of all the peaks of the pattern at the points s (increasing), with the Fourier series of the amplitudes
+    evaluated directly at the points instead of the FFT on the grid of the FFT parameters and the interpolation:
+    the values are the ones of the FFT rows at their grid points (same amplitudes, same normalization over one period)
+    and the exact series between them.
+
+    each peak is evaluated outwards from the Bragg position, in blocks of points, until a whole block is below the
+    peak threshold; the terms of the series whose total is below the threshold are not summed. returns a read-only array (component cache)
+    """
+    fft_type = fit_global_parameters.fit_initialization.fft_parameters.fft_type
+    n_steps = fit_global_parameters.fit_initialization.fft_parameters.n_step
+    dL = fit_global_parameters.space_parameters().dL
+    crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+    reflections = [crystal_structure.get_reflection(reflection_index) for reflection_index in range(crystal_structure.get_reflections_count())]
+
+    peak_threshold = fit_global_parameters.fit_initialization.fft_parameters.peak_threshold
+
+    if len(reflections) == 0: return numpy.zeros(len(s))
+
+    components, amplitudes_key = get_fourier_components(fit_global_parameters, diffraction_pattern_index, reflections)
+
+    # no Fourier amplitudes: delta peaks of the FFT synthesis
+    if len(components) == 0:
+        sanalitycal, Ianalitycal, (first, last) = create_peaks(fit_global_parameters, diffraction_pattern_index)
+
+        return Utilities.merge_functions(list(zip(sanalitycal, Ianalitycal, zip(first, last))), s)
+
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+    lattice_parameter = crystal_structure.a.value
+
+    shift_parameters_list = get_shift_parameters_list(fit_global_parameters, diffraction_pattern_index)
+    lorentz_formula = get_lorentz_formula(fit_global_parameters, diffraction_pattern_index)
+
+    def peaks():
+        fourier_amplitudes = multiply_fourier_components(components, (len(reflections), n_steps), fft_type)
+
+        s_hkl = Utilities.s_hkl(lattice_parameter,
+                                numpy.array([reflection.h for reflection in reflections]),
+                                numpy.array([reflection.k for reflection in reflections]),
+                                numpy.array([reflection.l for reflection in reflections]))
+
+        # intensity factors of each reflection
+        factors = numpy.ones((len(reflections), 1))
+        modulate_intensity(factors, crystal_structure, reflections, s_hkl[:, numpy.newaxis])
+        factors = factors[:, 0]
+
+        if lorentz_formula == LorentzFormula.Shkl_Shkl: factors *= lorentz_factor_simplified_normalized(s_hkl, wavelength)
+
+        # positions before the peak shifts: s = s0 + shifts(s0), solved by fixed point (the shifts are slowly varying)
+        s0 = numpy.array(s, dtype=float)
+
+        if not fit_global_parameters.shift_parameters is None and len(shift_parameters_list) > 0:
+            for iteration in range(3):
+                s_shifted = s0.copy()
+                add_peak_shifts(s_shifted, wavelength, shift_parameters_list)
+                s0 = s - (s_shifted - s0)
+
+        I = numpy.zeros(len(s))
+
+        # one period of the series, the s range of the FFT rows
+        x_min = -1/(2*dL)
+        x_max = (n_steps/2 - 1)/(n_steps*dL)
+
+        for reflection_index in range(len(reflections)):
+            indexes, values = fourier_series_peak(s0 - s_hkl[reflection_index],
+                                                  fourier_amplitudes[reflection_index],
+                                                  dL,
+                                                  fft_type,
+                                                  peak_threshold,
+                                                  x_min,
+                                                  x_max)
+
+            values *= factors[reflection_index]
+
+            if lorentz_formula == LorentzFormula.S_Shkl: values *= lorentz_factor_normalized(s[indexes], s_hkl[reflection_index], wavelength)
+
+            I[indexes] += values
+
+        return I
+
+    return component_cache.get("direct", (amplitudes_key,
+                                          lattice_parameter,
+                                          wavelength,
+                                          get_intensity_key(crystal_structure, reflections),
+                                          get_shift_key(shift_parameters_list),
+                                          lorentz_formula,
+                                          peak_threshold,
+                                          get_points_key(s)), peaks)
+
+def fourier_series_peak(x, fourier_amplitudes, dL, fft_type, peak_threshold, x_min, x_max, block_size=128):
+    """
+    one peak as direct sum of the Fourier series, at the points x (distance from the Bragg position, increasing),
+    normalized to its integral over one period [x_min, x_max].
+    returns the indexes of the evaluated points and the values
+    """
+    n_steps = len(fourier_amplitudes)
+    k = numpy.arange(n_steps)
+
+    amplitudes_re = numpy.real(fourier_amplitudes)
+    amplitudes_im = numpy.imag(fourier_amplitudes) if numpy.iscomplexobj(fourier_amplitudes) else None
+
+    # the full transform subtracts its value at the first point of the row, where the sine terms are 0
+    alternate = numpy.where(k % 2 == 0, 1.0, -1.0)
+    offset = 0.0 if fft_type == FFTTypes.REAL_ONLY else numpy.dot(amplitudes_re, alternate)
+
+    height = numpy.sum(amplitudes_re) - offset
+    threshold = peak_threshold*abs(height)
+
+    # terms in the series: the total of the omitted terms is below the threshold
+    weights = numpy.abs(amplitudes_re) if amplitudes_im is None else numpy.abs(amplitudes_re) + numpy.abs(amplitudes_im)
+    n_terms = max(1, numpy.count_nonzero(numpy.cumsum(weights[::-1])[::-1] > threshold))
+
+    # the cached phase matrices have a power of 2 of terms, the amplitudes over n_terms are 0: the small changes of
+    # n_terms during a fit use the same matrices
+    n_columns = min(n_steps, 2**int(numpy.ceil(numpy.log2(n_terms))))
+
+    amplitudes_re = numpy.where(k < n_terms, amplitudes_re, 0.0)[:n_columns]
+    if not amplitudes_im is None: amplitudes_im = numpy.where(k < n_terms, amplitudes_im, 0.0)[:n_columns]
+
+    def series(points, cached=True):
+        if cached:
+            cosines, sines = get_phase_matrices(points, dL, n_columns, not amplitudes_im is None)
+        else:
+            phases = 2*numpy.pi*dL*numpy.outer(points, k[:n_columns])
+            cosines, sines = numpy.cos(phases), None if amplitudes_im is None else numpy.sin(phases)
+
+        y = numpy.dot(cosines, amplitudes_re) - offset
+        if not amplitudes_im is None: y += numpy.dot(sines, amplitudes_im)
+
+        return numpy.abs(y) if fft_type == FFTTypes.REAL_ONLY else y
+
+    # integral of the FFT rows (trapezoidal rule on the grid of n_steps points): all the cosines but the first one
+    # sum to 0 on the grid, the sines too
+    y_ends = series(numpy.array([x_min, x_max]), cached=False)
+    integral = (amplitudes_re[0] - offset)/dL - (y_ends[0] + y_ends[1])/(2*n_steps*dL)
+
+    start = numpy.searchsorted(x, x_min, side="left")
+    end = numpy.searchsorted(x, x_max, side="right")
+    center = numpy.clip(numpy.searchsorted(x, 0.0), start, end)
+
+    indexes = []
+    values = []
+
+    # right side, then left side: blocks of points until a whole block is below the threshold (a single point
+    # below it can be a dip of an oscillating profile)
+    for block_starts, direction in [(range(center, end, block_size), 1), (range(center - 1, start - 1, -block_size), -1)]:
+        for block_start in block_starts:
+            block = numpy.arange(block_start, min(block_start + block_size, end) if direction == 1 else max(block_start - block_size, start - 1), direction)
+
+            y = series(x[block])
+
+            indexes.append(block)
+            values.append(y)
+
+            if numpy.all(numpy.abs(y) < threshold): break
+
+    if len(indexes) == 0: return numpy.zeros(0, dtype=int), numpy.zeros(0)
+
+    return numpy.concatenate(indexes), numpy.concatenate(values)/integral
+
+def get_phase_matrices(points, dL, n_columns, sines=True):
+    """
+    cosines and sines (None if not sines) of the first n_columns terms of the Fourier series at the points, from the
+    component cache: the points of a reflection are the same at every evaluation with the same lattice parameter,
+    wavelength and peak shifts (e.g. the derivatives of the other parameters), where the direct sum becomes a
+    product of the cached matrices with the amplitudes
+    """
+    def phase_matrices():
+        # exp(i*theta*k) with k = m*j + r as exp(i*theta*m*j)*exp(i*theta*r): 2*sqrt(n_columns) exponentials for each
+        # point instead of n_columns cosines and sines
+        n_low = 2**(int(numpy.log2(n_columns))//2)
+        theta = 2*numpy.pi*dL*numpy.asarray(points, dtype=float)
+
+        low = numpy.exp(1j*numpy.outer(theta, numpy.arange(n_low)))
+        high = numpy.exp(1j*numpy.outer(theta, n_low*numpy.arange(n_columns//n_low)))
+
+        phases = (high[:, :, numpy.newaxis]*low[:, numpy.newaxis, :]).reshape(len(theta), n_columns)
+
+        return numpy.ascontiguousarray(phases.real), numpy.ascontiguousarray(phases.imag) if sines else None
+
+    return component_cache.get("phases", (numpy.asarray(points, dtype=float).tobytes(), dL, n_columns, sines), phase_matrices)
+
+def get_fourier_components(fit_global_parameters, diffraction_pattern_index, reflections, fft_parameters=None):
+    """
+    Fourier amplitudes of the instrumental, size and strain components of the reflections, from the component cache.
+    returns the components [name, key, amplitudes] (one row for each reflection or one row for all) and the key of
+    their product.
+    fft_parameters: grid of the amplitudes, if not the one of the fit
+    """
+    if fft_parameters is None: fft_parameters = fit_global_parameters.fit_initialization.fft_parameters
+
+    fft_type = fft_parameters.fft_type
+    n_steps = fft_parameters.n_step
+    fit_space_parameters = fit_global_parameters.space_parameters(fft_parameters)
+    crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+
+    wavelength = fit_global_parameters.fit_initialization.diffraction_patterns[diffraction_pattern_index].wavelength.value
+    lattice_parameter = crystal_structure.a.value
+
+    # columns: one value for each reflection, broadcast along L
+    h = numpy.array([reflection.h for reflection in reflections])[:, numpy.newaxis]
+    k = numpy.array([reflection.k for reflection in reflections])[:, numpy.newaxis]
+    l = numpy.array([reflection.l for reflection in reflections])[:, numpy.newaxis]
+
+    hkl = tuple([(reflection.h, reflection.k, reflection.l) for reflection in reflections])
+    grid = (n_steps, fit_space_parameters.dL)
+
+    L = fit_space_parameters.L
+
+    components = [] # [name, key, amplitudes]
+
+    # INSTRUMENTAL PROFILE ---------------------------------------------------------------------------------------------
+
+    if not fit_global_parameters.instrumental_parameters is None:
+        instrumental_parameters = fit_global_parameters.instrumental_parameters[0 if len(fit_global_parameters.instrumental_parameters) == 1 else diffraction_pattern_index]
+
+        values = (instrumental_parameters.U.value,
+                  instrumental_parameters.V.value,
+                  instrumental_parameters.W.value,
+                  instrumental_parameters.a.value,
+                  instrumental_parameters.b.value,
+                  instrumental_parameters.c.value)
+
+        key = (grid, hkl, lattice_parameter, wavelength, values)
+        components.append(["instrumental", key, component_cache.get("instrumental", key,
+                                                                    lambda: instrumental_function(L, h, k, l, lattice_parameter, wavelength, *values))])
+
+    # SIZE -------------------------------------------------------------------------------------------------------------
+
+    if not fit_global_parameters.size_parameters is None:
+        size_parameters = fit_global_parameters.size_parameters[0 if len(fit_global_parameters.size_parameters) == 1 else diffraction_pattern_index]
+
+        # same for all the reflections
+        if size_parameters.distribution == Distribution.LOGNORMAL:
+            key = (grid, size_parameters.distribution, size_parameters.sigma.value, size_parameters.mu.value)
+            components.append(["size", key, component_cache.get("size", key,
+                                                                lambda: size_function_lognormal(L,
+                                                                                                size_parameters.sigma.value,
+                                                                                                size_parameters.mu.value))])
+        elif size_parameters.distribution == Distribution.DELTA:
+            key = (grid, size_parameters.distribution, size_parameters.mu.value)
+            components.append(["size", key, component_cache.get("size", key,
+                                                                lambda: size_function_delta(L,
+                                                                                            size_parameters.mu.value))])
+
+    # STRAIN -----------------------------------------------------------------------------------------------------------
+
+    if not fit_global_parameters.strain_parameters is None:
+        strain_parameters = fit_global_parameters.strain_parameters[0 if len(fit_global_parameters.strain_parameters) == 1 else diffraction_pattern_index]
+
+        if isinstance(strain_parameters, InvariantPAH): # INVARIANT PAH
+            C_hkl = numpy.array([strain_parameters.get_invariant(reflection.h,
+                                                                 reflection.k,
+                                                                 reflection.l) for reflection in reflections])[:, numpy.newaxis]
+
+            key = (grid, hkl, lattice_parameter, strain_parameters.aa.value, strain_parameters.bb.value, C_hkl.tobytes())
+            components.append(["strain", key, component_cache.get("strain", key,
+                                                                  lambda: strain_invariant_function_pah(L,
+                                                                                                        h,
+                                                                                                        k,
+                                                                                                        l,
+                                                                                                        lattice_parameter,
+                                                                                                        strain_parameters.aa.value,
+                                                                                                        strain_parameters.bb.value,
+                                                                                                        C_hkl))])
+
+        elif isinstance(strain_parameters, KrivoglazWilkensModel): # KRIVOGLAZ-WILKENS
+            values = (strain_parameters.rho.value,
+                      strain_parameters.Re.value,
+                      strain_parameters.Ae.value,
+                      strain_parameters.Be.value,
+                      strain_parameters.As.value,
+                      strain_parameters.Bs.value,
+                      strain_parameters.mix.value,
+                      strain_parameters.b.value)
+
+            key = (grid, hkl, lattice_parameter, values)
+            components.append(["strain", key, component_cache.get("strain", key,
+                                                                  lambda: strain_krivoglaz_wilkens(L, h, k, l, lattice_parameter, *values))])
+
+        elif isinstance(strain_parameters, WarrenModel): # WARREN: tabulated functions, one reflection at a time
+            def warren_amplitudes():
+                fourier_amplitudes_re = numpy.zeros((len(reflections), len(L)))
+                fourier_amplitudes_im = numpy.zeros((len(reflections), len(L)))
+
+                for reflection_index, reflection in enumerate(reflections):
+                    fourier_amplitudes_re[reflection_index, :], fourier_amplitudes_im[reflection_index, :] = \
+                        strain_warren_function(L,
+                                               reflection.h,
+                                               reflection.k,
+                                               reflection.l,
+                                               lattice_parameter,
+                                               strain_parameters.average_cell_parameter.value)
+
+                return fourier_amplitudes_re, fourier_amplitudes_im
+
+            key = (grid, hkl, lattice_parameter, strain_parameters.average_cell_parameter.value)
+            components.append(["warren", key, component_cache.get("warren", key, warren_amplitudes)])
+
+    return components, (grid, hkl, fft_type, tuple([(name, key) for name, key, _ in components]))
+
+def multiply_fourier_components(components, shape, fft_type):
+    # multiplying by 1 is exact: the rows are the same of create_one_peak
+    fourier_amplitudes = numpy.ones(shape)
+
+    for name, _, amplitudes in components:
+        if name == "warren":
+            if fft_type == FFTTypes.FULL:
+                fourier_amplitudes = (fourier_amplitudes*amplitudes[0]) + 1j*(fourier_amplitudes*amplitudes[1])
+            elif fft_type == FFTTypes.REAL_ONLY:
+                fourier_amplitudes *= amplitudes[0]
+        else:
+            fourier_amplitudes *= amplitudes
+
+    return fourier_amplitudes
+
+#################################################
+# AUTOMATIC FFT GRID
+#################################################
+
+def get_auto_fft_grid(fit_global_parameters, twotheta_list, synthesis=PeakSynthesis.FFT, max_refinements=8, grow_only=False):
+    """
+    s_max and n_step (power of 2) of the FFT grid for the current profiles: the model on the points of the patterns
+    (twotheta_list) is within the auto_tolerance of the FFT parameters, relative to its maximum.
+    The first grid comes from the widths of the profiles (get_fft_grid_requirements), then s_max or the resolution are
+    doubled until the model stops changing: it converges as 1/s_max (the amplitudes start from L = dL) and as ds^2.
+    s_max is kept below get_s_max_limit (the rows of the peaks end before 2/wavelength).
+    The current grid is kept while it is between the chosen one and twice as large, so the model changes only when
+    the profiles do; with grow_only (during a fit) it is never made shorter or coarser
+    """
+    fit_initialization = fit_global_parameters.fit_initialization
+    fft_parameters = fit_initialization.fft_parameters
+    tolerance = fft_parameters.auto_tolerance
+    s_max_limit = get_s_max_limit(fit_global_parameters)
+
+    # the amplitudes are probed on the current grid first, then on the grids they ask for, until they are resolved
+    probe = fft_parameters
+
+    for _ in range(4):
+        s_max, ds, resolved = get_fft_grid_requirements(fit_global_parameters, probe, tolerance)
+
+        # no broadening or invalid values of the parameters: nothing to measure
+        if s_max is None or not numpy.isfinite(s_max) or not numpy.isfinite(ds) or s_max <= 0 or ds <= 0:
+            return fft_parameters.s_max, fft_parameters.n_step
+        if resolved: break
+
+        probe = probe.duplicate()
+        probe.s_max = min(s_max, s_max_limit)
+        probe.n_step = get_fft_n_step(probe.s_max, ds)
+
+    # powers of 2 for s_max too: the choice changes only when the profiles change by a factor 2
+    s_max = min(float(2**int(numpy.ceil(numpy.log2(s_max)))), s_max_limit)
+    n_step = get_fft_n_step(s_max, ds)
+
+    def get_model(s_max, n_step):
+        fit_initialization.fft_parameters = fft_parameters.duplicate()
+        fit_initialization.fft_parameters.s_max = s_max
+        fit_initialization.fft_parameters.n_step = n_step
+
+        return [fit_function_direct(twotheta, fit_global_parameters, index, synthesis) for index, twotheta in enumerate(twotheta_list)]
+
+    def get_difference(y_list, y_reference_list):
+        return max([numpy.max(numpy.abs(y - y_reference))/max(numpy.max(numpy.abs(y_reference)), 1e-300)
+                    for y, y_reference in zip(y_list, y_reference_list)])
+
+    try:
+        y_list = get_model(s_max, n_step)
+
+        for _ in range(max_refinements):
+            if 2*n_step > AutomaticGrid.N_STEP_MAX:
+                print("Automatic FFT grid: tolerance not verified, n_step is at its maximum")
+                break
+
+            # first order: the difference is half the error. s_max stops at its limit
+            error_s = 2*get_difference(y_list, get_model(2*s_max, 2*n_step)) if 2*s_max <= s_max_limit else 0.0
+            error_n = get_difference(y_list, get_model(s_max, 2*n_step))
+
+            if error_s + error_n <= tolerance or not numpy.isfinite(error_s + error_n): break
+
+            if error_s > error_n:
+                s_max *= 2
+
+                # second order: the step can double with s_max while 4 times the error is small
+                if 4*error_n > 0.25*tolerance: n_step *= 2
+            else:
+                n_step *= 2
+
+            y_list = get_model(s_max, n_step)
+    finally:
+        fit_initialization.fft_parameters = fft_parameters
+
+    ds = 2*s_max/n_step
+    current_ds = 2*fft_parameters.s_max/fft_parameters.n_step
+
+    if s_max <= fft_parameters.s_max <= 2*s_max and 0.5*ds <= current_ds <= ds:
+        return fft_parameters.s_max, fft_parameters.n_step
+    elif grow_only:
+        # a shorter or coarser grid would change the model the minimizer is converging on
+        grown_s_max = min(max(s_max, fft_parameters.s_max), s_max_limit)
+        grown_n_step = max(n_step*grown_s_max/s_max, fft_parameters.n_step*grown_s_max/fft_parameters.s_max)
+
+        return grown_s_max, min(2**int(numpy.ceil(numpy.log2(grown_n_step) - 1e-9)), AutomaticGrid.N_STEP_MAX)
+    else:
+        return s_max, n_step
+
+def get_s_max_limit(fit_global_parameters):
+    """
+    largest power of 2 for s_max with s_hkl + s_max < 2/wavelength for all the reflections inside the sphere of
+    reflection: beyond it the rows of the peaks have no diffraction angle (arcsin of s*wavelength/2 > 1)
+    """
+    s_max_limit = numpy.inf
+
+    for diffraction_pattern_index, diffraction_pattern in enumerate(fit_global_parameters.fit_initialization.diffraction_patterns):
+        crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+        s_sphere = 2/diffraction_pattern.wavelength.value
+
+        s_hkl = numpy.array([Utilities.s_hkl(crystal_structure.a.value, reflection.h, reflection.k, reflection.l)
+                             for reflection in [crystal_structure.get_reflection(reflection_index) for reflection_index in range(crystal_structure.get_reflections_count())]])
+        s_hkl = s_hkl[s_hkl < s_sphere]
+
+        if len(s_hkl) > 0: s_max_limit = min(s_max_limit, s_sphere - numpy.max(s_hkl))
+
+    if not numpy.isfinite(s_max_limit) or s_max_limit <= 0: return numpy.inf
+
+    # strictly below the limit
+    return float(2**int(numpy.ceil(numpy.log2(s_max_limit)) - 1))
+
+def get_fft_n_step(s_max, ds):
+    # the FFT of n_step points spaced by dL = 1/(2*s_max) has a step of 2*s_max/n_step in s
+    n_step = 2**int(numpy.ceil(numpy.log2(2*s_max/ds)))
+
+    return min(max(n_step, AutomaticGrid.N_STEP_MIN), AutomaticGrid.N_STEP_MAX)
+
+def get_fft_grid_requirements(fit_global_parameters, fft_parameters, tolerance):
+    """
+    half width of the rows (s_max) and step in s needed by the profiles of all the reflections for a relative accuracy
+    of tolerance, from their Fourier amplitudes A(L) on the grid of fft_parameters (A(0) = 1) and their integral
+    breadths beta = 1/(2*integral of A), the lorentzian bounds of instrumental, size and strain broadening:
+     - s_max: tails of the broadest peak down to tolerance, beta/(pi*sqrt(tolerance)), not larger than the s range of
+       the patterns
+     - ds: linear interpolation of the sharpest peak, 2*beta*sqrt(tolerance)/pi, and L_max = 1/ds beyond the amplitudes
+       above tolerance
+    returns s_max, ds and False when the probe grid is too short or too coarse to resolve the amplitudes (the
+    requirements are then larger than the probe); None, None, True without broadening components or with invalid
+    amplitudes
+    """
+    fit_space_parameters = fit_global_parameters.space_parameters(fft_parameters)
+    n_steps = fft_parameters.n_step
+    dL = fit_space_parameters.dL
+
+    breadth_min = numpy.inf
+    breadth_max = 0.0
+    L_needed = 0.0
+    s_range = 0.0
+    resolved = True
+
+    for diffraction_pattern_index, diffraction_pattern in enumerate(fit_global_parameters.fit_initialization.diffraction_patterns):
+        crystal_structure = fit_global_parameters.fit_initialization.crystal_structures[diffraction_pattern_index]
+        reflections = [crystal_structure.get_reflection(reflection_index) for reflection_index in range(crystal_structure.get_reflections_count())]
+
+        if len(reflections) == 0: continue
+
+        components, _ = get_fourier_components(fit_global_parameters, diffraction_pattern_index, reflections, fft_parameters)
+
+        if len(components) == 0: continue
+
+        fourier_amplitudes = numpy.abs(multiply_fourier_components(components, (len(reflections), n_steps), FFTTypes.FULL))
+
+        if not numpy.all(numpy.isfinite(fourier_amplitudes)): return None, None, True # invalid values of the parameters
+
+        # trapezoidal rule from A(0) = 1
+        breadths = 1/(2*dL*(0.5 + numpy.sum(fourier_amplitudes, axis=1)))
+
+        # number of samples up to the last one above tolerance
+        above = fourier_amplitudes >= tolerance
+        last = numpy.where(numpy.any(above, axis=1), n_steps - numpy.argmax(above[:, ::-1], axis=1), 0)
+
+        if numpy.any(above[:, -1]): # too short: at least twice as long
+            L_needed = max(L_needed, 2*fit_space_parameters.L_max)
+            resolved = False
+        else:
+            L_needed = max(L_needed, max(numpy.max(last), 1)*dL)
+
+        if numpy.min(last) < 8: # too coarse: at least twice as wide
+            breadth_max = max(breadth_max, 2*fft_parameters.s_max*numpy.pi*numpy.sqrt(tolerance))
+            resolved = False
+
+        breadth_min = min(breadth_min, numpy.min(breadths))
+        breadth_max = max(breadth_max, numpy.max(breadths))
+
+        twotheta = diffraction_pattern.tuples()[0]
+
+        if len(twotheta) > 0:
+            s = Utilities.s(0.5*numpy.radians(numpy.array([numpy.min(twotheta), numpy.max(twotheta)])), diffraction_pattern.wavelength.value)
+            s_range = max(s_range, s[1] - s[0])
+
+    if breadth_max == 0.0: return None, None, True
+
+    s_max = breadth_max/(numpy.pi*numpy.sqrt(tolerance))
+    if s_range > 0: s_max = min(s_max, s_range)
+
+    ds = min(2*breadth_min*numpy.sqrt(tolerance)/numpy.pi, 1/L_needed)
+
+    return s_max, ds, resolved
+
+def get_shift_parameters_list(fit_global_parameters, diffraction_pattern_index):
+    shift_parameters_list = []
+
+    if not fit_global_parameters.shift_parameters is None:
+        for key in fit_global_parameters.shift_parameters.keys():
+            shift_parameters = fit_global_parameters.get_shift_parameters(key)[0 if len(fit_global_parameters.get_shift_parameters(key)) == 1 else diffraction_pattern_index]
+
+            if not shift_parameters is None: shift_parameters_list.append([key, shift_parameters])
+
+    return shift_parameters_list
+
+def get_shift_key(shift_parameters_list):
+    return tuple([(key, shift_parameters.goniometer_radius if key == SpecimenDisplacement.__name__ else None,
+                   tuple([parameter.value for parameter in shift_parameters.get_parameters()])) for key, shift_parameters in shift_parameters_list])
+
+def get_lorentz_formula(fit_global_parameters, diffraction_pattern_index):
+    if not fit_global_parameters.fit_initialization.thermal_polarization_parameters is None:
+        thermal_polarization_parameters = fit_global_parameters.fit_initialization.thermal_polarization_parameters[0 if len(fit_global_parameters.fit_initialization.thermal_polarization_parameters) == 1 else diffraction_pattern_index]
+
+        if thermal_polarization_parameters.use_lorentz_factor: return thermal_polarization_parameters.lorentz_formula
+
+    return None
+
+def get_intensity_key(crystal_structure, reflections):
+    if crystal_structure.use_structure:
+        return (crystal_structure.intensity_scale_factor.value, crystal_structure.formula, crystal_structure.symmetry)
+    else:
+        return tuple([reflection.intensity.value for reflection in reflections])
+
+def modulate_intensity(I, crystal_structure, reflections, s_hkl):
+    # in place, one row of I for each reflection (s_hkl column)
+    if crystal_structure.use_structure:
+        I *= crystal_structure.intensity_scale_factor.value
+        I *= get_structure_intensity_factors(crystal_structure, reflections, s_hkl[:, 0])[:, numpy.newaxis]
+    else:
+        I *= numpy.array([reflection.intensity.value for reflection in reflections])[:, numpy.newaxis]
+
+def get_structure_intensity_factors(crystal_structure, reflections, s_hkl):
+    """
+    multiplicity*|F(s_hkl)|^2 of the reflections (structural model), all at once: they depend only on the formula,
+    the symmetry, the hkl and s_hkl (the lattice parameter), so they are cached until one of them changes
+    """
+    hkl = tuple([(reflection.h, reflection.k, reflection.l) for reflection in reflections])
+    s_hkl = numpy.array(s_hkl, dtype=float)
+
+    def intensity_factors():
+        h, k, l = numpy.array(hkl, dtype=float).reshape((len(hkl), 3)).T
+
+        multiplicities = numpy.array([multiplicity_cubic(*reflection_hkl) for reflection_hkl in hkl], dtype=float)
+
+        return multiplicities*squared_modulus_structure_factor(s_hkl,
+                                                               crystal_structure.formula,
+                                                               h, k, l,
+                                                               crystal_structure.symmetry)
+
+    return component_cache.get("structure", (crystal_structure.formula,
+                                             crystal_structure.symmetry,
+                                             hkl,
+                                             s_hkl.tobytes()), intensity_factors)
+
+def add_peak_shifts(s, wavelength, shift_parameters_list):
+    # in place
+    theta = Utilities.theta(s, wavelength)
+
+    for key, shift_parameters in shift_parameters_list:
+        if key == Lab6TanCorrection.__name__:
+            s += lab6_tan_correction(theta, wavelength,
+                                     shift_parameters.ax.value,
+                                     shift_parameters.bx.value,
+                                     shift_parameters.cx.value,
+                                     shift_parameters.dx.value,
+                                     shift_parameters.ex.value)
+        elif key == ZeroError.__name__:
+            s += Utilities.s(shift_parameters.shift.value/2, wavelength)
+        elif key == SpecimenDisplacement.__name__:
+            s += specimen_displacement(theta, wavelength, shift_parameters.goniometer_radius, shift_parameters.displacement.value)
+
 
 ######################################################################
 # FUNZIONI WPPM
@@ -440,7 +1253,12 @@ def create_one_peak(reflection_index, fit_global_parameters, diffraction_pattern
 import numpy
 from scipy.special import erfc
 import os
-from Orange.canvas import resources
+from orangecontrib.xrdanalyzer.util.reference_data import reference_data, get_package_directory
+
+# reference tables: loaded at the first use
+
+def get_data_directory():
+    return get_package_directory("orangecontrib.xrdanalyzer.controller.fit.data")
 
 ######################################################################
 # THERMAL AND POLARIZATION
@@ -520,31 +1338,77 @@ from numpy import pi, log, sqrt, arcsin, sin, cos # TO SHORTEN FORMULAS
 def clausen_integral_inner_function(t):
     return log(2*sin(t/2))
 
-def clausen_integral(x=0.0):
+def clausen_integral_quad(x=0.0):
+    # reference: one adaptive quadrature for each point (accuracy check of the series: util/clausen_accuracy.py)
     _v_integrate_quad = numpy.vectorize(integrate.quad)
 
     return -1*(_v_integrate_quad(lambda t: clausen_integral_inner_function(t), 0.0, x)[0])
 
-def f_star(eta, use_simplified_calculation=True):
+@lru_cache(maxsize=None)
+def _clausen_series_coefficients(n_terms=40):
+    from scipy.special import bernoulli, factorial
+
+    k = numpy.arange(1, n_terms + 1)
+
+    return numpy.abs(bernoulli(2*n_terms)[2*k])/(2*k*factorial(2*k + 1))
+
+def clausen_integral(x=0.0):
+    """
+    Clausen function Cl2(x) = -integral of log(2*sin(t/2)) from 0 to x, by the series
+    Cl2(x) = x - x*log(x) + sum(|B_2k|*x^(2k+1)/(2k*(2k+1)!)), |x| < 2*pi, on x reduced to [0, pi]
+    (odd, periodic): the terms decrease at least as 4^-k, 40 terms are well below the double precision
+    (max absolute difference from clausen_integral_quad ~4E-12, the error of the quadrature)
+    """
+    x = numpy.mod(numpy.asarray(x, dtype=float), 2*pi)
+    sign = numpy.where(x > pi, -1.0, 1.0)
+    x = numpy.where(x > pi, 2*pi - x, x)
+
+    x2 = x**2
+    series = numpy.zeros(x.shape)
+    for coefficient in _clausen_series_coefficients()[::-1]: series = series*x2 + coefficient
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        result = numpy.where(x == 0, 0.0, x - x*log(x) + x*x2*series)
+
+    return sign*result
+
+# below this value the exact f_star loses digits (terms in 1/eta cancelling out), while the expansion differs
+# from it by less than 1E-13
+F_STAR_EXPANSION_LIMIT = 1e-2
+
+def f_star(eta, use_simplified_calculation=False):
+    """
+    Wilkens function f*(eta), eta = L/Re: the exact expression (Clausen integral) or the expansion for eta < 1
+    """
     result = numpy.zeros(len(eta))
     eta = numpy.array(eta)
 
     cursor_1 = numpy.where(eta >= 1)
-    cursor_2 = numpy.where(eta < 1)
+    cursor_2 = numpy.where(eta < 1) if use_simplified_calculation else numpy.where(eta < F_STAR_EXPANSION_LIMIT)
+    cursor_3 = numpy.where(numpy.logical_and(eta >= F_STAR_EXPANSION_LIMIT, eta < 1)) if not use_simplified_calculation else None
 
     eta1 = eta[cursor_1]
     eta2 = eta[cursor_2]
 
-    result[cursor_1] = (256/(45*pi*eta1)) - ((11/24) + (log(2) - log(eta1))/4)/(eta1**2)
+    result[cursor_1] = (256/(45*pi*eta1)) - ((11/24) + (log(2) + log(eta1))/4)/(eta1**2)
+    result[cursor_2] = (7/4) - log(2) - log(eta2) + ((eta2**2)/6) - (32*(eta2**3))/(225*pi)
 
-    if use_simplified_calculation:
-        result[cursor_2] = (7/4) - log(2) - log(eta2) + ((eta2**2)/6) - (32*(eta2**3))/(225*pi)
-    else:
-        result[cursor_2] = (256/(45*pi*eta2))
-        result[cursor_2] += ((eta2**2)/6) - log(2) - log(eta2)
-        result[cursor_2] += -eta2*sqrt(1-(eta2**2))*(769 + 4*(eta2**2)*(20.5 + (eta2**2)))/(180*pi*(eta2**2))
-        result[cursor_2] += -((45 - 180*eta2**2)*clausen_integral(2*arcsin(eta2)) +
-                             (15*arcsin(eta2)*(11 + 4*(eta2**2)*(10.5 + (eta2**2)) + (6 - 24*(eta2**2))*(log(2) + log(eta2)))))/(180*pi*(eta2**2))
+    if not use_simplified_calculation: result[cursor_3] = f_star_exact(eta[cursor_3])
+
+    return result
+
+def f_star_exact(eta, clausen_function=clausen_integral):
+    """
+    exact Wilkens function for 0 < eta < 1: with clausen_function=clausen_integral_quad it is the reference of
+    the accuracy check (util/clausen_accuracy.py)
+    """
+    eta = numpy.asarray(eta, dtype=float)
+
+    result = (7/4) + (256/(45*pi*eta))
+    result += ((eta**2)/6) - log(2) - log(eta)
+    result += -eta*sqrt(1-(eta**2))*(769 + 4*(eta**2)*(20.5 + (eta**2)))/(180*pi*(eta**2))
+    result += -((45 - 180*eta**2)*clausen_function(2*arcsin(eta)) +
+                (15*arcsin(eta)*(11 + 4*(eta**2)*(10.5 + (eta**2)) + (6 - 24*(eta**2))*(log(2) + log(eta)))))/(180*pi*(eta**2))
 
     return result
 
@@ -557,11 +1421,14 @@ def C_hkl_krivoglaz_wilkens(h, k, l, Ae, Be, As, Bs, mix):
 
     return mix*C_hkl_edge + (1-mix)*C_hkl_screw
 
-def strain_krivoglaz_wilkens(L, h, k, l, lattice_parameter, rho, Re, Ae, Be, As, Bs, mix, b):
+def strain_krivoglaz_wilkens(L, h, k, l, lattice_parameter, rho, Re, Ae, Be, As, Bs, mix, b, f_star_values=None):
     s_hkl = Utilities.s_hkl(lattice_parameter, h, k, l)
     C_hkl = C_hkl_krivoglaz_wilkens(h, k, l, Ae, Be, As, Bs, mix)
 
-    return numpy.exp(-(0.5*pi*(s_hkl**2)*(b**2)*rho*C_hkl*(L**2)*f_star(L/Re)))
+    # f_star(L/Re) does not depend on hkl: it can be calculated once for all the reflections
+    if f_star_values is None: f_star_values = f_star(L/Re)
+
+    return numpy.exp(-(0.5*pi*(s_hkl**2)*(b**2)*rho*C_hkl*(L**2)*f_star_values))
 
 def displacement_krivoglaz_wilkens(L, h, k, l, rho, Re, Ae, Be, As, Bs, mix, b):
     C_hkl = C_hkl_krivoglaz_wilkens(h, k, l, Ae, Be, As, Bs, mix)
@@ -571,28 +1438,16 @@ def displacement_krivoglaz_wilkens(L, h, k, l, rho, Re, Ae, Be, As, Bs, mix, b):
 
 # WARREN MODEL --------------------------------
 
-def load_warren_files():
-    delta_l_dict = {}
-    delta_l2_dict = {}
-
-    path = os.path.join(resources.package_dirname("orangecontrib.xrdanalyzer.controller.fit"), "data")
-    path = os.path.join(path, "delta_l_files")
-
-    filenames = os.listdir(path)
+def get_warren_files():
+    path = os.path.join(get_data_directory(), "delta_l_files")
 
-    for filename in filenames:
-        if filename.endswith('FTinfo'):
-            hkl = filename[0:3]
-            name =  os.path.join(path, filename)
-            data = numpy.loadtxt(name)
-            L = data[:,0]
+    return [os.path.join(path, filename) for filename in os.listdir(path) if filename.endswith('FTinfo')]
 
-            delta_l_dict[hkl] = [L, data[:, 1]] # deltal_fun
-            delta_l2_dict[hkl] = [L, data[:,2]] # deltal2_fun
+def load_warren_files(file_names):
+    # hkl -> columns L, deltal_fun, deltal2_fun
+    return {os.path.basename(file_name)[0:3]: numpy.loadtxt(file_name) for file_name in file_names}
 
-    return delta_l_dict, delta_l2_dict
-
-delta_l_dict, delta_l2_dict = load_warren_files()
+reference_data.register("warren_delta_l", get_warren_files, load_warren_files)
 
 def modify_delta_l(l, delta_l, lattice_parameter, average_lattice_parameter):
     return delta_l - (average_lattice_parameter/lattice_parameter -1)*l
@@ -609,16 +1464,14 @@ def im_warren_strain(s_hkl, delta_l):
 
 def strain_warren_function(L, h, k, l, lattice_parameter, average_lattice_parameter):
     hkl = str(h) + str(k) + str(l)
-    
-    if hkl not in delta_l_dict.keys():
+    warren_delta_l = reference_data.get("warren_delta_l")
+
+    if hkl not in warren_delta_l.keys():
         return numpy.ones(len(L)), numpy.zeros(len(L))
     
-    delta_l_entry = delta_l_dict[hkl]
-    delta_l2_entry = delta_l2_dict[hkl]
-
-    l_local  = delta_l_entry[0]
-    delta_l  = delta_l_entry[1]
-    delta_l2 = delta_l2_entry[1]
+    l_local  = warren_delta_l[hkl][:, 0]
+    delta_l  = warren_delta_l[hkl][:, 1]
+    delta_l2 = warren_delta_l[hkl][:, 2]
 
     new_delta_l  = modify_delta_l(l_local, delta_l, lattice_parameter, average_lattice_parameter)
     new_delta_l2 = modify_delta_l2(l_local, delta_l, delta_l2, lattice_parameter, average_lattice_parameter)
@@ -634,34 +1487,23 @@ def strain_warren_function(L, h, k, l, lattice_parameter, average_lattice_parame
 # STRUCTURE
 ######################################################################
 
-def load_atomic_scattering_factor_coefficients():
-    atomic_scattering_factor_coefficients = {}
-
-    path = os.path.join(resources.package_dirname("orangecontrib.xrdanalyzer.controller.fit"), "data")
-    file_name = os.path.join(path, "atomic_scattering_factor_coefficients.dat")
-
-    file = open(file_name, "r")
-    rows = file.readlines()
-    for row in rows:
-        tokens = numpy.array(row.strip().split(sep=" "))
-        tokens = tokens[numpy.where(tokens != '')]
-
-        if not tokens is None and len(tokens) == 10:
-            element = tokens[0].strip()
+def get_atomic_scattering_factor_files():
+    return [os.path.join(get_data_directory(), "atomic_scattering_factor_coefficients.dat")]
 
-            coefficients =[[[float(tokens[1].strip()), float(tokens[2].strip())],
-                            [float(tokens[3].strip()), float(tokens[4].strip())],
-                            [float(tokens[5].strip()), float(tokens[6].strip())],
-                            [float(tokens[7].strip()), float(tokens[8].strip())]],
-                           float(tokens[9].strip())]
+def load_atomic_scattering_factor_coefficients(file_names):
+    # element -> a1, b1, a2, b2, a3, b3, a4, b4, c
+    atomic_scattering_factor_coefficients = {}
 
-            atomic_scattering_factor_coefficients[element] = coefficients
+    with open(file_names[0], "r") as file:
+        for row in file.readlines():
+            tokens = row.split()
 
-    file.close()
+            if len(tokens) == 10:
+                atomic_scattering_factor_coefficients[tokens[0]] = numpy.array([float(token) for token in tokens[1:]])
 
     return atomic_scattering_factor_coefficients
 
-atomic_scattering_factor_coefficients = load_atomic_scattering_factor_coefficients()
+reference_data.register("atomic_scattering_factor_coefficients", get_atomic_scattering_factor_files, load_atomic_scattering_factor_coefficients)
 
 def multiplicity_cubic(h, k, l):
     p = [6, 12, 24, 8, 24, 48]
@@ -682,23 +1524,21 @@ def multiplicity_cubic(h, k, l):
         return p[5]
 
 def atomic_scattering_factor(s, element):
-    coefficients = atomic_scattering_factor_coefficients[str(element).upper()]
-    ab = coefficients[0]
-    c = coefficients[1]
+    # all the values of s at once: sum of the 4 gaussians a*exp(-b*(s/2)^2), s in angstrom-1
+    coefficients = reference_data.get("atomic_scattering_factor_coefficients")[str(element).upper()]
+    ab = coefficients[0:8].reshape((4, 2))
+    c = coefficients[8]
 
-    f_s = numpy.zeros(numpy.size(s))
-    s_angstrom = s/10 # to angstrom-1
-    for index in range(0, len(ab)):
-        a = ab[index][0]
-        b = ab[index][1]
+    s_angstrom = numpy.atleast_1d(numpy.asarray(s, dtype=float))/10 # to angstrom-1
 
-        f_s += a*numpy.exp(-b*((0.5*s_angstrom)**2))
+    f_s = numpy.dot(ab[:, 0], numpy.exp(-numpy.outer(ab[:, 1], (0.5*s_angstrom)**2)))
 
     # TODO: AGGIUNGERE DFi e DFii
 
     return f_s + c
 
 def structure_factor(s, formula, h, k, l, symmetry=Symmetry.FCC):
+    # s, h, k, l: scalars or arrays, one value for each reflection
     elements = ChemicalFormulaParser.parse_formula(formula)
 
     if len(elements) == 1: #TODO: this is valid for Cubic materials only
@@ -711,19 +1551,15 @@ def structure_factor(s, formula, h, k, l, symmetry=Symmetry.FCC):
     else:
         total_weight = 0.0
         total_structure_factor = 0.0
-        cell = get_cell(symmetry)
+
+        # sum of the phases of the atoms of the cell, the same for all the elements
+        phases = numpy.sum(numpy.exp(2 * numpy.pi * 1j * numpy.dot(get_cell(symmetry), [h, k, l])), axis=0)
 
         for element in elements:
             weight = element._n_atoms
 
-            element_structure_factor = 0.0
-
-            for atom in cell:
-                element_structure_factor += atomic_scattering_factor(s, element._element) * numpy.exp(2 * numpy.pi * 1j * (numpy.dot(atom, [h, k ,l])))
-            element_structure_factor *= weight
-
             total_weight += weight
-            total_structure_factor += element_structure_factor
+            total_structure_factor += weight*atomic_scattering_factor(s, element._element)*phases
 
         total_structure_factor /= total_weight
 
@@ -816,22 +1652,46 @@ def instrumental_function (L, h, k, l, lattice_parameter, wavelength, U, V, W, a
 # BACKGROUND
 ######################################################################
 
+# the backgrounds are linear combinations of basis functions of the experimental points: the bases are calculated
+# once for each grid (the points do not change during a fit) and the evaluation is a matrix-vector product, whose
+# rows are also the exact derivatives with respect to the linear coefficients
+
 def add_chebyshev_background(x, I, parameters=[0, 0, 0, 0, 0, 0, 0, 0, 0, 0]):
-    degree = len(parameters)
-    bkg = numpy.zeros(len(x))
-    T = numpy.zeros((len(x), degree))
+    if component_cache.enabled and not component_cache.get_grid_key(x) is None:
+        I += numpy.dot(parameters, get_chebyshev_basis(x, len(parameters)))
+    else:
+        I += chebyshev_clenshaw(x, parameters)
+
+def get_chebyshev_basis(x, degree=10):
+    # rows: T_j(x), j = 0 ... degree-1
+    def basis():
+        T = numpy.zeros((degree, len(x)))
+
+        for j in range(degree):
+            if j==0:
+                T[j, :] = 1
+            elif j==1:
+                T[j, :] = x
+            else:
+                T[j, :] = 2*x*T[j-1, :] - T[j-2, :]
 
-    for j in range(degree):
-        if j==0:
-            T[:, j] = 1
-        elif j==1:
-            T[:, j] = x
-        else:
-            T[:, j] = 2*x*T[:, j-1] - T[:, j-2]
+        return T
 
-        bkg += parameters[j]*T[:, j]
+    grid_key = component_cache.get_grid_key(x)
 
-    I += bkg
+    if grid_key is None: return basis()
+    else: return component_cache.get("background", (grid_key, "chebyshev", degree), basis)
+
+def chebyshev_clenshaw(x, parameters):
+    # sum of c_j*T_j(x) without the basis, for the points not belonging to a grid of the fit
+    x = numpy.asarray(x, dtype=float)
+    b1 = numpy.zeros(len(x))
+    b2 = numpy.zeros(len(x))
+
+    for c_j in parameters[:0:-1]:
+        b1, b2 = c_j + 2*x*b1 - b2, b1
+
+    return parameters[0] + x*b1 - b2
 
 def add_polynomial_background(x, I, parameters=[0, 0, 0, 0, 0, 0]):
     degree = len(parameters)
@@ -866,16 +1726,21 @@ def add_polynomial_0N_background(x, I, parameters=[0, 0, 0, 0, 0, 0]):
     I += bkg
 
 def add_expdecay_background(x, I, parameters=[0, 0, 0, 0, 0, 0]):
-    degree = len(parameters)
-    bkg = numpy.zeros(len(x))
+    n_terms = int(len(parameters)/2 - 1)
 
-    for j in range(0, int(degree/2 - 1)):
-        a_i = parameters[2*j]
-        b_i = parameters[2*j+1]
+    if n_terms > 0:
+        I += numpy.dot(parameters[0:2*n_terms:2], get_expdecay_basis(x, parameters[1:2*n_terms:2]))
 
-        bkg += a_i*numpy.exp(-numpy.abs(x)*b_i)
+def get_expdecay_basis(x, b):
+    # rows: exp(-|x|*b_i), for the decay constants b_i: cached for each grid and set of constants (the constants
+    # are the same for all the evaluations of the other parameters)
+    def basis():
+        return numpy.exp(-numpy.outer(b, numpy.abs(x)))
 
-    I += bkg
+    grid_key = component_cache.get_grid_key(x)
+
+    if grid_key is None: return basis()
+    else: return component_cache.get("background", (grid_key, "expdecay", tuple(b)), basis)
 
 def add_expdecay_0_background(x, I, parameters=[0, 0, 0, 0, 0, 0]):
     degree = len(parameters)
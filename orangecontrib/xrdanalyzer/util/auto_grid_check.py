@@ -0,0 +1,103 @@
+"""
+the automatic FFT grid on an Examples workflow: the fit with the automatic grid reaches the wss of the fit on the grid
+saved in the workflow, and its grids give no invalid diffraction angles (s_hkl + s_max beyond 2/wavelength)
+
+    python -m orangecontrib.xrdanalyzer.util.auto_grid_check [--workflow FILE] [--fitter NODE_ID] [--iterations N] [--margin RELATIVE]
+
+exit status 1 when the final wss of the automatic grid is over the one of the saved grid by more than the margin, or
+with invalid values in the model
+"""
+import os, sys, time, argparse, warnings
+
+from orangecontrib.xrdanalyzer.controller.fit.fitter_factory import FitterFactory, FitterName
+from orangecontrib.xrdanalyzer.util.fit_benchmark import Workflow, Silence, build_fit_global_parameters, DEFAULT_WORKFLOW, DEFAULT_FITTER
+
+DEFAULT_MARGIN = 1e-3
+
+def run_fit(fit_global_parameters, fitter_name, n_iterations):
+    """
+    seconds, wss of each iteration, final grid (s_max, n_step) and number of invalid-value warnings of the model
+    """
+    fit_global_parameters = fit_global_parameters.duplicate()
+    fit_global_parameters.set_n_max_iterations(n_iterations)
+    fit_global_parameters.set_convergence_reached(False)
+
+    wss = []
+
+    stdout, sys.stdout = sys.stdout, Silence()
+
+    try:
+        with warnings.catch_warnings(record=True) as caught_warnings:
+            warnings.simplefilter("always", RuntimeWarning)
+
+            start_time = time.perf_counter()
+
+            fitter = FitterFactory.create_fitter(fitter_name=fitter_name)
+            fitter.init_fitter(fit_global_parameters.duplicate())
+
+            for iteration in range(1, n_iterations + 1):
+                _, fit_global_parameters, fit_data = fitter.do_fit(current_fit_global_parameters=fit_global_parameters,
+                                                                   current_iteration=iteration)
+                wss.append(fit_data.wss)
+
+                if fit_global_parameters.is_convergence_reached(): break
+
+            fit_time = time.perf_counter() - start_time
+            fitter.finalize_fit()
+    finally:
+        sys.stdout = stdout
+
+    # e.g. arcsin(s*wavelength/2) of the rows of the peaks beyond 2/wavelength
+    invalid_values = len([warning for warning in caught_warnings if "invalid value" in str(warning.message)])
+
+    fft_parameters = fitter.fit_global_parameters.fit_initialization.fft_parameters
+
+    return fit_time, wss, (fft_parameters.s_max, fft_parameters.n_step), invalid_values
+
+def run_check(workflow_file=DEFAULT_WORKFLOW, fitter_node=DEFAULT_FITTER, n_iterations=None, margin=DEFAULT_MARGIN):
+    workflow = Workflow(workflow_file)
+    fit_global_parameters = build_fit_global_parameters(workflow, fitter_node)
+
+    fitter_settings = workflow.settings[fitter_node]
+
+    if n_iterations is None: n_iterations = fitter_settings["n_iterations"]
+    fitter_name = FitterName.tuple()[fitter_settings["fitter_name"]]
+
+    fit_global_parameters.free_output_parameters.parse_formulas(fitter_settings["free_output_parameters_text"])
+    fit_global_parameters.evaluate_functions()
+
+    fft_parameters = fit_global_parameters.fit_initialization.fft_parameters
+
+    print(os.path.basename(workflow_file) + ", Fitter node " + str(fitter_node) + ": " + str(n_iterations) + " iterations of " + fitter_name +
+          ", automatic grid tolerance " + str(fft_parameters.auto_tolerance))
+
+    results = {}
+    for auto_grid in [False, True]:
+        fft_parameters.auto_grid = auto_grid
+
+        fit_time, wss, (s_max, n_step), invalid_values = run_fit(fit_global_parameters, fitter_name, n_iterations)
+
+        results[auto_grid] = [wss[-1], invalid_values]
+
+        print("  " + ("automatic grid" if auto_grid else "saved grid    ") + ": " + str(round(fit_time, 2)) + " s, s_max " + str(s_max) + ", n_step " + str(n_step) +
+              ", wss " + " ".join([str(round(value, 1)) for value in wss]) + ("" if invalid_values == 0 else ", INVALID VALUES: " + str(invalid_values)))
+
+    wss_fixed, _ = results[False]
+    wss_auto, invalid_values = results[True]
+
+    reached = wss_auto <= wss_fixed*(1 + margin)
+
+    if not reached: print("WSS NOT REACHED: automatic grid " + str(round(wss_auto, 1)) + ", saved grid " + str(round(wss_fixed, 1)) + ", margin " + str(margin))
+
+    return reached and invalid_values == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fit of an Examples workflow with the automatic FFT grid against the saved grid")
+    parser.add_argument("--workflow", default=DEFAULT_WORKFLOW, help=".ows file, with its data in the same directory")
+    parser.add_argument("--fitter", default=DEFAULT_FITTER, help="node id of the Fitter")
+    parser.add_argument("--iterations", type=int, default=None, help="default: the ones of the Fitter")
+    parser.add_argument("--margin", type=float, default=DEFAULT_MARGIN, help="relative excess of the wss allowed to the automatic grid")
+
+    arguments = parser.parse_args()
+
+    sys.exit(0 if run_check(arguments.workflow, arguments.fitter, arguments.iterations, arguments.margin) else 1)
@@ -0,0 +1,94 @@
+"""
+accuracy of the series Clausen integral and of the exact Wilkens function f* (the default of f_star) against
+the adaptive quadrature of clausen_integral_quad, and continuity of f_star where its branches join
+(eta = F_STAR_EXPANSION_LIMIT and eta = 1).
+
+    python -m orangecontrib.xrdanalyzer.util.clausen_accuracy [--bound ERROR] [--points N]
+
+exit status 1 when an error is over the bound
+"""
+import sys, time, argparse, warnings
+
+import numpy
+
+from orangecontrib.xrdanalyzer.controller.fit.wppm_functions import clausen_integral, clausen_integral_quad, \
+    f_star, f_star_exact, F_STAR_EXPANSION_LIMIT
+
+DEFAULT_BOUND = 1e-10
+
+def get_clausen_points(n_points):
+    # a full period, the edges of the reduction to [0, pi] and points out of [0, 2*pi]
+    return numpy.concatenate([numpy.linspace(0.0, 2*numpy.pi, n_points + 1)[1:-1],
+                              [1e-8, 1e-3, numpy.pi - 1e-9, numpy.pi + 1e-9, 2*numpy.pi - 1e-3, 7.0, -1.0]])
+
+def get_quadrature(x):
+    # the integrand is singular at 0 and 2*pi: the warnings of quad near them are expected
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+
+        return clausen_integral_quad(x)
+
+def check_clausen_integral(n_points=2000):
+    """
+    max absolute difference of Cl2 from the quadrature, seconds of the series and of the quadrature
+    """
+    x = get_clausen_points(n_points)
+
+    start_time = time.perf_counter()
+    series = clausen_integral(x)
+    series_time = time.perf_counter() - start_time
+
+    # the integrand of the quadrature is real on [0, 2*pi) only: the reference of the others is the periodic one
+    start_time = time.perf_counter()
+    quadrature = get_quadrature(numpy.mod(x, 2*numpy.pi))
+    quadrature_time = time.perf_counter() - start_time
+
+    return numpy.max(numpy.abs(series - quadrature)), series_time, quadrature_time
+
+def check_f_star(n_points=2000):
+    """
+    max relative difference of the exact f* from the one with the quadrature, on the points of its branch
+    """
+    eta = numpy.linspace(F_STAR_EXPANSION_LIMIT, 1.0, n_points + 1)[:-1]
+
+    series = f_star_exact(eta)
+    quadrature = f_star_exact(eta, clausen_function=get_quadrature)
+
+    return numpy.max(numpy.abs(series - quadrature)/numpy.abs(quadrature))
+
+def check_f_star_branches(epsilon=1e-12):
+    """
+    relative jumps of f_star across the limit of the expansion and across eta = 1
+    """
+    def jump(eta):
+        below, above = f_star(numpy.array([eta*(1 - epsilon), eta*(1 + epsilon)]))
+
+        return abs(above - below)/abs(above)
+
+    return jump(F_STAR_EXPANSION_LIMIT), jump(1.0)
+
+def run_check(bound=DEFAULT_BOUND, n_points=2000):
+    clausen_error, series_time, quadrature_time = check_clausen_integral(n_points)
+    f_star_error = check_f_star(n_points)
+    expansion_jump, eta_1_jump = check_f_star_branches()
+
+    errors = [["Cl2, max absolute difference from the quadrature", clausen_error],
+              ["exact f*, max relative difference from the quadrature", f_star_error],
+              ["f*, relative jump at eta = " + str(F_STAR_EXPANSION_LIMIT), expansion_jump],
+              ["f*, relative jump at eta = 1", eta_1_jump]]
+
+    for text, error in errors:
+        print(("OVER BOUND: " if error > bound else "") + text + ": " + "{:.1e}".format(error))
+
+    print("Cl2 on " + str(n_points) + " points: series " + str(round(1000*series_time, 2)) + " ms, quadrature " + str(round(1000*quadrature_time, 1)) + " ms, bound: " + "{:.1e}".format(bound))
+
+    return all([error <= bound for _, error in errors])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="accuracy of the Clausen integral and of the exact f* against the quadrature")
+    parser.add_argument("--bound", type=float, default=DEFAULT_BOUND, help="max error")
+    parser.add_argument("--points", type=int, default=2000)
+
+    arguments = parser.parse_args()
+
+    sys.exit(0 if run_check(arguments.bound, arguments.points) else 1)
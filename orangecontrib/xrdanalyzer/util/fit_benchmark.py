@@ -0,0 +1,318 @@
+"""
+time and memory of a fit of the Examples workflows without the Orange canvas: the widgets upstream of a Fitter are
+rebuilt from the settings saved in the workflow, and the fit runs as in the Fitter widget, twice:
+
+    snapshot:  the snapshot published by the fitter comes back as the input of the next iteration (Fitter widget)
+    duplicate: a duplicate of it comes back, so the fitter starts every iteration from a new object (as before the
+               snapshots)
+
+    python -m orangecontrib.xrdanalyzer.util.fit_benchmark [--workflow FILE] [--fitter NODE_ID] [--iterations N]
+
+exit status 1 when the two runs do not give the same fitted parameters
+"""
+import os, sys, ast, time, argparse, tracemalloc
+import xml.etree.ElementTree as ElementTree
+
+import numpy
+
+from orangecontrib.xrdanalyzer.controller.fit.fit_parameter import FitParameter, Boundary, PARAM_HWMIN, PARAM_HWMAX
+from orangecontrib.xrdanalyzer.controller.fit.fit_global_parameters import FitGlobalParameters
+from orangecontrib.xrdanalyzer.controller.fit.fitter_factory import FitterFactory, FitterName
+from orangecontrib.xrdanalyzer.controller.fit.init.fit_initialization import FitInitialization
+from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import FFTInitParameters
+from orangecontrib.xrdanalyzer.controller.fit.init.crystal_structure import CrystalStructure
+from orangecontrib.xrdanalyzer.controller.fit.init.crystal_structure_symmetry import Symmetry
+from orangecontrib.xrdanalyzer.controller.fit.instrument.instrumental_parameters import Caglioti, Lab6TanCorrection, ZeroError
+from orangecontrib.xrdanalyzer.controller.fit.instrument.background_parameters import ChebyshevBackground
+from orangecontrib.xrdanalyzer.controller.fit.microstructure.size import SizeParameters, Shape, Distribution
+from orangecontrib.xrdanalyzer.model.diffraction_pattern import DiffractionPattern, DiffractionPatternFactory, DiffractionPatternLimits
+
+EXAMPLES_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))), "Examples")
+
+DEFAULT_WORKFLOW = os.path.join(EXAMPLES_DIRECTORY, "FeMo_PM2K.ows")
+DEFAULT_FITTER = "7" # the first Fitter of FeMo_PM2K.ows
+
+###############################################
+#
+# WORKFLOW
+#
+###############################################
+
+class Workflow:
+    """
+    nodes (id -> widget class name), their settings (id -> dictionary) and their input (id -> id of the upstream node)
+    of an .ows file
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+        scheme = ElementTree.parse(file_name).getroot()
+
+        self.nodes = {node.get("id"): node.get("qualified_name").split(".")[-1] for node in scheme.iter("node")}
+        self.inputs = {link.get("sink_node_id"): link.get("source_node_id") for link in scheme.iter("link")}
+        self.settings = {}
+
+        for properties in scheme.iter("properties"):
+            if properties.get("format") != "literal": raise ValueError("Settings of node " + properties.get("node_id") + " are not literal: they cannot be read without the canvas")
+
+            self.settings[properties.get("node_id")] = ast.literal_eval(properties.text)
+
+    def get_upstream_nodes(self, node_id):
+        # from the first widget of the workflow to the one before node_id
+        nodes = []
+
+        while node_id in self.inputs:
+            node_id = self.inputs[node_id]
+            nodes.insert(0, node_id)
+
+        return nodes
+
+def get_setting(settings, name, index=0):
+    # the widgets of more diffraction patterns keep a list of values for each setting
+    value = settings[name]
+
+    return value[index] if isinstance(value, list) else value
+
+def populate_parameter(settings, parameter_name, parameter_prefix, index=0):
+    """
+    fit parameter of a widget setting, as OWGenericWidget.populate_parameter_in_widget
+    """
+    def setting(suffix=""): return get_setting(settings, parameter_name + suffix, index)
+
+    if setting("_function") == 1:
+        return FitParameter(parameter_name=parameter_prefix + parameter_name, function=True, function_value=setting("_function_value"))
+    elif setting("_fixed") == 1:
+        return FitParameter(parameter_name=parameter_prefix + parameter_name, value=setting(), fixed=True)
+    else:
+        min_value = setting("_min") if setting("_has_min") == 1 else PARAM_HWMIN
+        max_value = setting("_max") if setting("_has_max") == 1 else PARAM_HWMAX
+
+        boundary = None if (min_value == PARAM_HWMIN and max_value == PARAM_HWMAX) else Boundary(min_value=min_value, max_value=max_value)
+
+        return FitParameter(parameter_name=parameter_prefix + parameter_name, value=setting(), boundary=boundary)
+
+###############################################
+#
+# WIDGETS
+#
+###############################################
+
+# each function changes the fit global parameters as the widget does when it sends them
+
+def build_diffraction_patterns(workflow, settings, fit_global_parameters):
+    diffraction_patterns = []
+
+    for index in range(len(settings["filename"])):
+        if get_setting(settings, "is_multiple_wavelength", index) == 1: raise ValueError("Multiple wavelengths are not supported")
+
+        twotheta_has_min = get_setting(settings, "twotheta_has_min", index) == 1
+        twotheta_has_max = get_setting(settings, "twotheta_has_max", index) == 1
+
+        limits = DiffractionPatternLimits(twotheta_min=get_setting(settings, "twotheta_min", index) if twotheta_has_min else -numpy.inf,
+                                          twotheta_max=get_setting(settings, "twotheta_max", index) if twotheta_has_max else numpy.inf) \
+            if twotheta_has_min or twotheta_has_max else None
+
+        # the saved paths are the ones of the authors: the data are next to the workflow
+        file_name = os.path.join(os.path.dirname(workflow.file_name), os.path.basename(get_setting(settings, "filename", index)))
+
+        diffraction_patterns.append(DiffractionPatternFactory.create_diffraction_pattern_from_file(file_name,
+                                                                                                   populate_parameter(settings, "wavelength", DiffractionPattern.get_parameters_prefix() + str(index+1) + "_", index),
+                                                                                                   limits))
+
+    return FitGlobalParameters(fit_initialization=FitInitialization(diffraction_patterns=diffraction_patterns))
+
+def build_fft_parameters(workflow, settings, fit_global_parameters):
+    fit_global_parameters.fit_initialization.fft_parameters = FFTInitParameters(s_max=settings["s_max"],
+                                                                                n_step=int(settings["n_step"]),
+                                                                                fft_type=settings["fft_type"])
+
+    return fit_global_parameters
+
+def build_crystal_structures(workflow, settings, fit_global_parameters):
+    fit_global_parameters.fit_initialization.crystal_structures = []
+
+    for index in range(len(settings["a"])):
+        progressive = str(index+1) + "_"
+        prefix = CrystalStructure.get_parameters_prefix() + progressive
+        use_structure = get_setting(settings, "use_structure", index) == 1
+
+        crystal_structure = CrystalStructure.init_cube(a0=populate_parameter(settings, "a", prefix, index),
+                                                       symmetry=Symmetry.tuple()[get_setting(settings, "symmetry", index)],
+                                                       use_structure=use_structure,
+                                                       formula=get_setting(settings, "formula", index) if use_structure else None,
+                                                       intensity_scale_factor=populate_parameter(settings, "intensity_scale_factor", prefix, index) if use_structure else None,
+                                                       progressive=progressive)
+
+        fit_global_parameters.fit_initialization.crystal_structures.append(crystal_structure)
+        fit_global_parameters.evaluate_functions()
+
+        crystal_structure.parse_reflections(get_setting(settings, "reflections", index), progressive=progressive)
+
+        if use_structure:
+            for reflection in crystal_structure.get_reflections(): reflection.intensity.fixed = True
+
+    return fit_global_parameters
+
+def build_instrumental_profile(workflow, settings, fit_global_parameters):
+    fit_global_parameters.instrumental_parameters = [Caglioti(*[populate_parameter(settings, name, Caglioti.get_parameters_prefix())
+                                                                for name in ["U", "V", "W", "a", "b", "c"]])]
+
+    return fit_global_parameters
+
+def build_calibration_peak_shift(workflow, settings, fit_global_parameters):
+    fit_global_parameters.set_shift_parameters([Lab6TanCorrection(*[populate_parameter(settings, name, Lab6TanCorrection.get_parameters_prefix())
+                                                                    for name in ["ax", "bx", "cx", "dx", "ex"]])])
+
+    return fit_global_parameters
+
+def build_zero_error_peak_shift(workflow, settings, fit_global_parameters):
+    fit_global_parameters.set_shift_parameters([ZeroError(shift=populate_parameter(settings, "shift", ZeroError.get_parameters_prefix()))])
+
+    return fit_global_parameters
+
+def build_chebyshev_background(workflow, settings, fit_global_parameters):
+    fit_global_parameters.set_background_parameters([ChebyshevBackground(*[populate_parameter(settings, "c" + str(i), ChebyshevBackground.get_parameters_prefix(), index)
+                                                                           for i in range(10)])
+                                                     for index in range(len(settings["c0"]))])
+
+    return fit_global_parameters
+
+def build_size(workflow, settings, fit_global_parameters):
+    distribution = Distribution.tuple()[settings["distribution"]]
+
+    fit_global_parameters.size_parameters = [SizeParameters(shape=Shape.tuple()[settings["shape"]],
+                                                            distribution=distribution,
+                                                            mu=populate_parameter(settings, "mu", SizeParameters.get_parameters_prefix()),
+                                                            sigma=None if distribution == Distribution.DELTA else populate_parameter(settings, "sigma", SizeParameters.get_parameters_prefix()),
+                                                            add_saxs=settings["add_saxs"] if distribution == Distribution.DELTA else False)]
+
+    return fit_global_parameters
+
+def pass_fitter(workflow, settings, fit_global_parameters):
+    # a Fitter upstream sends its fitted parameters: here they go on with their initial values
+    return fit_global_parameters
+
+WIDGETS = {"OWDiffractionPattern": build_diffraction_patterns,
+           "OWFFTParameters": build_fft_parameters,
+           "OWCrystalStructure": build_crystal_structures,
+           "OWInstrumentalProfile": build_instrumental_profile,
+           "OWCalibrationPeakShift": build_calibration_peak_shift,
+           "OWZeroErrorPeakShift": build_zero_error_peak_shift,
+           "OWChebyshevBackground": build_chebyshev_background,
+           "OWSize": build_size,
+           "OWFitter": pass_fitter}
+
+def build_fit_global_parameters(workflow, fitter_node):
+    """
+    fit global parameters received by the Fitter widget fitter_node
+    """
+    if workflow.nodes.get(fitter_node) != "OWFitter": raise ValueError("Node " + str(fitter_node) + " is not a Fitter")
+
+    fit_global_parameters = None
+
+    for node_id in workflow.get_upstream_nodes(fitter_node):
+        widget = workflow.nodes[node_id]
+
+        if not widget in WIDGETS: raise ValueError("Widget " + widget + " (node " + node_id + ") is not supported")
+
+        fit_global_parameters = WIDGETS[widget](workflow, workflow.settings[node_id], fit_global_parameters)
+
+    return fit_global_parameters
+
+###############################################
+#
+# BENCHMARK
+#
+###############################################
+
+class Silence:
+    # the fitters print their progress
+    def write(self, text): pass
+    def flush(self): pass
+
+def run_fit(fit_global_parameters, fitter_name, n_iterations, use_snapshots=True):
+    """
+    fit as the Fitter widget does: seconds, model evaluations, peak of the traced memory (bytes), fitted parameters
+    """
+    fit_global_parameters = fit_global_parameters.duplicate()
+    fit_global_parameters.set_n_max_iterations(n_iterations)
+    fit_global_parameters.set_convergence_reached(False)
+
+    stdout, sys.stdout = sys.stdout, Silence()
+    tracemalloc.start()
+
+    try:
+        start_time = time.perf_counter()
+
+        fitter = FitterFactory.create_fitter(fitter_name=fitter_name)
+        fitted_fit_global_parameters = fit_global_parameters.duplicate()
+        fitter.init_fitter(fitted_fit_global_parameters)
+
+        for iteration in range(1, n_iterations + 1):
+            if not use_snapshots: fitted_fit_global_parameters = fitted_fit_global_parameters.duplicate()
+
+            _, fitted_fit_global_parameters, _ = fitter.do_fit(current_fit_global_parameters=fitted_fit_global_parameters,
+                                                               current_iteration=iteration)
+
+            if fitted_fit_global_parameters.is_convergence_reached(): break
+
+        fit_time = time.perf_counter() - start_time
+        fitter.finalize_fit()
+
+        _, peak_memory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+        sys.stdout = stdout
+
+    return fit_time, fitter.model_cache_misses, peak_memory, numpy.array([parameter.value for parameter in fitted_fit_global_parameters.get_parameters()])
+
+def get_copy_time(fit_global_parameters, copy, repeat=100):
+    start_time = time.perf_counter()
+    for _ in range(repeat): copy(fit_global_parameters)
+
+    return (time.perf_counter() - start_time)/repeat
+
+def run_benchmark(workflow_file=DEFAULT_WORKFLOW, fitter_node=DEFAULT_FITTER, n_iterations=None):
+    workflow = Workflow(workflow_file)
+    fit_global_parameters = build_fit_global_parameters(workflow, fitter_node)
+
+    fitter_settings = workflow.settings[fitter_node]
+
+    if n_iterations is None: n_iterations = fitter_settings["n_iterations"]
+    fitter_name = FitterName.tuple()[fitter_settings["fitter_name"]]
+
+    fit_global_parameters.free_output_parameters.parse_formulas(fitter_settings["free_output_parameters_text"])
+    fit_global_parameters.evaluate_functions()
+
+    print(os.path.basename(workflow_file) + ", Fitter node " + str(fitter_node) + ": " +
+          " + ".join([str(diffraction_pattern.diffraction_points_count()) for diffraction_pattern in fit_global_parameters.fit_initialization.diffraction_patterns]) + " points, " +
+          str(len([parameter for parameter in fit_global_parameters.get_parameters() if parameter.is_variable()])) + " free parameters, " +
+          str(n_iterations) + " iterations of " + fitter_name)
+
+    results = {}
+    for use_snapshots in [False, True]:
+        fit_time, evaluations, peak_memory, values = run_fit(fit_global_parameters, fitter_name, n_iterations, use_snapshots)
+
+        results[use_snapshots] = values
+
+        print("  " + ("snapshot " if use_snapshots else "duplicate") + ": " + str(round(fit_time, 2)) + " s, " + str(evaluations) + " model evaluations, peak traced memory " + str(round(peak_memory/1e6, 1)) + " MB")
+
+    print("  copy of the fit global parameters: duplicate() " + str(round(1000*get_copy_time(fit_global_parameters, FitGlobalParameters.duplicate), 3)) + " ms, " +
+          "snapshot() " + str(round(1000*get_copy_time(fit_global_parameters, FitGlobalParameters.snapshot), 3)) + " ms")
+
+    same_result = numpy.array_equal(results[False], results[True])
+
+    if not same_result: print("DIFFERENT RESULTS: max difference of the fitted parameters " + str(numpy.max(numpy.abs(results[False] - results[True]))))
+
+    return same_result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="time and memory of a fit of an Examples workflow without the canvas")
+    parser.add_argument("--workflow", default=DEFAULT_WORKFLOW, help=".ows file, with its data in the same directory")
+    parser.add_argument("--fitter", default=DEFAULT_FITTER, help="node id of the Fitter")
+    parser.add_argument("--iterations", type=int, default=None, help="default: the ones of the Fitter")
+
+    arguments = parser.parse_args()
+
+    sys.exit(0 if run_benchmark(arguments.workflow, arguments.fitter, arguments.iterations) else 1)
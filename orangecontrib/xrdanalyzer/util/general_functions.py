@@ -1,5 +1,8 @@
 import numpy
 import inspect
+import threading
+from functools import lru_cache
+from dataclasses import dataclass
 
 def distance(X, Y):
     return numpy.linalg.norm(X-Y)
@@ -18,18 +21,34 @@ def attributes_of_a_point (myClass):
 
     return [attr[3], attr[1], attr[0], attr[2]]
 
+# immutable: the same records are returned by all the calls of ChemicalFormulaParser.parse_formula
+@dataclass(frozen=True)
 class ElementInFormula(object):
-    def __init__(self, element, atomic_number, n_atoms, molecular_weight):
-        self._element = element
-        self._atomic_number = atomic_number
-        self._n_atoms = n_atoms
-        self._molecular_weight = molecular_weight
+    _element: str
+    _atomic_number: int
+    _n_atoms: float
+    _molecular_weight: float
+
+    def __repr__(self):
+        return "ElementInFormula(" + self._element + ", " + str(self._n_atoms) + ")"
 
 class ChemicalFormulaParser(object):
 
     @classmethod
     def parse_formula(cls, formula):
-        return parse(formula).getsyms()
+        """
+        tuple of the elements of the formula (ElementInFormula), memoized: the model evaluates the same formulas
+        at every call
+        """
+        return _parse_formula(formula)
+
+# the parser keeps its state in module globals
+_parse_lock = threading.Lock()
+
+@lru_cache(maxsize=256)
+def _parse_formula(formula):
+    with _parse_lock:
+        return tuple(parse(formula).getsyms())
 
 ###################################
 
@@ -159,12 +178,19 @@ class Element:
 def build_dict(s):
     answer = {}
     for line in s.split("\n"):
-        symbol, name, num, weight = eval(line)
-        answer[symbol] = Element(symbol, name, num, weight)
+        symbol, name, num, weight = [token.strip().strip("'") for token in line.split(",")]
+        answer[symbol] = Element(symbol, name, int(num), float(weight))
     return answer
 
-sym2elt = build_dict(_data)
-del _data
+@lru_cache(maxsize=1)
+def get_element_table():
+    # symbol -> Element, built at the first use
+    return build_dict(_data)
+
+def __getattr__(name):
+    if name == "sym2elt": return get_element_table()
+
+    raise AttributeError("module " + __name__ + " has no attribute " + name)
 
 class ElementSequence:
     def __init__(self, *seq):
@@ -197,16 +223,18 @@ class ElementSequence:
         #items = sorted(result.items())
 
         for sym, count in result.items():
-            print (sym, "(" + sym2elt[sym].name + "):", count)
+            print (sym, "(" + get_element_table()[sym].name + "):", count)
 
     def getsyms(self):
         result = {}
         self.addsyms(1, result)
         items = sorted(result.items())
 
+        element_table = get_element_table()
+
         result = []
         for sym, count in items:
-            result.append (ElementInFormula(sym, sym2elt[sym].ano, count, sym2elt[sym].mw))
+            result.append (ElementInFormula(sym, element_table[sym].ano, count, element_table[sym].mw))
 
         return result
 
@@ -269,8 +297,8 @@ def parse_sequence():
             t.gettoken()
         else:
             assert ttype == NAME
-            if tvalue in sym2elt:
-                thisguy = ElementSequence(sym2elt[tvalue])
+            if tvalue in get_element_table():
+                thisguy = ElementSequence(get_element_table()[tvalue])
             else:
                 t.error("'" + tvalue + "' is not an element symbol")
             t.gettoken()
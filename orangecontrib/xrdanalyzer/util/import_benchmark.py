@@ -0,0 +1,79 @@
+"""
+import time of the fitting engine in headless mode: all the modules of the controller and model packages are
+imported in a new interpreter where the GUI packages cannot be imported, the best time of a few runs must be
+within the budget.
+
+    python -m orangecontrib.xrdanalyzer.util.import_benchmark [--budget SECONDS] [--repeat N]
+
+exit status 1 when a module needs a GUI package or the import is over the budget
+"""
+import sys, json, subprocess, argparse
+
+HEADLESS_PACKAGES = ["orangecontrib.xrdanalyzer.controller", "orangecontrib.xrdanalyzer.model"]
+GUI_PACKAGES = ["Orange", "PyQt5", "PyQt4", "silx", "matplotlib"]
+
+DEFAULT_BUDGET = 1.0 # seconds
+
+_IMPORT_SCRIPT = """
+import sys, json, time, importlib, pkgutil
+
+packages, blocked = json.loads(sys.argv[1])
+
+class GUIBlocker:
+    def find_spec(self, name, path=None, target=None):
+        if name.split(".")[0] in blocked: raise ImportError("headless mode: " + name + " cannot be imported")
+
+sys.meta_path.insert(0, GUIBlocker())
+
+start_time = time.perf_counter()
+failed = {}
+
+for package_name in packages:
+    package = importlib.import_module(package_name)
+
+    for module in pkgutil.walk_packages(package.__path__, package_name + "."):
+        try:
+            importlib.import_module(module.name)
+        except Exception as exception:
+            failed[module.name] = str(exception)
+
+print(json.dumps({"time": time.perf_counter() - start_time, "failed": failed}))
+"""
+
+def measure_import_time(packages=HEADLESS_PACKAGES, blocked=GUI_PACKAGES):
+    """
+    seconds to import the packages (all their modules) in a new interpreter, and the modules that failed
+    (module -> error)
+    """
+    output = subprocess.run([sys.executable, "-c", _IMPORT_SCRIPT, json.dumps([packages, blocked])],
+                            stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+    result = json.loads(output.strip().splitlines()[-1])
+
+    return result["time"], result["failed"]
+
+def run_benchmark(budget=DEFAULT_BUDGET, repeat=3):
+    times = []
+    failed = {}
+
+    for _ in range(repeat):
+        import_time, failed = measure_import_time()
+        times.append(import_time)
+
+    for module_name, error in failed.items():
+        print("NOT HEADLESS: " + module_name + " (" + error + ")")
+
+    best_time = min(times)
+
+    print("headless import: " + str(round(1000*best_time, 1)) + " ms (best of " + str(repeat) + "), budget: " + str(round(1000*budget, 1)) + " ms")
+
+    return len(failed) == 0 and best_time <= budget
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="import time of the controller and model packages without the GUI")
+    parser.add_argument("--budget", type=float, default=DEFAULT_BUDGET, help="seconds")
+    parser.add_argument("--repeat", type=int, default=3)
+
+    arguments = parser.parse_args()
+
+    sys.exit(0 if run_benchmark(arguments.budget, arguments.repeat) else 1)
@@ -0,0 +1,166 @@
+import os, threading, time, logging
+import importlib.resources
+
+import numpy
+
+log = logging.getLogger(__name__)
+
+def get_package_directory(package):
+    """
+    directory of the files of an installed (not zipped) package, found without the Orange canvas
+    """
+    return str(importlib.resources.files(package))
+
+class ReferenceTable:
+    """
+    a table of reference data: sources() lists its source files, parse(files) reads them into a dictionary of
+    numpy arrays (string keys)
+    """
+
+    def __init__(self, name, sources, parse):
+        self.name = name
+        self.sources = sources
+        self.parse = parse
+
+class ReferenceData:
+    """
+    registry of the reference tables of the package (atomic scattering factors, Warren tables, X-ray tube lines):
+    a table is loaded at its first use only, and kept in a binary cache (.npz) valid while its source files keep
+    their modification times. The time spent on each table is recorded, to profile a cold start.
+    """
+
+    CACHE_KEY = "__sources__"
+
+    def __init__(self, cache_directory=None, use_file_cache=True):
+        self.cache_directory = cache_directory
+        self.use_file_cache = use_file_cache
+
+        self._tables = {}
+        self._values = {}
+        self._lock = threading.RLock()
+
+        self.timings = {} # table name -> [seconds, "parsed" or "cache"]
+
+    def register(self, name, sources, parse):
+        with self._lock:
+            self._tables[name] = ReferenceTable(name, sources, parse)
+            self._values.pop(name, None)
+
+    def is_loaded(self, name):
+        return name in self._values
+
+    def get(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            with self._lock:
+                if not name in self._values:
+                    if not name in self._tables: raise KeyError("Reference table <" + name + "> not registered")
+
+                    self._values[name] = self._load(self._tables[name])
+
+                return self._values[name]
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+            self.timings = {}
+
+    def to_text(self):
+        text = "Reference data:\n"
+
+        for name, (seconds, origin) in self.timings.items():
+            text += "  " + name + ": " + str(round(1000*seconds, 2)) + " ms (" + origin + ")\n"
+
+        return text
+
+    def _load(self, table):
+        start_time = time.perf_counter()
+
+        files = sorted(table.sources())
+        key = "\n".join([file + " " + str(os.stat(file).st_mtime_ns) for file in files])
+        cache_file = self._get_cache_file(table.name)
+
+        value = self._read_cache(cache_file, key)
+
+        if value is None:
+            value = {name: numpy.asarray(array) for name, array in table.parse(files).items()}
+            origin = "parsed"
+
+            self._write_cache(cache_file, key, value)
+        else:
+            origin = "cache"
+
+        self.timings[table.name] = [time.perf_counter() - start_time, origin]
+
+        return value
+
+    def _get_cache_file(self, name):
+        if not self.use_file_cache: return None
+
+        cache_directory = self.cache_directory
+        if cache_directory is None:
+            cache_directory = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")), "orange3-wonder")
+
+        return os.path.join(cache_directory, name + ".npz")
+
+    # the arrays of a table are stored packed (names, dimensions, shapes, concatenated values): the tables have
+    # hundreds of small arrays, one member of the npz file for each of them would be slower to read than the text
+    # sources. The values are packed as float64 only, a table of other types is not cached.
+
+    def _read_cache(self, cache_file, key):
+        if cache_file is None or not os.path.exists(cache_file): return None
+
+        try:
+            with numpy.load(cache_file) as cache:
+                if str(cache[self.CACHE_KEY]) != key: return None
+
+                names, dimensions, shapes, data = cache["names"], cache["dimensions"], cache["shapes"], cache["data"]
+
+            value = {}
+            shape_start = data_start = 0
+
+            for name, dimension in zip(names, dimensions):
+                shape = tuple(shapes[shape_start:shape_start + dimension])
+                size = int(numpy.prod(shape, dtype=int))
+
+                value[str(name)] = data[data_start:data_start + size].reshape(shape)
+
+                shape_start += dimension
+                data_start += size
+
+            if data_start != len(data): raise ValueError("the values do not match the shapes")
+
+            return value
+        except Exception as exception:
+            # an unreadable cache (e.g. written by an older version) is parsed again and overwritten
+            log.warning("Reference data cache " + cache_file + " not readable, parsing the sources: " + str(exception))
+
+            return None
+
+    def _write_cache(self, cache_file, key, value):
+        if cache_file is None or len(value) == 0: return
+
+        try:
+            names = list(value.keys())
+
+            for name in names:
+                if value[name].dtype != numpy.float64:
+                    raise ValueError("array <" + name + "> is " + str(value[name].dtype) + ", only float64 tables are cached")
+
+            dimensions = numpy.array([value[name].ndim for name in names], dtype=int)
+            shapes = numpy.array([size for name in names for size in value[name].shape], dtype=int)
+            data = numpy.concatenate([value[name].ravel() for name in names])
+
+            os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+
+            # written aside and renamed: a concurrent reader never finds a partial file
+            temporary_file = cache_file + "." + str(os.getpid()) + ".tmp.npz"
+            numpy.savez(temporary_file, **{self.CACHE_KEY: numpy.array(key)}, names=numpy.array(names), dimensions=dimensions, shapes=shapes, data=data)
+            os.replace(temporary_file, cache_file)
+        except Exception as exception:
+            # the cache is optional (e.g. read-only or missing home directory): the table is used anyway
+            log.warning("Reference data cache " + str(cache_file) + " not written: " + str(exception))
+
+# the tables of the package, registered by the modules using them
+reference_data = ReferenceData()
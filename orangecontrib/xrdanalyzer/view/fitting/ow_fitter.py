@@ -2,7 +2,7 @@ import sys, numpy, os
 
 from PyQt5.QtWidgets import QMessageBox, QScrollArea, QApplication, QTableWidget, QHeaderView, QAbstractItemView, QTableWidgetItem, QFileDialog
 from PyQt5.QtCore import Qt, QMutex
-from PyQt5.QtGui import QColor, QFont, QTextCursor, QIntValidator
+from PyQt5.QtGui import QColor, QFont, QTextCursor, QIntValidator, QDoubleValidator
 
 from silx.gui.plot.PlotWindow import PlotWindow
 from silx.gui.plot.LegendSelector import LegendsDockWidget
@@ -16,12 +16,14 @@ from orangecontrib.xrdanalyzer.util.gui.gui_utility import gui, ConfirmDialog, E
 
 
 from orangecontrib.xrdanalyzer.controller.fit.fitter_factory import FitterFactory, FitterName
+from orangecontrib.xrdanalyzer.controller.fit.fitters.fitter_least_squares import LeastSquaresMethod, LeastSquaresJacobian
 
 from orangecontrib.xrdanalyzer.util import congruence
 from orangecontrib.xrdanalyzer.controller.fit.fit_parameter import PARAM_HWMAX, PARAM_HWMIN
 from orangecontrib.xrdanalyzer.controller.fit.fit_global_parameters import FitGlobalParameters, FreeOutputParameters
 from orangecontrib.xrdanalyzer.controller.fit.instrument.instrumental_parameters import SpecimenDisplacement
 from orangecontrib.xrdanalyzer.controller.fit.init.thermal_polarization_parameters import ThermalPolarizationParameters
+from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import PeakSynthesis
 from orangecontrib.xrdanalyzer.controller.fit.instrument.instrumental_parameters import Lab6TanCorrection
 from orangecontrib.xrdanalyzer.controller.fit.wppm_functions import caglioti_fwhm, caglioti_eta, delta_two_theta_lab6
 
@@ -40,6 +42,15 @@ class OWFitter(OWGenericWidget):
     fitting_method = Setting(0)
 
     n_iterations = Setting(5)
+    n_workers = Setting(1)
+    analytic_jacobian = Setting(0)
+    peak_synthesis = Setting(0)
+    multiresolution_stages = Setting(1)
+    multiresolution_stall = Setting(0.01)
+    least_squares_method = Setting(0)
+    least_squares_jacobian = Setting(0)
+    least_squares_x_scale = Setting(0)
+    least_squares_max_nfev = Setting(50)
     is_incremental = Setting(1)
     current_iteration = 0
     free_output_parameters_text = Setting("")
@@ -120,7 +131,16 @@ class OWFitter(OWGenericWidget):
 
         orangegui.separator(main_box)
 
-        self.cb_fitter = orangegui.comboBox(main_box, self, "fitter_name", label="Fit algorithm", items=FitterName.tuple(), orientation="horizontal")
+        self.cb_fitter = orangegui.comboBox(main_box, self, "fitter_name", label="Fit algorithm", items=FitterName.tuple(), orientation="horizontal", callback=self.set_fitter_name)
+
+        self.least_squares_box = gui.widgetBox(main_box, "", orientation="vertical", width=250)
+
+        orangegui.comboBox(self.least_squares_box, self, "least_squares_method", label="Method", items=LeastSquaresMethod.tuple(), orientation="horizontal")
+        orangegui.comboBox(self.least_squares_box, self, "least_squares_jacobian", label="Jacobian", items=LeastSquaresJacobian.tuple(), orientation="horizontal")
+        orangegui.checkBox(self.least_squares_box, self, "least_squares_x_scale", "Scale parameters by the Jacobian")
+        gui.lineEdit(self.least_squares_box, self, "least_squares_max_nfev", "Max evaluations per iteration", labelWidth=160, valueType=int, validator=QIntValidator(), orientation="horizontal")
+
+        self.set_fitter_name()
 
 
         iteration_box = gui.widgetBox(main_box, "", orientation="horizontal", width=250)
@@ -128,6 +148,19 @@ class OWFitter(OWGenericWidget):
         gui.lineEdit(iteration_box, self, "n_iterations", "Nr. Iterations", labelWidth=80, valueType=int, validator=QIntValidator())
         orangegui.checkBox(iteration_box, self, "is_incremental", "Incremental")
 
+        workers_box = gui.widgetBox(main_box, "", orientation="horizontal", width=250)
+
+        gui.lineEdit(workers_box, self, "n_workers", "Nr. Workers (Jacobian)", labelWidth=160, valueType=int, validator=QIntValidator())
+
+        orangegui.checkBox(main_box, self, "analytic_jacobian", "Analytic derivatives (when available)")
+
+        orangegui.comboBox(main_box, self, "peak_synthesis", label="Peaks", items=PeakSynthesis.tuple(), orientation="horizontal")
+
+        multiresolution_box = gui.widgetBox(main_box, "", orientation="vertical", width=250)
+
+        gui.lineEdit(multiresolution_box, self, "multiresolution_stages", "Resolution stages (1 = full only)", labelWidth=190, valueType=int, validator=QIntValidator(), orientation="horizontal")
+        gui.lineEdit(multiresolution_box, self, "multiresolution_stall", "Next stage below wss gain", labelWidth=190, valueType=float, validator=QDoubleValidator(), orientation="horizontal")
+
         iteration_box = gui.widgetBox(main_box, "", orientation="vertical", width=250)
 
         self.le_current_iteration = gui.lineEdit(iteration_box, self, "current_iteration", "Current Iteration", labelWidth=120, valueType=int, orientation="horizontal")
@@ -400,6 +433,11 @@ class OWFitter(OWGenericWidget):
                 self.stop_fit = False
 
                 congruence.checkStrictlyPositiveNumber(self.n_iterations, "Nr. Iterations")
+                congruence.checkStrictlyPositiveNumber(self.n_workers, "Nr. Workers")
+                congruence.checkStrictlyPositiveNumber(self.multiresolution_stages, "Resolution stages")
+                congruence.checkPositiveNumber(self.multiresolution_stall, "Next stage below wss gain")
+                if self.cb_fitter.currentText() == FitterName.LEAST_SQUARES:
+                    congruence.checkStrictlyPositiveNumber(self.least_squares_max_nfev, "Max evaluations per iteration")
 
                 if self.fit_global_parameters.fit_initialization is None:
                     raise ValueError("Mandatory widgets (Load Data/Fit Initialization/Crystal Structure) are totally missing.")
@@ -426,7 +464,7 @@ class OWFitter(OWGenericWidget):
                 sys.stdout = EmittingStream(textWritten=self.write_stdout)
 
                 if self.is_incremental == 0 or (self.is_incremental == 1 and self.current_iteration == 0):
-                    self.fitter = FitterFactory.create_fitter(fitter_name=self.cb_fitter.currentText())
+                    self.create_fitter()
 
                     self.fitter.init_fitter(initial_fit_global_parameters)
                     self.current_wss = []
@@ -458,9 +496,34 @@ class OWFitter(OWGenericWidget):
         self.setStatusMessage("")
         self.progressBarFinished()
 
+    def set_fitter_name(self):
+        self.least_squares_box.setVisible(self.cb_fitter.currentText() == FitterName.LEAST_SQUARES)
+
+    def create_fitter(self):
+        # the fitter replaced releases its workers
+        if not getattr(self, "fitter", None) is None: self.fitter.finalize_fit()
+
+        self.fitter = FitterFactory.create_fitter(fitter_name=self.cb_fitter.currentText(),
+                                                  additional_data=self.get_fitter_additional_data())
+
+    def get_fitter_additional_data(self):
+        additional_data = {"n_workers": self.n_workers,
+                           "analytic_jacobian": self.analytic_jacobian == 1,
+                           "synthesis": self.peak_synthesis,
+                           "multiresolution_stages": self.multiresolution_stages,
+                           "multiresolution_stall": self.multiresolution_stall}
+
+        if self.cb_fitter.currentText() == FitterName.LEAST_SQUARES:
+            additional_data["method"] = LeastSquaresMethod.tuple()[self.least_squares_method]
+            additional_data["jacobian"] = LeastSquaresJacobian.tuple()[self.least_squares_jacobian]
+            additional_data["x_scale"] = "jac" if self.least_squares_x_scale == 1 else 1.0
+            additional_data["max_nfev"] = self.least_squares_max_nfev
+
+        return additional_data
+
     def send_current_fit(self):
         if not self.fit_global_parameters is None:
-            self.send("Fit Global Parameters", self.fit_global_parameters.duplicate())
+            self.send("Fit Global Parameters", self.fit_global_parameters.snapshot())
 
     def set_data(self, data):
         try:
@@ -529,7 +592,7 @@ class OWFitter(OWGenericWidget):
                     self.fitted_fit_global_parameters = self.fit_global_parameters.duplicate()
                     self.fitted_fit_global_parameters.evaluate_functions()
 
-                    self.fitter = FitterFactory.create_fitter(fitter_name=self.cb_fitter.currentText())
+                    self.create_fitter()
                     self.fitter.init_fitter(self.fitted_fit_global_parameters)
 
                     self.fitted_patterns = self.fitter.build_fitted_diffraction_pattern(self.fitted_fit_global_parameters)
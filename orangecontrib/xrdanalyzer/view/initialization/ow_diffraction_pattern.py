@@ -13,6 +13,7 @@ from Orange.canvas import resources
 from orangecontrib.xrdanalyzer.util.widgets.ow_generic_widget import OWGenericWidget
 from orangecontrib.xrdanalyzer.util.gui.gui_utility import gui, ConfirmDialog
 from orangecontrib.xrdanalyzer.util import congruence
+from orangecontrib.xrdanalyzer.util.reference_data import reference_data
 from orangecontrib.xrdanalyzer.model.diffraction_pattern import DiffractionPattern, DiffractionPatternFactory, DiffractionPatternLimits
 from orangecontrib.xrdanalyzer.controller.fit.fit_global_parameters import FitGlobalParameters
 from orangecontrib.xrdanalyzer.controller.fit.init.fit_initialization import FitInitialization
@@ -27,49 +28,59 @@ class Wavelenght:
         self.weight = weight
         self.is_principal = False
 
-wavelengths_data = {}
-
-def load_data_files():
+def get_data_files():
     directory_files = resources.package_dirname("orangecontrib.xrdanalyzer.view.initialization") + "/data"
 
-    try:
-        for path, dirs, files in os.walk(directory_files):
-
-            for file_name in files:
-                file = open(os.path.join(path, file_name), "r")
-
-                rows = file.readlines()
+    return [os.path.join(path, file_name) for path, dirs, files in os.walk(directory_files) for file_name in files]
 
-                key = rows[0].strip()
-                wavelengths = [None]*(len(rows)-1)
-                highest_weight = 0.0
-                for index in range(1, len(rows)):
-                    data = rows[index].split()
-                    wavelength = round(float(data[0].strip())/10, 8) # nm!
-                    weight = round(float(data[1].strip()), 6)
-                    highest_weight = highest_weight if weight <= highest_weight else weight
+def load_data_files(file_names):
+    # X-ray tube -> rows of wavelength (nm), weight
+    wavelengths_table = {}
 
-                    wavelengths[index-1] = Wavelenght(wavelength, weight)
+    try:
+        for file_name in file_names:
+            with open(file_name, "r") as file: rows = file.readlines()
 
-                for wavelength in wavelengths:
-                    if wavelength.weight == highest_weight:
-                        wavelength.is_principal = True
+            key = rows[0].strip()
+            wavelengths = []
+            for index in range(1, len(rows)):
+                data = rows[index].split()
+                wavelengths.append([round(float(data[0].strip())/10, 8), # nm!
+                                    round(float(data[1].strip()), 6)])
 
-                wavelengths_data[key] = wavelengths
+            wavelengths_table[key] = numpy.array(wavelengths).reshape((len(wavelengths), 2))
 
     except Exception as err:
         raise Exception("Problems reading X-ray Tubes Wavelengths Configuration file: {0}".format(err))
     except:
         raise Exception("Unexpected error while reading X-ray Tubes Wavelengths Configuration file: ", sys.exc_info()[0])
 
-load_data_files()
+    return wavelengths_table
+
+reference_data.register("xray_tube_wavelengths", get_data_files, load_data_files)
+
+_wavelengths_data = None
+
+def get_wavelengths_data():
+    # X-ray tube -> Wavelenght list, the one with the highest weight is the principal wavelength
+    global _wavelengths_data
+
+    if _wavelengths_data is None:
+        wavelengths_data = {}
+
+        for key, wavelengths_table in reference_data.get("xray_tube_wavelengths").items():
+            wavelengths = [Wavelenght(float(wavelength), float(weight)) for wavelength, weight in wavelengths_table]
+            highest_weight = max([0.0] + [wavelength.weight for wavelength in wavelengths])
+
+            for wavelength in wavelengths:
+                if wavelength.weight == highest_weight:
+                    wavelength.is_principal = True
+
+            wavelengths_data[key] = wavelengths
+
+        _wavelengths_data = wavelengths_data
 
-'''
-for key in wavelengths_data.keys():
-    print(key)
-    wavelengths = wavelengths_data[key]
-    for wavelength in wavelengths: print(wavelength.wavelength, wavelength.weight, wavelength.is_principal)
-'''
+    return _wavelengths_data
 
 class OWDiffractionPattern(OWGenericWidget):
 
@@ -1572,7 +1583,7 @@ class DiffractionPatternBox(QtWidgets.QWidget, OWComponent):
     def get_xray_tube_keys(self):
         items = []
 
-        for key in wavelengths_data.keys():
+        for key in get_wavelengths_data().keys():
             items.append(key)
 
         return items
@@ -1580,11 +1591,11 @@ class DiffractionPatternBox(QtWidgets.QWidget, OWComponent):
     def create_wavelength_boxes(self):
         self.secondary_wavelengths_boxes = {}
 
-        for key in wavelengths_data.keys():
+        for key in get_wavelengths_data().keys():
             self.secondary_wavelengths_boxes[key] = gui.widgetBox(self.secondary_box_2, key + " Secondary Wavelengths", orientation="vertical", width=self.CONTROL_AREA_WIDTH - 40, height=230)
 
             secondary_index = 2
-            for wavelenght in wavelengths_data[key]:
+            for wavelenght in get_wavelengths_data()[key]:
                 if not wavelenght.is_principal:
                     var_wl = "wavelength_" + str(secondary_index)
                     var_we = "weight_" + str(secondary_index)
@@ -1599,9 +1610,9 @@ class DiffractionPatternBox(QtWidgets.QWidget, OWComponent):
             self.secondary_wavelengths_boxes[key].setVisible(False)
 
     def set_xray_tube_key(self):
-        if not self.is_on_init and self.xray_tube_key in wavelengths_data.keys():
+        if not self.is_on_init and self.xray_tube_key in get_wavelengths_data().keys():
             secondary_index = 2
-            for wavelength in wavelengths_data[self.xray_tube_key]:
+            for wavelength in get_wavelengths_data()[self.xray_tube_key]:
                 if not wavelength.is_principal:
                     var_wl = "wavelength_" + str(secondary_index)
                     var_we = "weight_" + str(secondary_index)
@@ -1728,7 +1739,7 @@ class DiffractionPatternBox(QtWidgets.QWidget, OWComponent):
             secondary_wavelengths_weights = []
 
             secondary_index = 2
-            for wavelenght in wavelengths_data[self.xray_tube_key]:
+            for wavelenght in get_wavelengths_data()[self.xray_tube_key]:
                 if not wavelenght.is_principal:
                     var_wl = "wavelength_" + str(secondary_index)
                     var_we = "weight_" + str(secondary_index)
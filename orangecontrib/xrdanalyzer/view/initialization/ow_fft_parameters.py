@@ -1,7 +1,7 @@
 import sys
 
 from PyQt5.QtWidgets import QMessageBox, QApplication
-from PyQt5.QtGui import QDoubleValidator
+from PyQt5.QtGui import QDoubleValidator, QIntValidator
 
 from Orange.widgets.settings import Setting
 from Orange.widgets import gui as orangegui
@@ -10,7 +10,7 @@ from orangecontrib.xrdanalyzer.util.widgets.ow_generic_widget import OWGenericWi
 from orangecontrib.xrdanalyzer.util.gui.gui_utility import gui, ShowTextDialog
 from orangecontrib.xrdanalyzer.util import congruence
 from orangecontrib.xrdanalyzer.controller.fit.fit_global_parameters import FitGlobalParameters
-from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import FFTInitParameters, FFTTypes
+from orangecontrib.xrdanalyzer.controller.fit.init.fft_parameters import FFTInitParameters, FFTTypes, FFTImplementation
 
 class OWFFTParameters(OWGenericWidget):
 
@@ -24,6 +24,12 @@ class OWFFTParameters(OWGenericWidget):
     s_max = Setting(9.0)
     n_step = Setting(3)
     fft_type = Setting(0)
+    peak_threshold = Setting(1e-4)
+    fft_implementation = Setting(1)
+    fft_workers = Setting(1)
+    auto_grid = Setting(0)
+    auto_tolerance = Setting(1e-4)
+    auto_check_interval = Setting(5)
 
     inputs = [("Fit Global Parameters", FitGlobalParameters, 'set_data')]
     outputs = [("Fit Global Parameters", FitGlobalParameters)]
@@ -33,7 +39,7 @@ class OWFFTParameters(OWGenericWidget):
 
         main_box = gui.widgetBox(self.controlArea,
                                  "Fit Initialization", orientation="vertical",
-                                 width=self.CONTROL_AREA_WIDTH - 10, height=250)
+                                 width=self.CONTROL_AREA_WIDTH - 10, height=430)
 
 
         button_box = gui.widgetBox(main_box,
@@ -51,15 +57,44 @@ class OWFFTParameters(OWGenericWidget):
         self.cb_n_step = orangegui.comboBox(fft_box, self, "n_step", label="FFT Steps", labelWidth=350, items=["1024", "2048", "4096", "8192", "16384", "32768", "65536"], sendSelectedValue=True, orientation="horizontal")
         orangegui.comboBox(fft_box, self, "fft_type", label="FFT Type", items=FFTTypes.tuple(), orientation="horizontal")
 
+        gui.lineEdit(fft_box, self, "peak_threshold", "Peak threshold (relative to max)", labelWidth=250, valueType=float, validator=QDoubleValidator())
+
+        orangegui.comboBox(fft_box, self, "fft_implementation", label="FFT Implementation", items=FFTImplementation.tuple(), orientation="horizontal")
+        gui.lineEdit(fft_box, self, "fft_workers", "FFT Threads (-1 = all CPUs)", labelWidth=250, valueType=int, validator=QIntValidator())
+
+        auto_box = gui.widgetBox(main_box,
+                                 "Automatic Grid", orientation="vertical",
+                                 width=self.CONTROL_AREA_WIDTH - 30)
+
+        orangegui.checkBox(auto_box, self, "auto_grid", "S_max and FFT Steps from the profiles", callback=self.set_auto_grid)
+
+        self.le_auto_tolerance = gui.lineEdit(auto_box, self, "auto_tolerance", "Tolerance (relative to max)", labelWidth=250, valueType=float, validator=QDoubleValidator())
+        self.le_auto_check_interval = gui.lineEdit(auto_box, self, "auto_check_interval", "Check every [iterations]", labelWidth=250, valueType=int, validator=QIntValidator())
+
+        self.set_auto_grid()
+
+    def set_auto_grid(self):
+        self.le_auto_tolerance.setEnabled(self.auto_grid == 1)
+        self.le_auto_check_interval.setEnabled(self.auto_grid == 1)
 
     def send_fit_initialization(self):
         try:
             if not self.fit_global_parameters is None:
                 congruence.checkStrictlyPositiveNumber(self.s_max, "S Max")
+                congruence.checkPositiveNumber(self.peak_threshold, "Peak threshold")
+                if self.auto_grid == 1:
+                    congruence.checkStrictlyPositiveNumber(self.auto_tolerance, "Tolerance")
+                    congruence.checkStrictlyPositiveNumber(self.auto_check_interval, "Check interval")
 
                 self.fit_global_parameters.fit_initialization.fft_parameters = FFTInitParameters(s_max=self.s_max,
                                                                                                  n_step=int(self.cb_n_step.currentText()),
-                                                                                                 fft_type=self.fft_type)
+                                                                                                 fft_type=self.fft_type,
+                                                                                                 peak_threshold=self.peak_threshold,
+                                                                                                 fft_implementation=self.fft_implementation,
+                                                                                                 fft_workers=self.fft_workers,
+                                                                                                 auto_grid=self.auto_grid == 1,
+                                                                                                 auto_tolerance=self.auto_tolerance,
+                                                                                                 auto_check_interval=self.auto_check_interval)
 
                 self.send("Fit Global Parameters", self.fit_global_parameters)
 
@@ -78,6 +113,14 @@ class OWFFTParameters(OWGenericWidget):
                 self.n_step = ((self.fit_global_parameters.fit_initialization.fft_parameters.n_step)/1024)-1
                 self.s_max = self.fit_global_parameters.fit_initialization.fft_parameters.s_max
                 self.fft_type = self.fit_global_parameters.fit_initialization.fft_parameters.fft_type
+                self.peak_threshold = self.fit_global_parameters.fit_initialization.fft_parameters.peak_threshold
+                self.fft_implementation = self.fit_global_parameters.fit_initialization.fft_parameters.fft_implementation
+                self.fft_workers = self.fit_global_parameters.fit_initialization.fft_parameters.fft_workers
+                self.auto_grid = 1 if self.fit_global_parameters.fit_initialization.fft_parameters.auto_grid else 0
+                self.auto_tolerance = self.fit_global_parameters.fit_initialization.fft_parameters.auto_tolerance
+                self.auto_check_interval = self.fit_global_parameters.fit_initialization.fft_parameters.auto_check_interval
+
+                self.set_auto_grid()
 
             if self.is_automatic_run:
                 self.send_fit_initialization()